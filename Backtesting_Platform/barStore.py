@@ -0,0 +1,170 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+barStore.py
+描述：收益panel的持久化存储
+     (t-lag, t]区间的绝对或相对收益只与股票池、周期、lag、收益类型及时间有关，与因子无关，
+     每个(股票池, 周期, lag, 收益类型)存一份，由FactorUpdate回放时的Returns或RelativeReturns计算，
+     新的分钟数据到来时只追加晚于已存最后时间的新bar；批量检测模式下各因子直接读取，回放时不再创建收益对象
+说明：resample后的bar不存储，因子仍需在分钟panelFeed及ResampledPanelFeed上回放，见FactorUpdate._updateBarStores；
+     sessionBarIndex和resampleBars由分钟数据直接计算bar，用于检验与ResampledPanelFeed的一致性
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from cpa.utils import logger
+from cpa.config import pathSelector
+from cpa.io import panelCache
+
+
+class BarStore:
+    '''
+    单个(股票池, 周期, lag, 收益类型)的收益存储，以PanelCache的内存映射格式保存，新数据作为新的数据段追加
+    存储位置：<cacheDir>/<instruments>_<freq>_lag<lag>_<abs|rel>/
+    字段：returns
+    '''
+
+    logger = logger.getLogger("BarStore")
+    FIELDS = ['returns']
+
+    def __init__(self, instruments, freqStr, lag=1, isRelReturn=False, cacheDir=None):
+        '''
+        param instruments: 代码 "SZ50", "HS300", or "ZZ500"
+        param freqStr: 周期标签，如 "5min"
+        param lag: 收益的间隔bar数
+        param isRelReturn: True为相对基准指数的收益
+        param cacheDir: 存储根目录，为空时为factorData旁的barStore文件夹
+        '''
+        if cacheDir is None:
+            factorDataPath = pathSelector.PathSelector.getFactorFilePath().rstrip(os.sep)
+            cacheDir = os.path.join(os.path.dirname(factorDataPath), "barStore")
+        self.instruments = instruments
+        self.freqStr = freqStr
+        self.lag = lag
+        self.isRelReturn = isRelReturn
+        name = "{}_{}_lag{}_{}".format(instruments, freqStr, lag, "rel" if isRelReturn else "abs")
+        self.panelCache = panelCache.PanelCache(name, sourcePaths=[], fields=self.FIELDS, cacheDir=cacheDir,
+                                                sourceKey=name)
+
+    def lastTime(self):
+        '''已存最后一个bar的时间，没有数据时返回None'''
+        if not self.panelCache.isValid():
+            return None
+        dates = self.panelCache.getDates()
+        return dates[-1] if len(dates) else None
+
+    def coverStart(self):
+        '''
+        已存数据对应的回放开始时间，为空字符串时表示从数据源的第一天开始
+        return: 没有数据时返回None
+        '''
+        if not self.panelCache.isValid():
+            return None
+        return self.panelCache.getAttrs().get("start")
+
+    def needsRebuild(self, start):
+        '''
+        回放开始时间早于已存数据的开始时间时需重建
+        param start: 本次回放的开始时间，为空时为数据源的第一天
+        '''
+        coverStart = self.coverStart()
+        if coverStart is None:
+            return True
+        if coverStart == "":
+            return False
+        return start is None or pd.Timestamp(start).normalize() < pd.Timestamp(coverStart).normalize()
+
+    def update(self, returnFrame, start=None):
+        '''
+        写入回放得到的收益，只追加晚于已存最后时间的bar，已存的bar不重新读取或写入
+        param returnFrame: Returns或RelativeReturns的to_frame()，index为bar时间，columns为代码
+        param start: 本次回放的开始时间，需重建（见needsRebuild）时记录为已存数据的开始时间
+        return: 新增的bar数
+        '''
+        if self.needsRebuild(start):
+            self.panelCache.build({"returns": returnFrame}, attrs={"start": "" if start is None else str(start)})
+            self.logger.info("{} bars have been written to {}".format(len(returnFrame), self.panelCache.name))
+            return len(returnFrame)
+        lastTime = self.lastTime()
+        newFrame = returnFrame if lastTime is None else returnFrame.loc[returnFrame.index > lastTime]
+        if not len(newFrame) or not self.panelCache.append({"returns": newFrame}):
+            return 0  # 没有新的bar，或并行时其他进程已追加了相同的bar
+        self.logger.info("{} bars have been added to {}".format(len(newFrame), self.panelCache.name))
+        return len(newFrame)
+
+    def covers(self, start, end):
+        '''
+        已存数据覆盖[start, end]：不需要重建，且已存的最后一个bar晚于end当天
+        end当天的bar已部分存储时仍需回放，检查是否有新的bar
+        '''
+        lastTime = self.lastTime()
+        return end is not None and lastTime is not None and not self.needsRebuild(start) \
+            and lastTime.normalize() > pd.Timestamp(end).normalize()
+
+    def replayStart(self, start):
+        '''
+        追加新bar需要回放的开始时间：已存最后一个bar所在日期之前lag+1个工作日，使新bar的收益有足够的前序bar；
+        start晚于已存数据时同样从该时间回放，已存数据与start之间的bar一并追加
+        param start: 本次计算的开始时间，需重建时直接从start回放
+        '''
+        lastTime = self.lastTime()
+        if lastTime is None or self.needsRebuild(start):
+            return start
+        return lastTime.normalize() - pd.tseries.offsets.BusinessDay(n=self.lag + 1)
+
+    def load(self, start=None, end=None, fields=None):
+        '''
+        以内存映射方式读取[start, end]的数据
+        return: {field: DataFrame}，index为bar时间，columns为代码
+        '''
+        return self.panelCache.load(start=start, end=end, fields=fields)
+
+
+def sessionBarIndex(minuteIndex, freqStr, sessionGap="30min"):
+    '''
+    由分钟时间和周期长度得到bar的结束时间，与因子值无关
+    相邻分钟间隔超过sessionGap处分为不同交易时段，各时段从第一分钟的前一分钟起按周期长度切分，
+    时段末不足一个周期的部分以时段最后一分钟结束，如A股5min的bar结束于09:35, ..., 11:30, 13:05, ..., 15:00
+    param minuteIndex: 分钟时间，分钟bar的时间为其结束时间
+    param freqStr: 周期标签，如 "5min", "2h"
+    return: 升序的DatetimeIndex
+    '''
+    minutes = pd.DatetimeIndex(minuteIndex).unique().sort_values()
+    if not len(minutes):
+        return minutes
+    values = minutes.values.astype("datetime64[ns]").view(np.int64)
+    length = pd.Timedelta(freqStr).value
+    isBreak = np.diff(values) > pd.Timedelta(sessionGap).value
+    sessionId = np.r_[0, np.cumsum(isBreak)]
+    anchor = (values[np.r_[True, isBreak]] - pd.Timedelta(minutes=1).value)[sessionId]
+    sessionEnd = values[np.r_[isBreak, True]][sessionId]
+    ends = anchor + -((anchor - values) // length) * length  # 向上取整到周期的整数倍
+    return pd.DatetimeIndex(np.unique(np.minimum(ends, sessionEnd)))
+
+
+def resampleBars(minuteDict, barIndex):
+    '''
+    将分钟数据聚合为给定结束时间的bar，每根bar包含上一根bar之后到本bar结束时间（含）的分钟
+    收盘价取bar结束时刻最近一分钟的收盘价，与批量检测模式原有的计算方式一致
+    param minuteDict: 分钟数据{field: DataFrame}，index为时间，columns为代码
+    param barIndex: bar的结束时间，升序
+    return: {field: DataFrame}，index为barIndex
+    '''
+    if not len(barIndex):
+        return {field: pd.DataFrame(index=barIndex, columns=minuteDict["close"].columns, dtype=np.float64)
+                for field in ['open', 'high', 'low', 'close', 'volume']}
+    minuteIndex = minuteDict["close"].index
+    inRange = minuteIndex <= barIndex[-1]
+    barId = barIndex.searchsorted(minuteIndex[inRange], side="left")  # 分钟所属的bar
+    barDict = {"close": minuteDict["close"].reindex(index=barIndex, method="ffill")}
+    for field, how in [("open", "first"), ("high", "max"), ("low", "min"), ("volume", "sum")]:
+        grouped = minuteDict[field][inRange].groupby(barId)
+        frame = getattr(grouped, how)(min_count=1) if how == "sum" else getattr(grouped, how)()
+        frame.index = barIndex[frame.index]
+        barDict[field] = frame.reindex(barIndex)
+    return {field: barDict[field].astype(np.float64) for field in ['open', 'high', 'low', 'close', 'volume']}
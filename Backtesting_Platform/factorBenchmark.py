@@ -0,0 +1,629 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+factorBenchmark.py
+描述：因子更新流程的性能测试
+     生成SZ50、HS300、ZZ500规模的模拟分钟OHLCV数据和模拟基准指数，在临时目录中离线运行，
+     分别计时数据读取、各周期resample、因子计算、DefaultFactorTest的各检测指标、批量检测、
+     h5的new/append/tail写入以及图表生成，结果以JSON lines输出，可与保存的基准结果比较；
+     --check时在同样的模拟数据上运行一致性检查（CHECKS），比较不同计算路径写入的数据
+说明：pathSelector替换为指向临时目录的BenchPathSelector，DataFeedFactory替换为SyntheticFeedFactory，
+     模拟分钟数据在内存中生成，基准指数按原始数据的文件布局写入临时目录，不读取也不改写真实的data和factorData
+用法：python factorBenchmark.py --universe SZ50 HS300 --factor maPanelFactor --output bench.jsonl
+     python factorBenchmark.py --universe ZZ500 --baseline baseline.jsonl --threshold 1.2
+     python factorBenchmark.py --universe SZ50 --check
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from cpa.utils import bar, logger
+from cpa.config import pathSelector, const
+from cpa.io import h5Writer, panelCache, factorStorage
+from cpa.io.reportWriter import ReportWriter, ReportData, testerHash
+from cpa.factorModel import factorBase
+from cpa.factorPool import factorUpdate, multiUniverse
+from cpa.indicators.panelIndicators import returns
+from cpa.factorProcessor.factorTest import DefaultFactorTest
+from cpa.factorProcessor import panelFactorTest
+from cpa.resample.resampled import ResampledPanelFeed
+
+UNIVERSES = {"SZ50": 50, "HS300": 300, "ZZ500": 500}
+BENCH_FILES = {"SZ50": "IH.CCFX", "HS300": "IF.CCFX", "ZZ500": "IC.CCFX"}
+INDICATORS = ['IC', 'rankIC', 'beta', 'gpIC', 'tbdf', 'turn', 'groupRet']
+
+
+def tradingMinutes(start, days):
+    '''
+    A股交易时间的分钟时间戳，每天09:31-11:30和13:01-15:00共240个
+    param start: 开始日期
+    param days: 工作日天数
+    '''
+    morning = pd.timedelta_range("09:31:00", "11:30:00", freq="min")
+    afternoon = pd.timedelta_range("13:01:00", "15:00:00", freq="min")
+    minutes = morning.append(afternoon)
+    dates = pd.bdate_range(start, periods=days)
+    return pd.DatetimeIndex([date + minute for date in dates for minute in minutes])
+
+
+def makeMinutePanel(instruments, index, seed=0):
+    '''
+    几何随机游走生成的模拟分钟OHLCV
+    return: {field: DataFrame}，index为时间，columns为代码
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (len(index), len(instruments))
+    logRet = rng.normal(0.0, 0.001, size=shape)
+    close = 10.0 * np.exp(np.cumsum(logRet, axis=0)) * rng.uniform(0.5, 5.0, size=shape[1])
+    openPrice = np.vstack([close[:1], close[:-1]])
+    spread = np.abs(rng.normal(0.0, 0.0005, size=shape)) * close
+    frameDict = {"open": openPrice,
+                 "high": np.maximum(openPrice, close) + spread,
+                 "low": np.minimum(openPrice, close) - spread,
+                 "close": close,
+                 "volume": rng.integers(100, 100000, size=shape).astype(np.float64)}
+    return {field: pd.DataFrame(values, index=index, columns=instruments) for field, values in frameDict.items()}
+
+
+def writeSyntheticData(universe, days, start="2019-01-02", seed=0):
+    '''
+    生成一个股票池的模拟分钟数据和基准指数数据，需在offlineEnvironment中调用
+    股票池的分钟数据登记在SyntheticFeedFactory中，不写文件；
+    基准指数按原始数据的文件布局写入<bench>.csv，列为datetime, open, high, low, close, volume
+    return: 分钟时间索引
+    '''
+    index = tradingMinutes(start, days)
+    instruments = ["{:06d}.XSHE".format(i + 1) for i in range(UNIVERSES[universe])]
+    SyntheticFeedFactory.panelDict[universe] = makeMinutePanel(instruments, index, seed=seed)
+
+    benchDict = makeMinutePanel([BENCH_FILES[universe]], index, seed=seed + 1)
+    benchFrame = pd.DataFrame({field: frame.iloc[:, 0] for field, frame in benchDict.items()})
+    benchFrame.index.name = "datetime"
+    benchPath = BenchPathSelector.getDataFilePath(market=const.DataMarket.FUTURES, types=const.DataType.OHLCV,
+                                                  frequency=const.DataFrequency.MINUTE,
+                                                  fileName="{}.csv".format(BENCH_FILES[universe]))
+    benchFrame.reset_index().to_csv(benchPath, index=False)
+    return index
+
+
+class BenchPathSelector:
+    '''
+    替代pathSelector.PathSelector，数据和因子数据均指向临时目录，因子定义路径沿用原路径
+    '''
+
+    rootPath = None
+    factorDefPath = None
+    factorDataName = "factorData"  # 一致性检查时切换为不同的文件夹，见factorDataRoot
+
+    @classmethod
+    def getDataFilePath(cls, market=None, types=None, frequency=None, fileName=None):
+        folderPath = os.path.join(cls.rootPath, "data", *[str(part) for part in [market, types, frequency]
+                                                          if part is not None])
+        os.makedirs(folderPath, exist_ok=True)
+        return os.path.join(folderPath, fileName) if fileName else folderPath
+
+    @classmethod
+    def getFactorFilePath(cls, factorName=None, factorFrequency=None, fileName=None):
+        folderPath = os.path.join(cls.rootPath, cls.factorDataName, *[part for part in [factorName, factorFrequency]
+                                                                if part is not None])
+        os.makedirs(folderPath, exist_ok=True)
+        return os.path.join(folderPath, fileName) if fileName else folderPath
+
+    @classmethod
+    def getFactorDefPath(cls):
+        return cls.factorDefPath
+
+
+class SyntheticFeedFactory(factorUpdate.DataFeedFactory):
+    '''
+    替代DataFeedFactory，由writeSyntheticData登记的内存中的模拟分钟数据创建reader和panelFeed，不读取数据文件
+    只替换getHistReader和getHistFeed，由reader创建feed的getReaderFeed沿用框架的DataFeedFactory
+    '''
+
+    panelDict = {}  # {股票池: {field: DataFrame}}
+
+    @classmethod
+    def getHistReader(cls, instruments, market=bar.Market.STOCK, frequency=bar.Frequency.MINUTE, start=None, end=None):
+        if instruments not in cls.panelDict:
+            raise ValueError("No synthetic data for {}, registered: {}".format(instruments, sorted(cls.panelDict)))
+        return panelCache.FramePanelReader(cls.panelDict[instruments], frequency=frequency, start=start, end=end,
+                                           isInstrumentCol=True)
+
+    @classmethod
+    def getHistFeed(cls, instruments, market=bar.Market.STOCK, frequency=bar.Frequency.MINUTE, start=None, end=None):
+        return cls.getReaderFeed(cls.getHistReader(instruments, market=market, frequency=frequency,
+                                                   start=start, end=end))
+
+
+@contextlib.contextmanager
+def offlineEnvironment(rootPath):
+    '''在with块中用BenchPathSelector和SyntheticFeedFactory替换真实的路径和数据源'''
+    originalSelector = pathSelector.PathSelector
+    originalFactory = factorUpdate.DataFeedFactory
+    BenchPathSelector.rootPath = rootPath
+    BenchPathSelector.factorDefPath = originalSelector.getFactorDefPath()
+    pathSelector.PathSelector = BenchPathSelector
+    factorUpdate.DataFeedFactory = multiUniverse.DataFeedFactory = SyntheticFeedFactory
+    try:
+        yield
+    finally:
+        pathSelector.PathSelector = originalSelector
+        factorUpdate.DataFeedFactory = multiUniverse.DataFeedFactory = originalFactory
+
+
+@contextlib.contextmanager
+def factorDataRoot(name):
+    '''在with块中将BenchPathSelector的factorData指向临时目录下的另一个文件夹，模拟数据不变'''
+    originalName = BenchPathSelector.factorDataName
+    BenchPathSelector.factorDataName = name
+    try:
+        yield
+    finally:
+        BenchPathSelector.factorDataName = originalName
+
+
+class FactorUpdateBenchmark:
+    '''
+    一个股票池一个因子的分阶段计时
+    每条记录：{"universe", "factor", "stage", "frequency", "indicator", "seconds", "cpuSeconds", "netSeconds",
+              "repeat", "nInstruments", "nMinutes"}，netSeconds为扣除前置阶段后的净耗时
+    '''
+
+    logger = logger.getLogger("FactorUpdateBenchmark")
+
+    def __init__(self, universe, factorName, index, testFreq=None, repeat=1):
+        '''
+        param universe: "SZ50", "HS300" or "ZZ500"
+        param factorName: factorPool中已有的因子名
+        param index: 模拟数据的分钟时间索引
+        param testFreq: resample周期列表，为空时使用FactorUpdate的默认周期
+        param repeat: 重复次数
+        '''
+        self.universe = universe
+        self.factorName = factorName
+        self.index = index
+        self.repeat = repeat
+        self.start = index[0].strftime("%Y%m%d")
+        self.end = index[-1].strftime("%Y%m%d")
+        self.factorUpdate = factorUpdate.FactorUpdate(instruments=universe, start=self.start, end=self.end,
+                                                      testFreq=testFreq, isRelReturn=False, reportWorkers=0)
+        # 批量检测按周期分别计时，每个周期使用只含该周期的FactorUpdate
+        self.freqUpdateDict = {freqStr: factorUpdate.FactorUpdate(instruments=universe, start=self.start,
+                                                                  end=self.end, testFreq=[freqNum],
+                                                                  isRelReturn=False, reportWorkers=0)
+                               for freqNum, freqStr in zip(self.factorUpdate.resampleFreqNum,
+                                                           self.factorUpdate.resampleFreqStr)}
+        self.factorObject = self.factorUpdate._loadFactorObject(factorName)
+        self.records = []
+        self.currentRepeat = 0
+
+    def timeit(self, stage, function, frequency=None, indicator=None, baseSeconds=0.0):
+        '''
+        计时并记录一个阶段
+        param baseSeconds: 前置阶段的耗时，用于计算净耗时
+        return: function的返回值
+        '''
+        wallStart, cpuStart = time.perf_counter(), time.process_time()
+        result = function()
+        seconds, cpuSeconds = time.perf_counter() - wallStart, time.process_time() - cpuStart
+        self.records.append({"universe": self.universe, "factor": self.factorName, "stage": stage,
+                             "frequency": frequency, "indicator": indicator,
+                             "seconds": seconds, "cpuSeconds": cpuSeconds,
+                             "netSeconds": max(seconds - baseSeconds, 0.0), "repeat": self.currentRepeat,
+                             "nInstruments": UNIVERSES[self.universe], "nMinutes": len(self.index)})
+        self.logger.info("{} {} {} {}: {:.3f}s".format(self.universe, stage, frequency or "", indicator or "", seconds))
+        return result
+
+    def lastSeconds(self):
+        return self.records[-1]["seconds"]
+
+    def _replay(self, freqNum, withFactor=False, indicators=None, start=None):
+        '''新建panelFeed和一个周期的流水线后回放，返回(feed, 检测对象)'''
+        fu = self.factorUpdate
+        fu.start = start or self.start
+        panelFeed = fu.getPanelFeed()
+        resampleFeed = ResampledPanelFeed(panelFeed, freqNum)
+        tester = None
+        if withFactor:
+            returnPanel = returns.Returns(resampleFeed, lag=fu.lag, maxLen=1024)
+            factorPanel = factorBase.FactorPanel(resampleFeed, self.factorObject)
+            if indicators:
+                tester = DefaultFactorTest(resampleFeed, factorPanel, returnPanel, indicators=indicators,
+                                           lag=fu.lag, cut=0.1, fee=fu.fee)
+            else:
+                tester = factorPanel
+        return panelFeed, tester
+
+    def run(self):
+        '''运行全部阶段，返回记录列表'''
+        for self.currentRepeat in range(self.repeat):
+            self.runOnce()
+        return self.records
+
+    def runOnce(self):
+        fu = self.factorUpdate
+        self.timeit("feedLoad", fu.getPanelFeed)
+        for freqNum, freqStr in zip(fu.resampleFreqNum, fu.resampleFreqStr):
+            panelFeed, _ = self._replay(freqNum)
+            self.timeit("resample", lambda: panelFeed.run(_print=False), frequency=freqStr)
+            resampleSeconds = self.lastSeconds()
+
+            panelFeed, factorPanel = self._replay(freqNum, withFactor=True)
+            self.timeit("factor", lambda: panelFeed.run(_print=False), frequency=freqStr,
+                        baseSeconds=resampleSeconds)
+            factorSeconds = self.lastSeconds()
+
+            for indicator in INDICATORS:
+                panelFeed, tester = self._replay(freqNum, withFactor=True, indicators=[indicator])
+                self.timeit("indicator", lambda: panelFeed.run(_print=False), frequency=freqStr,
+                            indicator=indicator, baseSeconds=factorSeconds)
+
+            freqUpdate = self.freqUpdateDict[freqStr]
+            driverFeed = freqUpdate._buildFeeds(freqUpdate.getPanelFeed(), fullHistory=True)
+            factorPanelDict = freqUpdate._buildFactorPanels(self.factorObject)
+            driverFeed.run(_print=False)
+            self.timeit("vectorIndicators", lambda: freqUpdate._buildPanelTesters(factorPanelDict),
+                        frequency=freqStr)
+            self.runWrites(freqNum, freqStr)
+
+    def runWrites(self, freqNum, freqStr):
+        '''
+        new模式写入前70%的数据，再以最后30%的数据分别计时append和tail续写，最后计时图表生成
+        tail续写在复制出的因子文件夹上进行，与append互不影响
+        '''
+        fu = self.factorUpdate
+        splitTime = self.index[int(len(self.index) * 0.7)]
+        savedEnd = fu.end
+        fu.end = splitTime.strftime("%Y%m%d")
+        panelFeed, tester = self._replay(freqNum, withFactor=True, indicators=INDICATORS)
+        panelFeed.run(_print=False)
+        fu.end = savedEnd
+
+        tailName = self.factorName + "_tail"
+        factorFolder = os.path.join(BenchPathSelector.getFactorFilePath(), self.factorName)
+        tailFolder = os.path.join(BenchPathSelector.getFactorFilePath(), tailName)
+        shutil.rmtree(factorFolder, ignore_errors=True)
+        shutil.rmtree(tailFolder, ignore_errors=True)
+        self.timeit("writeNew", lambda: h5Writer.H5PanelWriter(self.factorName, tester,
+                                                                backend=fu.backend).write(mode="new"),
+                    frequency=freqStr)
+        shutil.copytree(factorFolder, tailFolder)
+
+        appendStart = (splitTime - pd.tseries.offsets.BusinessDay(n=3)).strftime("%Y%m%d")
+        panelFeed, tester = self._replay(freqNum, withFactor=True, indicators=INDICATORS, start=appendStart)
+        panelFeed.run(_print=False)
+
+        def writeAppend():
+            oldResultDict = factorStorage.readFactorData(self.factorName, freqStr)
+            h5Writer.H5PanelWriter(self.factorName, tester,
+                                   backend=fu.backend).write(mode="append", oldResultDict=oldResultDict)
+
+        self.timeit("writeAppend", writeAppend, frequency=freqStr)
+        self.timeit("writeTail", lambda: h5Writer.H5PanelWriter(tailName, tester).write(mode="tail"),
+                    frequency=freqStr)
+        self.timeit("report", lambda: ReportWriter(factorName=self.factorName,
+                                                    defaultFactorTest=tester).write(force=True),
+                    frequency=freqStr)
+
+
+def writeRecords(records, path):
+    '''以JSON lines写出记录，每行附带运行环境信息'''
+    environment = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                   "machine": platform.node(), "time": pd.Timestamp.now().isoformat(timespec="seconds")}
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps({**record, **environment}) + "\n")
+
+
+def loadRecords(path):
+    '''读取JSON lines记录'''
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    '''
+    按(universe, stage, frequency, indicator)取各次重复中最短的净耗时
+    return: {key: seconds}
+    '''
+    summary = {}
+    for record in records:
+        key = (record["universe"], record["stage"], record["frequency"], record["indicator"])
+        summary[key] = min(summary.get(key, float("inf")), record["netSeconds"])
+    return summary
+
+
+def compareBaseline(records, baselineRecords, threshold=1.2, minSeconds=0.05):
+    '''
+    与基准结果比较
+    param threshold: 耗时超过基准的倍数阈值
+    param minSeconds: 基准耗时低于该值的阶段不参与比较，避免计时噪声
+    return: [(key, 基准耗时, 本次耗时, 倍数)]，按倍数从大到小排列，只包含超过阈值的阶段
+    '''
+    current, baseline = summarize(records), summarize(baselineRecords)
+    regressions = []
+    for key, seconds in current.items():
+        baseSeconds = baseline.get(key)
+        if baseSeconds is None or baseSeconds < minSeconds:
+            continue
+        ratio = seconds / baseSeconds
+        if ratio > threshold:
+            regressions.append((key, baseSeconds, seconds, ratio))
+    return sorted(regressions, key=lambda item: -item[3])
+
+
+def maxAbsDiff(left, right):
+    '''
+    两个DataFrame或Series按index和columns（按字符串对齐）对齐后的最大绝对误差
+    缺失值的位置不一致时返回inf
+    '''
+    left, right = pd.DataFrame(left), pd.DataFrame(right)
+    left.columns, right.columns = left.columns.astype(str), right.columns.astype(str)
+    left, right = left.align(right, join="outer")
+    leftValues, rightValues = left.to_numpy(dtype=np.float64), right.to_numpy(dtype=np.float64)
+    if not np.array_equal(np.isnan(leftValues), np.isnan(rightValues)):
+        return float("inf")
+    diff = np.abs(leftValues - rightValues)[~np.isnan(leftValues)]
+    return float(diff.max()) if diff.size else 0.0
+
+
+def compareFactorData(factorName, leftName, rightName, freqList):
+    '''
+    比较两个factorData文件夹下同一因子各周期的全部数据，需在offlineEnvironment中调用
+    return: {(freqStr, 数据名): 最大绝对误差}，只在一侧存在的数据为inf
+    '''
+    diffDict = {}
+    for freqStr in freqList:
+        with factorDataRoot(leftName):
+            leftDict = factorStorage.readFactorData(factorName, freqStr)
+        with factorDataRoot(rightName):
+            rightDict = factorStorage.readFactorData(factorName, freqStr)
+        for key in sorted(set(leftDict) | set(rightDict)):
+            if key in leftDict and key in rightDict:
+                diffDict[(freqStr, key)] = maxAbsDiff(leftDict[key], rightDict[key])
+            else:
+                diffDict[(freqStr, key)] = float("inf")
+    return diffDict
+
+
+def checkCheckpointResume(universe, factorName, index, testFreq=None, checkpointDays=10):
+    '''
+    检查点续写与完整重算的一致性，需在offlineEnvironment中调用
+    一个factorData一次写入全部日期；另一个先写入前70%的日期并保存检查点，再由检查点以tail模式续写到最后，
+    checkpointDays需不少于因子及检测指标的回看长度
+    return: {(freqStr, 数据名): 最大绝对误差}
+    '''
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    start, end = dates[0].strftime("%Y%m%d"), dates[-1].strftime("%Y%m%d")
+    splitEnd = dates[int(len(dates) * 0.7) - 1].strftime("%Y%m%d")
+    kwargs = dict(instruments=universe, testFreq=testFreq, isRelReturn=False, reportWorkers=0,
+                  checkpointDays=checkpointDays)
+    with factorDataRoot("factorData_full"):
+        fullUpdate = factorUpdate.FactorUpdate(start=start, end=end, **kwargs)
+        fullUpdate._writeOneNewFactor(factorName)
+    with factorDataRoot("factorData_resume"):
+        resumeUpdate = factorUpdate.FactorUpdate(start=start, end=splitEnd, **kwargs)
+        resumeUpdate._writeOneNewFactor(factorName)
+        if not resumeUpdate._loadCheckpoints(factorName):
+            raise AssertionError("No checkpoint was saved for {}".format(factorName))
+        resumeUpdate.end = end
+        resumeUpdate.updateFactor(factorName, appendMode="tail", useCheckpoint=True)
+    return compareFactorData(factorName, "factorData_full", "factorData_resume", fullUpdate.resampleFreqStr)
+
+
+def checkStreamVector(universe, factorName, index, testFreq=None):
+    '''
+    批量检测与逐bar检测的一致性，需在offlineEnvironment中调用
+    同一FactorUpdate分别以stream和vector模式回放，由panelFactorTest.compareIndicators逐个指标比较，
+    包括turn, gpIC等定义容易不一致的指标
+    return: {(freqStr, 指标名): 最大绝对误差}
+    '''
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    fu = factorUpdate.FactorUpdate(instruments=universe, start=dates[0].strftime("%Y%m%d"),
+                                   end=dates[-1].strftime("%Y%m%d"), testFreq=testFreq, isRelReturn=False,
+                                   reportWorkers=0)
+    factorObject = fu._loadFactorObject(factorName)
+    streamDict = fu._replayFactor(factorObject, "stream")
+    vectorDict = fu._replayFactor(factorObject, "vector")
+    diffDict = {}
+    for freqStr in fu.resampleFreqStr:
+        diffDict[(freqStr, "factor")] = maxAbsDiff(vectorDict[freqStr].factorPanel.to_frame(),
+                                                   streamDict[freqStr].factorPanel.to_frame())
+        for name, diff in panelFactorTest.compareIndicators(vectorDict[freqStr], streamDict[freqStr]).items():
+            diffDict[(freqStr, name)] = diff
+    return diffDict
+
+
+def checkVectorWrite(universe, factorName, index, testFreq=None):
+    '''
+    批量检测模式写入的完整流程，需在offlineEnvironment中调用
+    分别以stream和vector模式写入新因子，经数据目录读回后比较全部数据
+    return: {(freqStr, 数据名): 最大绝对误差}
+    '''
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    kwargs = dict(instruments=universe, start=dates[0].strftime("%Y%m%d"), end=dates[-1].strftime("%Y%m%d"),
+                  testFreq=testFreq, isRelReturn=False, reportWorkers=0)
+    for evalMode in ["stream", "vector"]:
+        with factorDataRoot("factorData_" + evalMode):
+            fu = factorUpdate.FactorUpdate(**kwargs)
+            fu._writeOneNewFactor(factorName, evalMode=evalMode)
+    return compareFactorData(factorName, "factorData_stream", "factorData_vector", fu.resampleFreqStr)
+
+
+def checkBarStore(universe, factorName, index, testFreq=None):
+    '''
+    barStore与分钟数据回放的一致性，需在offlineEnvironment中调用
+    barStore先由前70%的日期建立，再追加到最后，其中的收益与完整回放中Returns计算的收益逐周期比较；
+    再以批量检测模式分别使用和不使用barStore写入新因子，经数据目录读回后比较全部数据
+    return: {(freqStr, 数据名): 最大绝对误差}
+    '''
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    start, end = dates[0].strftime("%Y%m%d"), dates[-1].strftime("%Y%m%d")
+    kwargs = dict(instruments=universe, start=start, end=end, testFreq=testFreq, isRelReturn=False, reportWorkers=0)
+    diffDict = {}
+    replayUpdate = factorUpdate.FactorUpdate(**kwargs)
+    replayUpdate._buildFeeds(replayUpdate.getPanelFeed(), fullHistory=True).run(_print=False)
+    storeUpdate = factorUpdate.FactorUpdate(useBarStore=True, **kwargs)
+    storeUpdate.end = dates[int(len(dates) * 0.7) - 1].strftime("%Y%m%d")
+    storeUpdate._updateBarStores()
+    storeUpdate.end = end
+    storeUpdate._updateBarStores()  # 追加剩余的日期
+    for freqStr in replayUpdate.resampleFreqStr:
+        returnFrame = replayUpdate._return_Dict[freqStr].to_frame()
+        diffDict[(freqStr, "returns")] = maxAbsDiff(returnFrame, storeUpdate._storedReturns(freqStr, returnFrame))
+    for useBarStore in [False, True]:
+        with factorDataRoot("factorData_vector_{}".format("store" if useBarStore else "replay")):
+            fu = factorUpdate.FactorUpdate(useBarStore=useBarStore, **kwargs)
+            fu._writeOneNewFactor(factorName, evalMode="vector")
+    diffDict.update(compareFactorData(factorName, "factorData_vector_replay", "factorData_vector_store",
+                                      fu.resampleFreqStr))
+    return diffDict
+
+
+def checkReportData(universe, factorName, index, testFreq=None):
+    '''
+    ReportData与其替代的DefaultFactorTest的一致性，需在offlineEnvironment中调用
+    以stream模式回放后，分别由检测对象、ReportData.fromTester、按日期切成两段再concat的快照，
+    以及写入后经ReportData.fromStorage读回的快照取写入数据（getDataDict）逐项比较，
+    图表的输入hash（testerHash）不一致时记为inf
+    return: {(freqStr, 来源, 数据名): 最大绝对误差}
+    '''
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    splitDate = dates[len(dates) // 2]
+    fu = factorUpdate.FactorUpdate(instruments=universe, start=dates[0].strftime("%Y%m%d"),
+                                   end=dates[-1].strftime("%Y%m%d"), testFreq=testFreq, isRelReturn=False,
+                                   reportWorkers=0)
+    testerDict = fu._replayFactor(fu._loadFactorObject(factorName), "stream")
+    diffDict = {}
+    with factorDataRoot("factorData_report"):
+        for freqStr, tester in testerDict.items():
+            reportData = ReportData.fromTester(tester)
+            h5Writer.H5PanelWriter(factorName, tester).write("new")
+            reportDataDict = {"fromTester": reportData,
+                              "concat": ReportData.concat([reportData.slice(end=splitDate - pd.Timedelta(days=1)),
+                                                           reportData.slice(start=splitDate)]),
+                              "fromStorage": ReportData.fromStorage(factorName, tester.frequency)}
+            testerData = h5Writer.H5PanelWriter(factorName, tester).getDataDict()
+            for source, data in reportDataDict.items():
+                dataDict = h5Writer.H5PanelWriter(factorName, data).getDataDict()
+                for key in sorted(set(testerData) | set(dataDict)):
+                    diffDict[(freqStr, source, key)] = maxAbsDiff(testerData[key], dataDict[key])\
+                        if key in testerData and key in dataDict else float("inf")
+                diffDict[(freqStr, source, "testerHash")] = 0.0 if testerHash(data) == testerHash(tester)\
+                    else float("inf")
+    return diffDict
+
+
+def checkMultiUniverse(universe, factorName, index, testFreq=None, subSize=20):
+    '''
+    多股票池共用一次回放与各股票池分别运行的一致性，需在offlineEnvironment中调用
+    登记由universe前subSize个代码组成的子股票池，MultiUniverseUpdate在两个股票池的代码并集上回放一次并分别写入，
+    再对每个股票池单独运行批量检测模式的FactorUpdate写入，经数据目录读回后比较全部数据
+    return: {(freqStr, 股票池 数据名): 最大绝对误差}
+    '''
+    subUniverse = universe + "_SUB"
+    SyntheticFeedFactory.panelDict[subUniverse] = {field: frame.iloc[:, :subSize] for field, frame
+                                                   in SyntheticFeedFactory.panelDict[universe].items()}
+    dates = pd.DatetimeIndex(index).normalize().unique()
+    kwargs = dict(start=dates[0].strftime("%Y%m%d"), end=dates[-1].strftime("%Y%m%d"),
+                  testFreq=testFreq, isRelReturn=False)
+    universes = [universe, subUniverse]
+    multiUpdate = multiUniverse.MultiUniverseUpdate(
+        factorDataPaths={name: os.path.join(BenchPathSelector.rootPath, "factorData_multi_" + name)
+                         for name in universes}, **kwargs)
+    multiUpdate.loadUnionData()
+    multiUpdate._writeOneFactor(factorName, universes, {name: None for name in universes})
+    diffDict = {}
+    for name in universes:
+        with factorDataRoot("factorData_single_" + name):
+            fu = factorUpdate.FactorUpdate(instruments=name, reportWorkers=0, **kwargs)
+            fu._writeOneNewFactor(factorName, evalMode="vector")
+        for (freqStr, key), diff in compareFactorData(factorName, "factorData_single_" + name,
+                                                      "factorData_multi_" + name, fu.resampleFreqStr).items():
+            diffDict[(freqStr, name + " " + key)] = diff
+    return diffDict
+
+
+# 一致性检查：{名称: 函数}，函数参数为(universe, factorName, index, testFreq)，返回{项目: 最大绝对误差}
+CHECKS = {"checkpointResume": checkCheckpointResume,
+          "streamVector": checkStreamVector,
+          "vectorWrite": checkVectorWrite,
+          "reportData": checkReportData,
+          "barStore": checkBarStore,
+          "multiUniverse": checkMultiUniverse}
+
+
+def runChecks(universe, factorName, index, testFreq=None, names=None, tolerance=1e-8):
+    '''
+    运行一致性检查，需在offlineEnvironment中调用
+    return: [(检查名, 项目, 最大绝对误差)]，只包含超过tolerance的项目
+    '''
+    failures = []
+    for name in (names or CHECKS):
+        for item, diff in CHECKS[name](universe, factorName, index, testFreq).items():
+            print("CHECK {} {} {}: {:.3g}".format(universe, name, item, diff))
+            if not diff <= tolerance:
+                failures.append((name, item, diff))
+    return failures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the factor update pipeline on synthetic panels")
+    parser.add_argument("--universe", nargs="*", default=["SZ50"], choices=sorted(UNIVERSES))
+    parser.add_argument("--factor", default="maPanelFactor", help="factor name in factorPool")
+    parser.add_argument("--days", type=int, default=20, help="business days of synthetic minute data")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default="factorBenchmark.jsonl")
+    parser.add_argument("--baseline", help="JSON lines file of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data folder")
+    parser.add_argument("--check", nargs="*", choices=sorted(CHECKS),
+                        help="run consistency checks instead of timing, all checks when no name is given")
+    args = parser.parse_args()
+
+    rootPath = tempfile.mkdtemp(prefix="factorBenchmark_")
+    allRecords = []
+    failureList = []
+    try:
+        with offlineEnvironment(rootPath):
+            for universe in args.universe:
+                minuteIndex = writeSyntheticData(universe, args.days)
+                if args.check is not None:
+                    failureList.extend(runChecks(universe, args.factor, minuteIndex, names=args.check))
+                    continue
+                benchmark = FactorUpdateBenchmark(universe, args.factor, minuteIndex, repeat=args.repeat)
+                allRecords.extend(benchmark.run())
+    finally:
+        if not args.keep:
+            shutil.rmtree(rootPath, ignore_errors=True)
+
+    if args.check is not None:
+        for name, item, diff in failureList:
+            print("FAILED {} {}: {:.3g}".format(name, item, diff))
+        # 批量检测与逐bar检测一致时记录验证结果，之后FactorUpdate才允许使用evalMode="vector"
+        if "streamVector" in (args.check or CHECKS) and not any(name == "streamVector" for name, _, _ in failureList):
+            panelFactorTest.markVerified()
+            print("The vector evaluation mode of panelFactorTest has been marked as verified")
+        sys.exit(1 if failureList else 0)
+
+    writeRecords(allRecords, args.output)
+    print("{} records written to {}".format(len(allRecords), args.output))
+    if args.baseline:
+        regressionList = compareBaseline(allRecords, loadRecords(args.baseline), threshold=args.threshold)
+        for key, baseSeconds, seconds, ratio in regressionList:
+            print("REGRESSION {}: {:.3f}s -> {:.3f}s ({:.2f}x)".format(" ".join(str(k) for k in key if k),
+                                                                       baseSeconds, seconds, ratio))
+        sys.exit(1 if regressionList else 0)
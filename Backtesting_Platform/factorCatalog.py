@@ -0,0 +1,280 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+factorCatalog.py
+描述：factorData下每个因子每个周期的数据目录（catalog.json），
+     记录各数据文件的起止时间、行数、列名、因子检测参数和因子源码hash，
+     每次写入时更新，续写计划和因子池列表只需读取目录，不再加载h5数据
+'''
+
+import os
+import json
+import hashlib
+import datetime
+import importlib.util
+
+import pandas as pd
+
+from cpa.utils import logger
+from cpa.config import pathSelector
+
+
+class FactorCatalog:
+    '''
+    单个因子单个周期的数据目录
+    文件位置：factorData/<factor>/<freq>/catalog.json
+    结构：
+        {"version": 1, "factor": 因子名, "frequency": 周期标签, "params": {"lag", "cut", "fee", "nGroup"},
+         "source": 因子源码hash, "backend": 存储后端名, "updated": 更新时间,
+         "resultKey": 结果集在resultCache中的key（可选，写入时清除，由FactorUpdate按写入后的数据重新记录）,
+         "files": {数据名("factor"或检测指标名): {"file", "start", "end", "rows", "columns"}}}
+    '''
+
+    logger = logger.getLogger("FactorCatalog")
+    VERSION = 1
+    FILE_NAME = "catalog.json"
+
+    def __init__(self, factorName, freqStr, folderPath=None, rootPath=None):
+        '''
+        param factorName: 因子名
+        param freqStr: 周期标签，如 "5min"
+        param folderPath: 因子周期文件夹，为空时由rootPath生成
+        param rootPath: factorData根文件夹，为空时由pathSelector生成，见factorFolderPath
+        '''
+        self.factorName = factorName
+        self.freqStr = freqStr
+        self.folderPath = folderPath or factorFolderPath(factorName, freqStr, rootPath=rootPath)
+        self.path = os.path.join(self.folderPath, self.FILE_NAME)
+        self.content = {"version": self.VERSION, "factor": factorName, "frequency": freqStr,
+                        "params": {}, "source": None, "backend": "table", "updated": None, "files": {}}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                content = json.load(f)
+            if content.get("version") == self.VERSION:
+                self.content = content
+
+    def exists(self):
+        '''目录文件是否存在'''
+        return os.path.exists(self.path)
+
+    def save(self):
+        '''写入目录文件，先写临时文件再替换'''
+        self.content["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        tmpPath = "{}.tmp{}".format(self.path, os.getpid())
+        with open(tmpPath, "w") as f:
+            json.dump(self.content, f, indent=1, default=str)
+        os.replace(tmpPath, self.path)
+
+    def setParams(self, params, source=None):
+        '''
+        记录因子检测参数和因子源码hash
+        param params: {"lag", "cut", "fee", "nGroup"}等
+        param source: 因子源码hash，为空时自动计算
+        '''
+        self.content["params"] = {key: value for key, value in params.items() if value is not None}
+        self.content["source"] = source or factorSourceHash(self.factorName)
+
+    def record(self, key, fileName, data):
+        '''
+        记录一个新写入的数据文件
+        param key: "factor"或检测指标名
+        param fileName: 文件名
+        param data: 写入的DataFrame或Series
+        '''
+        self.content["files"][key] = {"file": fileName,
+                                      "start": str(data.index[0]) if len(data) else None,
+                                      "end": str(data.index[-1]) if len(data) else None,
+                                      "rows": int(len(data)),
+                                      "columns": _columnNames(data)}
+
+    def recordAppend(self, key, fileName, appendedData, storeKey=None):
+        '''
+        记录对已有文件的追加
+        param appendedData: 实际追加的数据
+        param storeKey: 文件中的key，一个文件存放多个数据时需要
+        '''
+        entry = self.content["files"].get(key)
+        if entry is None or entry["file"] != fileName:  # 目录中没有该文件时从文件元数据补全
+            entry = readFileEntry(os.path.join(self.folderPath, fileName), storeKey=storeKey)
+            self.content["files"][key] = entry
+            return
+        if len(appendedData):
+            entry["end"] = str(appendedData.index[-1])
+            entry["rows"] += int(len(appendedData))
+            if isinstance(appendedData, pd.DataFrame):  # 追加的数据已按合并后的列对齐，新加入的代码记入目录
+                entry["columns"] = _columnNames(appendedData)
+            if entry["start"] is None:
+                entry["start"] = str(appendedData.index[0])
+
+    def getFiles(self):
+        '''{数据名: 文件信息}'''
+        return self.content["files"]
+
+    def getDateRange(self):
+        '''所有数据文件的最早开始时间和最晚结束时间'''
+        starts = [pd.Timestamp(entry["start"]) for entry in self.getFiles().values() if entry["start"]]
+        ends = [pd.Timestamp(entry["end"]) for entry in self.getFiles().values() if entry["end"]]
+        if not ends:
+            return None
+        return min(starts), max(ends)
+
+    def scanFolder(self):
+        '''
+        由文件夹下已有的数据文件重建目录并识别存储后端，只读取h5的元数据及首尾两行
+        用于catalog出现之前写入的旧数据，或目录文件缺失的数据；支持factorStorage的全部后端
+        '''
+        if not os.path.exists(self.folderPath):
+            return
+        latestDict = {}
+        consolidatedName = self.factorName + "_" + self.freqStr + ".h5"
+        for name in sorted(os.listdir(self.folderPath)):
+            if not os.path.isfile(os.path.join(self.folderPath, name)):
+                continue
+            if name == consolidatedName:  # consolidated后端：一个文件中每个数据一个key
+                with pd.HDFStore(os.path.join(self.folderPath, name), mode="r") as store:
+                    for storeKey in store.keys():
+                        latestDict[storeKey.lstrip("/")] = (name, storeKey.lstrip("/"))
+                continue
+            key = parseDataKey(name, self.factorName, self.freqStr)
+            if key is not None:
+                latestDict[key] = (name, None)  # 按文件名排序，保留每种数据最新的文件
+        for key, (name, storeKey) in latestDict.items():
+            self.content["files"][key] = readFileEntry(os.path.join(self.folderPath, name), storeKey=storeKey)
+        fileNames = sorted({name for name, _ in latestDict.values()})
+        if fileNames:
+            self.content["backend"] = fileBackend(os.path.join(self.folderPath, fileNames[0]),
+                                                  consolidated=fileNames[0] == consolidatedName)
+        self.logger.info("The catalog of {} {} has been rebuilt from {} files"
+                         .format(self.factorName, self.freqStr, len(latestDict)))
+
+
+def parseDataKey(fileName, factorName, freqStr):
+    '''
+    由文件名解析数据名，如 maFactor_IC_5min_20200101_1200.h5 -> IC，maFactor_IC_5min_20200101_1200.parquet -> IC
+    consolidated后端的 maFactor_5min.h5 包含多个数据，不由文件名解析，见FactorCatalog.scanFolder
+    return: 数据名，不是该因子该周期的数据文件时返回None
+    '''
+    prefix = factorName + "_"
+    suffix = "_" + freqStr + "_"
+    if not (fileName.startswith(prefix) and fileName.endswith((".h5", ".parquet")) and suffix in fileName):
+        return None
+    return fileName[len(prefix):fileName.rindex(suffix)]
+
+
+def readFileEntry(filePath, storeKey=None):
+    '''
+    从h5文件的元数据读取目录信息，不加载整个文件
+    param storeKey: 文件中的key，为空时使用第一个key
+    '''
+    if filePath.endswith(".parquet"):  # parquet文件没有可按行读取的元数据，直接读取
+        head = tail = pd.read_parquet(filePath)
+        nRows = len(head)
+    else:
+        with pd.HDFStore(filePath, mode="r") as store:
+            key = storeKey if storeKey is not None and "/" + storeKey in store.keys() else store.keys()[0]
+            storer = store.get_storer(key)
+            if storer.is_table:
+                nRows = storer.nrows or 0
+                head = store.select(key, start=0, stop=1)
+                tail = store.select(key, start=nRows - 1) if nRows else head
+            else:  # fixed格式不能按行读取
+                head = tail = store.select(key)
+                nRows = len(head)
+    return {"file": os.path.basename(filePath),
+            "start": str(head.index[0]) if len(head) else None,
+            "end": str(tail.index[-1]) if len(tail) else None,
+            "rows": int(nRows),
+            "columns": _columnNames(head)}
+
+
+def fileBackend(filePath, consolidated=False):
+    '''
+    由数据文件识别存储后端名
+    param consolidated: 文件为一个因子一个周期的合并文件
+    '''
+    if filePath.endswith(".parquet"):
+        return "parquet"
+    if consolidated:
+        return "consolidated"
+    with pd.HDFStore(filePath, mode="r") as store:
+        return "table" if store.get_storer(store.keys()[0]).is_table else "fixed"
+
+
+def factorFolderPath(factorName, freqStr, rootPath=None, fileName=None):
+    '''
+    因子周期文件夹或其中文件的路径，文件夹不存在时创建
+    param rootPath: factorData根文件夹，为空时由pathSelector生成；多个股票池分别写入各自的factorData时传入
+    '''
+    if rootPath is None:
+        return pathSelector.PathSelector.getFactorFilePath(factorName=factorName, factorFrequency=freqStr,
+                                                           fileName=fileName)
+    folderPath = os.path.join(rootPath, factorName, freqStr)
+    os.makedirs(folderPath, exist_ok=True)
+    return os.path.join(folderPath, fileName) if fileName else folderPath
+
+
+def factorSourceHash(factorName):
+    '''因子模块源码的sha1，用于判断因子定义是否发生变化'''
+    spec = importlib.util.find_spec("cpa.factorPool.factors.{}".format(factorName))
+    if spec is None or not spec.origin or not os.path.exists(spec.origin):
+        return None
+    with open(spec.origin, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def listFrequencies(factorName):
+    '''因子文件夹下的周期文件夹名'''
+    factorPath = pathSelector.PathSelector.getFactorFilePath(factorName=factorName)
+    if not os.path.isdir(factorPath):
+        return []
+    return sorted(name for name in os.listdir(factorPath) if os.path.isdir(os.path.join(factorPath, name)))
+
+
+def getCatalog(factorName, freqStr, rebuild=True):
+    '''
+    读取目录，目录不存在且rebuild为True时由已有文件重建并保存
+    '''
+    catalog = FactorCatalog(factorName, freqStr)
+    if not catalog.exists() and rebuild:
+        catalog.scanFolder()
+        if catalog.getFiles():
+            catalog.save()
+    return catalog
+
+
+def factorEndDate(factorName):
+    '''
+    因子所有周期数据中最晚的结束时间
+    return: datetime，没有任何数据时返回None
+    '''
+    endList = []
+    for freqStr in listFrequencies(factorName):
+        dateRange = getCatalog(factorName, freqStr).getDateRange()
+        if dateRange:
+            endList.append(dateRange[1])
+    return max(endList).to_pydatetime() if endList else None
+
+
+def listPool(rebuild=False):
+    '''
+    列出factorData下所有因子各周期的目录信息，只读取catalog.json
+    param rebuild: 为True时对没有目录的旧数据从h5元数据重建目录
+    return: {factor: {freqStr: 目录内容}}
+    '''
+    rootPath = pathSelector.PathSelector.getFactorFilePath()
+    poolDict = {}
+    for factorName in sorted(os.listdir(rootPath)):
+        if not os.path.isdir(os.path.join(rootPath, factorName)):
+            continue
+        poolDict[factorName] = {freqStr: getCatalog(factorName, freqStr, rebuild=rebuild).content
+                                for freqStr in listFrequencies(factorName)}
+    return poolDict
+
+
+def _columnNames(data):
+    '''DataFrame的列名或Series的名称'''
+    if isinstance(data, pd.DataFrame):
+        return [str(column) for column in data.columns]
+    return [str(data.name)]
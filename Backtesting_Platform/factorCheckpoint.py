@@ -0,0 +1,93 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+factorCheckpoint.py
+描述：记录因子检测流水线上次计算结束时的状态，续写时不再按nBizDaysAhead从已存数据的结束日期往前估计回放的起点
+说明：收益、因子回看窗口、分组持仓及交易成本均为cpa框架对象的内部状态，只能由分钟panelFeed回放得到；
+     检查点只保存恢复这些状态所需的信息，即上次计算的最后一个bar的时间、因子检测参数和回看窗口的工作日数。
+     续写时从最后一个bar所在日期之前windowDays个工作日开始回放，最后一个bar之后的分钟（包括同一天中的）全部重新计算，
+     窗口部分的结果与已存数据重复，写入时被跳过；
+     检查点的最后时间与数据目录中因子计算值的结束时间不完全一致（如检查点之后数据又被其他方式写入）时不使用检查点
+'''
+
+import os
+import json
+
+import pandas as pd
+
+from cpa.utils import logger
+from cpa.config import pathSelector
+
+
+class FactorCheckpoint:
+    '''
+    单个因子单个周期的检查点文件
+    文件位置：factorData/<factor>/<freq>/<factor>_checkpoint_<freq>.json
+    内容：{"version", "lastTime", "params", "windowDays"}
+    '''
+
+    logger = logger.getLogger("FactorCheckpoint")
+    VERSION = 3
+
+    def __init__(self, factorName, freqStr):
+        '''
+        param factorName: 因子名
+        param freqStr: 周期标签，如 "5min"
+        '''
+        self.factorName = factorName
+        self.freqStr = freqStr
+        self.fileName = "{}_checkpoint_{}.json".format(factorName, freqStr)
+
+    def getPath(self):
+        '''检查点文件路径'''
+        return pathSelector.PathSelector.getFactorFilePath(factorName=self.factorName,
+                                                           factorFrequency=self.freqStr,
+                                                           fileName=self.fileName)
+
+    def save(self, lastTime, params, windowDays):
+        '''
+        保存检查点，失败时只记录日志，不影响因子数据的写入
+        param lastTime: 本次计算数据的最后时间，即最后一个bar的时间
+        param params: 因子检测参数，恢复时参数不一致则不使用检查点
+        param windowDays: 恢复状态需回放的工作日数，需不少于因子及检测指标的回看长度
+        return: 是否保存成功
+        '''
+        path = self.getPath()
+        tmpPath = "{}.tmp{}".format(path, os.getpid())
+        content = {"version": self.VERSION,
+                   "lastTime": str(pd.Timestamp(lastTime)),
+                   "params": params,
+                   "windowDays": int(windowDays)}
+        try:
+            with open(tmpPath, "w") as f:
+                json.dump(content, f, indent=1)
+            os.replace(tmpPath, path)
+        except Exception as e:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            self.logger.warning("The checkpoint of {} {} could not be saved: {}".format(self.factorName, self.freqStr, e))
+            return False
+        self.logger.info("The checkpoint {} has been saved, last bar {}".format(self.fileName, content["lastTime"]))
+        return True
+
+    def load(self, params):
+        '''
+        读取检查点
+        param params: 当前的因子检测参数
+        return: (lastTime, windowDays)，检查点不存在、版本或参数不一致时返回None
+        '''
+        path = self.getPath()
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                content = json.load(f)
+        except Exception as e:
+            self.logger.warning("The checkpoint {} could not be loaded: {}".format(self.fileName, e))
+            return None
+        if not isinstance(content, dict) or content.get("version") != self.VERSION or content["params"] != params:
+            self.logger.info("The checkpoint {} does not match the current parameters".format(self.fileName))
+            return None
+        return pd.Timestamp(content["lastTime"]), content["windowDays"]
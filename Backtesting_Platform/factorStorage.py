@@ -0,0 +1,356 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+factorStorage.py
+描述：因子计算及检测数据的存储后端
+     table:         原有格式，每个数据一个h5文件，table格式，所有列均为data_columns
+     fixed:         每个数据一个h5文件，fixed格式，blosc压缩，读写最快，续写时重写文件
+     parquet:       每个数据一个parquet文件，需要pyarrow
+     consolidated:  每个因子每个周期一个h5文件，各数据为文件中的不同key，table格式，
+                    只对时间索引建立查询，blosc压缩，支持原位续写
+     各后端的列名统一以字符串存储（table格式的data_columns要求字符串列名），读取时均为字符串列名；
+     同时提供按数据目录读取因子数据的接口，以及将已有factorData转换为其他后端的工具
+'''
+
+import os
+import shutil
+import datetime
+import argparse
+
+import pandas as pd
+
+from cpa.utils import logger
+from cpa.config import pathSelector
+from cpa.io import factorCatalog
+
+moduleLogger = logger.getLogger("factorStorage")
+
+
+class TableBackend:
+    '''原有的h5 table格式，所有列均建立data_columns'''
+
+    name = "table"
+    extension = ".h5"
+    consolidated = False
+
+    def fileName(self, factorName, key, freqStr, currentDT):
+        '''数据文件名，如 maFactor_IC_5min_20200101_1200.h5'''
+        return factorName + "_" + key + "_" + freqStr + currentDT.strftime("_%Y%m%d_%H%M") + self.extension
+
+    def storeKey(self, factorName, key):
+        '''文件中的key，因子计算值以因子名为key，检测数据以指标名为key'''
+        return factorName if key == "factor" else key
+
+    def findLatest(self, folderPath, factorName, key, freqStr):
+        '''
+        在因子周期文件夹下查找某一数据的最新文件
+        return: 文件路径，不存在时返回None
+        '''
+        prefix = factorName + "_" + key + "_" + freqStr + "_"
+        if not os.path.exists(folderPath):
+            return None
+        fileList = sorted(name for name in os.listdir(folderPath)
+                          if name.startswith(prefix) and name.endswith(self.extension)
+                          and os.path.isfile(os.path.join(folderPath, name)))
+        return os.path.join(folderPath, fileList[-1]) if fileList else None
+
+    def clear(self, folderPath, factorName, freqStr):
+        '''整体重写一个因子周期的数据之前调用；每次写入均为新文件，无需处理'''
+        pass
+
+    def write(self, filePath, key, data):
+        '''以table格式写新h5文件，并在元数据中记录最后一行的时间'''
+        data = stringColumns(data)
+        data.to_hdf(path_or_buf=filePath,
+                    key=key,
+                    format="table",
+                    data_columns=True,
+                    mode="w")
+        if len(data):
+            with pd.HDFStore(filePath, mode="a") as store:
+                store.get_storer(key).attrs.lastIndex = data.index[-1]
+
+    def append(self, filePath, key, data):
+        '''
+        将晚于已存最后时间的新数据追加到h5文件的table中，只读取元数据，开销与新数据量成正比
+        新数据中出现已存table没有的列（如新加入的代码）时，读取旧数据后按合并的列重写文件
+        param filePath: 已存在的h5文件路径
+        param key: 文件中的key，为空时使用文件中的第一个key
+        param data: 新生成的DataFrame或Series
+        return: 实际追加的数据
+        '''
+        data = stringColumns(data)
+        oldData = None
+        with pd.HDFStore(filePath, mode="a") as store:
+            if key is None or "/" + key not in store.keys():
+                key = store.keys()[0]
+            storer = store.get_storer(key)
+            lastIndex = getattr(storer.attrs, "lastIndex", None)
+            if lastIndex is None and storer.nrows:  # 旧文件没有记录最后时间时只读取最后一行
+                lastIndex = store.select(key, start=storer.nrows - 1).index[-1]
+            newData = _newRows(data, lastIndex)
+            if isinstance(newData, pd.DataFrame) and len(newData):
+                storedColumns = list(store.select(key, start=0, stop=0).columns)
+                newData = newData.reindex(columns=widenColumns(storedColumns, newData.columns))
+                if len(newData.columns) > len(storedColumns):  # table不能增加列，读取旧数据后按合并的列重写
+                    oldData = store.select(key).reindex(columns=newData.columns)
+            if oldData is None and len(newData):
+                store.append(key, newData, format="table", data_columns=self._dataColumns())
+                store.get_storer(key).attrs.lastIndex = newData.index[-1]
+        if oldData is not None:
+            self.write(filePath, key.lstrip("/"), pd.concat([oldData, newData]))
+        return newData
+
+    def read(self, filePath, key):
+        '''读取数据'''
+        return pd.read_hdf(filePath, key=key)
+
+    def _dataColumns(self):
+        return True
+
+
+class FixedBackend(TableBackend):
+    '''h5 fixed格式，blosc压缩，不支持原位追加，续写时读取旧数据后重写'''
+
+    name = "fixed"
+    complib = "blosc:lz4"
+    complevel = 5
+
+    def write(self, filePath, key, data):
+        data = stringColumns(data)
+        data.to_hdf(path_or_buf=filePath,
+                    key=key,
+                    format="fixed",
+                    complib=self.complib,
+                    complevel=self.complevel,
+                    mode="w")
+
+    def append(self, filePath, key, data):
+        '''
+        读取旧数据，将晚于已存最后时间的新数据接在后面重写文件，parquet后端同样使用
+        新旧数据的列名均先转换为字符串再对齐，否则整数列名（如分组号）与已存的字符串列名对齐后全为NaN；
+        只在新数据中出现的列在旧数据部分为NaN
+        '''
+        oldData = stringColumns(self.read(filePath, key))
+        newData = _newRows(stringColumns(data), oldData.index[-1] if len(oldData) else None)
+        if isinstance(newData, pd.DataFrame):
+            columns = widenColumns(oldData.columns, newData.columns)
+            oldData, newData = oldData.reindex(columns=columns), newData.reindex(columns=columns)
+        if len(newData):
+            self.write(filePath, key, pd.concat([oldData, newData]))
+        return newData
+
+    def read(self, filePath, key):
+        with pd.HDFStore(filePath, mode="r") as store:
+            if key is None or "/" + key not in store.keys():
+                key = store.keys()[0]
+            return store.select(key)
+
+
+class ParquetBackend(FixedBackend):
+    '''parquet格式，列名以字符串存储，Series以单列DataFrame存储'''
+
+    name = "parquet"
+    extension = ".parquet"
+
+    SERIES_COLUMN = "__series__"
+
+    def write(self, filePath, key, data):
+        frame = data.to_frame(name=self.SERIES_COLUMN) if isinstance(data, pd.Series) else stringColumns(data)
+        frame.to_parquet(filePath, compression="zstd")
+
+    def read(self, filePath, key):
+        frame = pd.read_parquet(filePath)
+        if list(frame.columns) == [self.SERIES_COLUMN]:
+            return frame[self.SERIES_COLUMN].rename(key)
+        return frame
+
+
+class ConsolidatedBackend(TableBackend):
+    '''每个因子每个周期一个h5文件，各数据为不同的key，只对时间索引建立查询，blosc压缩'''
+
+    name = "consolidated"
+    consolidated = True
+    complib = "blosc:lz4"
+    complevel = 5
+
+    def fileName(self, factorName, key, freqStr, currentDT):
+        return factorName + "_" + freqStr + self.extension
+
+    def storeKey(self, factorName, key):
+        return key
+
+    def findLatest(self, folderPath, factorName, key, freqStr):
+        filePath = os.path.join(folderPath, factorName + "_" + freqStr + self.extension)
+        if not os.path.exists(filePath):
+            return None
+        with pd.HDFStore(filePath, mode="r") as store:
+            return filePath if "/" + key in store.keys() else None
+
+    def clear(self, folderPath, factorName, freqStr):
+        '''
+        删除已有的合并文件，之后逐个key写入，避免上次写入的key（如已去掉的检测指标）残留在新数据中
+        '''
+        filePath = os.path.join(folderPath, factorName + "_" + freqStr + self.extension)
+        if os.path.exists(filePath):
+            os.remove(filePath)
+
+    def write(self, filePath, key, data):
+        data = stringColumns(data)
+        with pd.HDFStore(filePath, mode="a", complib=self.complib, complevel=self.complevel) as store:
+            if "/" + key in store.keys():
+                store.remove(key)
+            store.put(key, data, format="table", data_columns=None)
+            if len(data):
+                store.get_storer(key).attrs.lastIndex = data.index[-1]
+
+    def _dataColumns(self):
+        return None
+
+
+BACKENDS = {backend.name: backend for backend in [TableBackend, FixedBackend, ParquetBackend, ConsolidatedBackend]}
+
+
+def getBackend(name):
+    '''
+    按名称获取存储后端
+    param name: "table", "fixed", "parquet" or "consolidated"
+    '''
+    if name not in BACKENDS:
+        raise ValueError("Unknown storage backend {}, expected one of {}".format(name, sorted(BACKENDS)))
+    return BACKENDS[name]()
+
+
+def readFactorData(factorName, freqStr, keys=None):
+    '''
+    按数据目录读取一个因子一个周期的数据，自动识别存储后端
+    param factorName: 因子名
+    param freqStr: 周期标签，如 "5min"
+    param keys: 读取的数据名列表，如 ["factor", "IC", "groupRet"]，为空时读取全部
+    return: {数据名: DataFrame或Series}
+    '''
+    return readCatalogData(factorCatalog.getCatalog(factorName, freqStr), keys=keys)
+
+
+def readCatalogData(catalog, keys=None):
+    '''
+    读取一个FactorCatalog记录的数据，存储后端由目录识别
+    param catalog: FactorCatalog对象，可指向pathSelector之外的factorData文件夹
+    param keys: 读取的数据名列表，为空时读取全部
+    return: {数据名: DataFrame或Series}
+    '''
+    backend = getBackend(catalog.content.get("backend", "table"))
+    dataDict = {}
+    for key, entry in catalog.getFiles().items():
+        if keys is not None and key not in keys:
+            continue
+        filePath = os.path.join(catalog.folderPath, entry["file"])
+        dataDict[key] = backend.read(filePath, None if backend.name == "table"
+                                     else backend.storeKey(catalog.factorName, key))
+    return dataDict
+
+
+def convertFactorData(factorName, backend, freqList=None, keepOld=True):
+    '''
+    将一个因子已有的数据转换为另一种存储后端
+    param factorName: 因子名
+    param backend: 目标后端名
+    param freqList: 转换的周期标签列表，为空时转换全部周期
+    param keepOld: True时将旧文件移入以时间命名的文件夹，False时删除旧文件
+    '''
+    target = getBackend(backend)
+    currentDT = datetime.datetime.now()
+    for freqStr in (freqList or factorCatalog.listFrequencies(factorName)):
+        catalog = factorCatalog.getCatalog(factorName, freqStr)
+        source = getBackend(catalog.content.get("backend", "table"))
+        if source.name == target.name or not catalog.getFiles():
+            continue
+        dataDict = readFactorData(factorName, freqStr)
+        oldFileList = sorted({entry["file"] for entry in catalog.getFiles().values()})
+
+        # 先将旧文件移走，避免与新文件重名
+        archivePath = os.path.join(catalog.folderPath, currentDT.strftime("%Y%m%d_%H%M"))
+        os.makedirs(archivePath, exist_ok=True)
+        for fileName in oldFileList:
+            shutil.move(os.path.join(catalog.folderPath, fileName), archivePath)
+
+        for key, data in dataDict.items():
+            fileName = target.fileName(factorName, key, freqStr, currentDT)
+            target.write(os.path.join(catalog.folderPath, fileName), target.storeKey(factorName, key), data)
+            catalog.record(key, fileName, data)
+        catalog.content["backend"] = target.name
+        catalog.save()
+        if not keepOld:
+            shutil.rmtree(archivePath)
+        moduleLogger.info("{} {}: converted {} files from {} to {}"
+                          .format(factorName, freqStr, len(oldFileList), source.name, target.name))
+
+
+def convertFactorPool(backend, factorList=None, keepOld=True):
+    '''
+    转换factorData下所有（或指定）因子的存储后端
+    param backend: 目标后端名
+    param factorList: 因子名列表，为空时转换全部因子
+    param keepOld: 是否保留旧文件
+    '''
+    rootPath = pathSelector.PathSelector.getFactorFilePath()
+    factorList = factorList or sorted(name for name in os.listdir(rootPath)
+                                      if os.path.isdir(os.path.join(rootPath, name)))
+    for factorName in factorList:
+        convertFactorData(factorName, backend, keepOld=keepOld)
+
+
+def stringColumns(data):
+    '''DataFrame的列名转换为字符串，Series不变'''
+    if isinstance(data, pd.DataFrame) and not all(isinstance(column, str) for column in data.columns):
+        return data.set_axis([str(column) for column in data.columns], axis=1)
+    return data
+
+
+def mergeNewRows(oldData, data):
+    '''
+    将晚于旧数据最后时间的新数据接在旧数据之后，列名统一为字符串，只在新数据中出现的列在旧数据部分为NaN
+    param oldData: 已存的数据，为空时直接返回新数据
+    param data: 新生成的DataFrame或Series
+    return: (合并后的数据, 实际追加的数据)
+    '''
+    data = stringColumns(data)
+    if oldData is None or not len(oldData):
+        return data, data
+    oldData = stringColumns(oldData)
+    newData = _newRows(data, oldData.index[-1])
+    if isinstance(newData, pd.DataFrame):
+        columns = widenColumns(oldData.columns, newData.columns)
+        oldData, newData = oldData.reindex(columns=columns), newData.reindex(columns=columns)
+    return pd.concat([oldData, newData]), newData
+
+
+def widenColumns(oldColumns, newColumns):
+    '''
+    已存数据的列加上只在新数据中出现的列，用于续写时出现新代码的情况
+    已存的列有序（如代码列）时合并后仍排序，否则新列接在后面
+    '''
+    oldColumns = list(oldColumns)
+    addedColumns = [column for column in newColumns if column not in set(oldColumns)]
+    if not addedColumns:
+        return oldColumns
+    columns = oldColumns + addedColumns
+    return sorted(columns) if oldColumns == sorted(oldColumns) else columns
+
+
+def _newRows(data, lastIndex):
+    '''晚于lastIndex且时间不重复的数据'''
+    newData = data if lastIndex is None else data.loc[data.index > lastIndex]
+    return newData.loc[~newData.index.duplicated(keep="first")]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert factorData folders to another storage backend")
+    parser.add_argument("backend", choices=sorted(BACKENDS))
+    parser.add_argument("--factor", nargs="*", help="factor names, all factors when omitted")
+    parser.add_argument("--remove-old", action="store_true", help="delete the old files instead of archiving them")
+    args = parser.parse_args()
+    convertFactorPool(args.backend, factorList=args.factor, keepOld=not args.remove_old)
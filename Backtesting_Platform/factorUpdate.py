@@ -8,20 +8,30 @@ factorUpdate.py
 '''
 
 import os
+import gc
 import shutil
+import logging
 import importlib
+import traceback
+import contextlib
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 import numpy as np
 
-from cpa.io import h5Writer, h5Reader, csvReader
-from cpa.io.reportWriter import ReportWriter
+from cpa.io import h5Writer, panelCache, factorCatalog, factorStorage, barStore
+from cpa.io.reportWriter import ReportPool, ReportData
 from cpa.io.csvReader import CSVPanelReader
 from cpa.utils import logger, bar, series
 from cpa.config import pathSelector, const
 from cpa.factorModel import factorBase
+from cpa.factorPool import factorCheckpoint, resultCache
+from cpa.utils import stageRecorder
 from cpa.indicators.panelIndicators import returns
 from cpa.factorProcessor.factorTest import DefaultFactorTest
+from cpa.factorProcessor import panelFactorTest
 from cpa.feed.feedFactory import DataFeedFactory
 from cpa.resample.resampled import ResampledPanelFeed
 from cpa.feed.baseFeed import AdvancedFeed
@@ -32,7 +42,9 @@ class FactorUpdate:
     logger = logger.getLogger("factorUpdate")
 
     def __init__(self, instruments, market=bar.Market.STOCK, start=None, end=None,
-                 testFreq=None, isRelReturn=False, fee=0.003, lag=1):
+                 testFreq=None, isRelReturn=False, fee=0.003, lag=1, usePanelCache=False,
+                 backend="table", reportWorkers=0, metricsPath=None, profileSlowest=False,
+                 cacheMaxBytes=20 * 1024 ** 3, useBarStore=False, checkpointDays=30):
         '''
         初始化因子检测参数
         param instruments: 代码 "SZ50", "HS300", or "ZZ500"
@@ -43,7 +55,27 @@ class FactorUpdate:
         param testFreq: 测试的resample频率
         param isRelReturn: True为计算相对收益， False为计算绝对收益
         param fee: 开仓手续费，用于计算交易成本
+        param usePanelCache: True时基准指数数据通过panelCache的内存映射缓存读取，源文件变化时自动重建；
+                             分钟数据仍由DataFeedFactory.getHistFeed读取
+        param backend: 因子数据的存储后端，"table", "fixed", "parquet" or "consolidated"，见factorStorage
+        param reportWorkers: 后台生成图表的进程数，为0（默认）时在当前进程中同步生成，图表出错时直接抛出异常；
+                             大于0时图表在后台进程池中生成，出错的图表由waitReports()汇总后抛出
+        param metricsPath: 不为空时记录各阶段的耗时、CPU时间、峰值内存及计数，运行结束后导出到该文件，
+                           扩展名为.prom时为Prometheus文本格式，否则为JSON lines
+        param profileSlowest: True时对每个因子运行cProfile，运行结束后保存耗时最长的因子的结果，
+                              文件与metricsPath同名，扩展名为.prof
+        param cacheMaxBytes: 结果缓存的总大小上限，writeChangedFactors结束后按最近使用时间淘汰超出的结果集
+        param useBarStore: True时批量检测模式的收益panel从barStore读取，各因子共用，新的分钟数据只追加计算一次，
+                           因子回放时不再创建Returns或RelativeReturns；逐bar检测模式不使用barStore，见_updateBarStores
+        param checkpointDays: 由检查点续写时提前回放的工作日数，需不少于因子及检测指标的回看长度，见factorCheckpoint
         '''
+        # 保存初始化参数，并行模式下子进程据此重建FactorUpdate对象
+        self._initKwargs = dict(instruments=instruments, market=market, start=start, end=end,
+                                testFreq=testFreq, isRelReturn=isRelReturn, fee=fee, lag=lag,
+                                usePanelCache=usePanelCache, backend=backend, reportWorkers=reportWorkers,
+                                metricsPath=metricsPath, profileSlowest=profileSlowest,
+                                cacheMaxBytes=cacheMaxBytes, useBarStore=useBarStore,
+                                checkpointDays=checkpointDays)
         self.instruments = instruments
         self.market = market
         self.start = start
@@ -54,6 +86,19 @@ class FactorUpdate:
         self.fee = fee
         self.isRelReturn = isRelReturn
         self.lag = lag
+        self.usePanelCache = usePanelCache
+        self.backend = backend
+        self.useBarStore = useBarStore
+        self.checkpointDays = checkpointDays
+        self.reportPool = ReportPool(workers=reportWorkers)
+        self.metricsPath = metricsPath
+        self.profileSlowest = profileSlowest
+        self.recorder = stageRecorder.StageRecorder(enabled=metricsPath is not None or profileSlowest,
+                                                    profile=profileSlowest,
+                                                    instruments=instruments,
+                                                    returns="relative" if isRelReturn else "absolute")
+        self.stageTags = {}  # 当前因子的阶段标签：factor, mode, eval
+        self.resultCache = resultCache.ResultCache(maxBytes=cacheMaxBytes)
         #设置要回测的时间频率，默认测试 5，30, 60, 120分钟的
         self.resampleFreqNum = [bar.Frequency.MINUTE5,
                                 bar.Frequency.MINUTE30,
@@ -61,13 +106,16 @@ class FactorUpdate:
                                 bar.Frequency.HOUR2] if not testFreq else testFreq
         self.resampleFreqStr = [const.DataFrequency.freq2lable(freq) for freq in self.resampleFreqNum]
 
+        # 分钟panelFeed及相对收益时的AdvancedFeed
+        self.panelFeed = None
+        self.advFeed = None
         # 存储resample相关对象的字典
         self.reasampleFeedDict = {}
+        self._barStoreUpdated = set()  # 已更新过barStore的(start, end)
         self._return_Dict = {}
         self.rawFactorDict = {}
         self.factorTesterDict = {}
         self.dictOldResultDict = {}
-        self.dictFilePathDict = {}
 
     def getPanelFeed(self):
         '''获取一个新的panelFeed'''
@@ -86,21 +134,74 @@ class FactorUpdate:
         else:
             self.logger.info("The input instruments do not have benchmark. Please re-input.")
             return
-        filePath = pathSelector.PathSelector.getDataFilePath(market=const.DataMarket.FUTURES, types=const.DataType.OHLCV,
-                                                frequency=const.DataFrequency.MINUTE, fileName=fileName)
-        indexReader = CSVPanelReader(filePath=filePath,
-                                     fields=['open', 'high', 'low', 'close', 'volume'],
-                                     frequency=bar.Frequency.MINUTE,
-                                     isInstrumentCol=False,
-                                     start=self.start)
+        indexReader = self._getBenchReader(fileName)
         indexReader.loads()
         benchPanel = series.SequenceDataPanel.from_reader(indexReader)
         return benchPanel
 
+    def getBenchClose(self, start=None, instruments=None):
+        '''
+        获取基准指数的分钟收盘价，批量检测模式计算相对收益时使用
+        param start: 开始时间，为空时使用self.start
+        param instruments: 股票池，为空时使用self.instruments
+        return: index为时间的Series
+        '''
+        benchNameDict = {"SZ50": "IH.CCFX.csv", "HS300": "IF.CCFX.csv", "ZZ500": "IC.CCFX.csv"}
+        instruments = self.instruments if instruments is None else instruments
+        if instruments not in benchNameDict:
+            raise ValueError("The input instruments {} do not have benchmark".format(instruments))
+        indexReader = self._getBenchReader(benchNameDict[instruments], start=start)
+        indexReader.loads()
+        return indexReader.to_frame()["close"]
+
+    def _getBenchReader(self, fileName, start=None):
+        '''
+        基准指数数据的reader，usePanelCache时从内存映射缓存读取
+        param fileName: 基准指数csv文件名，如 "IH.CCFX.csv"
+        param start: 开始时间，为空时使用self.start
+        '''
+        start = self.start if start is None else start
+        filePath = pathSelector.PathSelector.getDataFilePath(market=const.DataMarket.FUTURES, types=const.DataType.OHLCV,
+                                                frequency=const.DataFrequency.MINUTE, fileName=fileName)
+        fields = ['open', 'high', 'low', 'close', 'volume']
+        if self.usePanelCache:
+            benchName = fileName[:-len(".csv")]
+            benchCache = panelCache.PanelCache(name=benchName, sourcePaths=filePath, fields=fields)
+            if not benchCache.isValid():
+                fullReader = CSVPanelReader(filePath=filePath,
+                                            fields=fields,
+                                            frequency=bar.Frequency.MINUTE,
+                                            isInstrumentCol=False)
+                fullReader.loads()
+                benchCache.build(panelCache.frameToFieldDict(fullReader.to_frame(), fields, instrument=benchName))
+            indexReader = panelCache.CachedPanelReader(benchCache,
+                                                       frequency=bar.Frequency.MINUTE,
+                                                       start=start,
+                                                       isInstrumentCol=False)
+        else:
+            indexReader = CSVPanelReader(filePath=filePath,
+                                         fields=fields,
+                                         frequency=bar.Frequency.MINUTE,
+                                         isInstrumentCol=False,
+                                         start=start)
+        return indexReader
+
+    def listFactorPool(self, rebuild=False):
+        '''
+        列出factorData下所有因子各周期的数据目录，只读取catalog.json
+        param rebuild: 为True时对没有目录的旧数据从h5元数据重建目录
+        return: {factor: {freqStr: 目录内容}}
+        '''
+        return factorCatalog.listPool(rebuild=rebuild)
+
+    def definedFactorList(self):
+        '''factors下定义的所有因子名'''
+        return sorted({factor.split('.')[0] for factor in os.listdir(self.factorDefPath)
+                       if factor not in ['__init__.py', '__pycache__']})
+
     def newFactorList(self):
         '''获取新增的因子列表'''
-        allFactors = [factor.split('.')[0] for factor in os.listdir(self.factorDefPath) \
-                      if factor not in ['__init__.py', '__pycache__']]
+        allFactors = self.definedFactorList()
         # self.logger.info("All factors defined: {}".format(allFactors))
         self.newFactor = sorted(list(set(allFactors) - set(os.listdir(self.factorDataPath))))
         if self.newFactor:
@@ -108,113 +209,621 @@ class FactorUpdate:
         else:
             self.logger.info("No new factors seen, the factor updating process will end soon")
 
-    def writeNewFactor(self):
+    def writeNewFactor(self, workers=1, singleReplay=False, evalMode="stream", chunkDays=None, warmupDays=30):
         '''
         存储数据文件
+        param workers: 并行进程数，大于1时将新增因子分配到进程池中计算；等于1时按原有方式串行计算，
+                       两种方式下单个因子出错均不影响其他因子
+        param singleReplay: True时所有新增因子共用一次panelFeed回放，resampleFeed和收益panel
+                            在因子间共享；与workers同时使用时，每个进程对分到的一组因子回放一次
+        param evalMode: "stream"时检测指标由DefaultFactorTest随feed逐bar计算；
+                        "vector"时回放只计算因子值，回放结束后由PanelFactorTest对完整panel批量计算检测指标，
+                        适用于长历史的回补；需先通过factorBenchmark.py --check streamVector，见panelFactorTest.requireVerified
+        param chunkDays: 不为空时按chunkDays个工作日分段回放，每段结束后将结果写入文件并释放内存，
+                         内存占用只与段长有关，与总时长无关；需要指定start和end，不能与singleReplay同时使用
+        param warmupDays: 分段回放时每段提前开始的工作日数，需不少于因子及检测指标的回看长度，
+                          提前部分只用于恢复计算状态，不写入文件
+        return: 出错因子（或因子组）及其错误信息的字典，没有新增因子时返回None
         '''
+        if evalMode not in ["stream", "vector"]:
+            raise ValueError("evalMode must be 'stream' or 'vector', got {}".format(evalMode))
+        if chunkDays and singleReplay:
+            raise ValueError("chunkDays cannot be used together with singleReplay")
+        if evalMode == "vector":
+            panelFactorTest.requireVerified()
         self.newFactorList()
+        failedDict = None
         if self.newFactor:  # 仅在有新增因子的情况下才进行后续的因子计算、检验及存储
-            for factor in self.newFactor:  # 对新增因子列表里的因子进行计算和数据存储
-                if factor == 'broker':
-                    continue
-
-                self.logger.info(
-                    "****************** Writing FactorData for {} ******************".format(factor))
-                modulePath = "cpa.factorPool.factors.{}".format(factor)  # 因子模块路径
-                module = importlib.import_module(modulePath)  # 导入模块
-                factorObject = getattr(module, 'Factor')  # 获取因子对象的名称 e.g. cpa.factorPool.factors.dmaEwv.Factor
-                panelFeed = self.getPanelFeed()  # 为新的因子匹配一个新的panelFeed
-
-                # 计算绝对收益
-                if self.isRelReturn is False:
-                    # 对各resample周期创建相应的格模块类
-                    for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
-                        self.reasampleFeedDict[freqStr] = ResampledPanelFeed(panelFeed, freqNum)
-                        self._return_Dict[freqStr] = returns.Returns(self.reasampleFeedDict[freqStr],
-                                                                     lag=self.lag,
-                                                                     maxLen=1024)
-                        self.rawFactorDict[freqStr] = factorBase.FactorPanel(self.reasampleFeedDict[freqStr], factorObject)
-                        self.factorTesterDict[freqStr] = DefaultFactorTest(self.reasampleFeedDict[freqStr],
-                                                                           self.rawFactorDict[freqStr],
-                                                                           self._return_Dict[freqStr],
-                                                                           indicators=['IC', 'rankIC', 'beta', 'gpIC',
-                                                                                       'tbdf', 'turn', 'groupRet'],
-                                                                           lag=self.lag,
-                                                                           cut=0.1,
-                                                                           fee=self.fee)
-                    panelFeed.run(_print=True)  # 由panelFeed同时驱动各resampleFeed
-
-                # 计算相对收益
-                elif self.isRelReturn is True:
-                    # 生成一个存放resampleFeed的字典
-                    for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
-                        self.reasampleFeedDict[freqStr] = ResampledPanelFeed(panelFeed, freqNum)
-                    baseFeedDict = {"base": panelFeed}  # panelFeed字典
-                    combinedDict = {**baseFeedDict, **self.reasampleFeedDict}  #合并字典
-                    benchPanel = self.getBenchPanel()  # 基准指数panel
-                    advFeed = AdvancedFeed(feedDict=combinedDict, panelDict={'bench': benchPanel})
+            factorList = [factor for factor in self.newFactor if factor != 'broker']
+            if singleReplay:
+                if workers > 1:
+                    groupList = [tuple(factorList[i::workers]) for i in range(workers) if factorList[i::workers]]
+                    failedDict = self._runParallel("_writeFactorGroup", groupList, workers, evalMode=evalMode)
+                else:
+                    failedDict = self._runSerial("_writeFactorGroup", [tuple(factorList)], evalMode=evalMode)
+            elif workers > 1:
+                failedDict = self._runParallel("_writeOneNewFactor", factorList, workers, evalMode=evalMode,
+                                               chunkDays=chunkDays, warmupDays=warmupDays)
+            else:  # 对新增因子列表里的因子逐个进行计算和数据存储
+                failedDict = self._runSerial("_writeOneNewFactor", factorList, evalMode=evalMode,
+                                             chunkDays=chunkDays, warmupDays=warmupDays)
+            self._finishRun()
+        return failedDict
 
+    def staleCells(self):
+        '''
+        比较各因子各周期当前的结果集key与factorData中catalog记录的key
+        key由因子模块及其依赖的源码、检测参数（股票池、市场、lag、fee、cut、周期、收益类型）和已存数据的起止时间计算，
+        见_resultParams；没有记录key的已有数据（如首次在已有的因子池上运行），
+        catalog中的因子源码hash和检测参数与当前一致时补记key，否则视为变化
+        只读取已有的文件夹，不创建文件夹：没有因子文件夹的因子是新增因子，由writeNewFactor写入；
+        因子文件夹下缺少的周期视为变化
+        return: {factor: {freqStr: key}}，只包含key变化了的(因子, 周期)
+        '''
+        staleDict = {}
+        for factor in self.definedFactorList():
+            if factor == 'broker' or not os.path.isdir(os.path.join(self.factorDataPath, factor)):
+                continue
+            sourceHash = resultCache.dependencyHash(factor)
+            factorSource = factorCatalog.factorSourceHash(factor)
+            for freqStr in self.resampleFreqStr:
+                folderPath = os.path.join(self.factorDataPath, factor, freqStr)
+                if os.path.isdir(folderPath):
+                    catalog = factorCatalog.getCatalog(factor, freqStr)
+                else:  # 传入folderPath时FactorCatalog不创建文件夹
+                    catalog = factorCatalog.FactorCatalog(factor, freqStr, folderPath=folderPath)
+                key = resultCache.cellKey(self._resultParams(factor, freqStr, sourceHash, catalog))
+                recordedKey = catalog.content.get("resultKey")
+                if recordedKey is None and catalog.getFiles() and self._matchesCatalog(catalog, factorSource):
+                    catalog.content["resultKey"] = recordedKey = key
+                    catalog.save()
+                if recordedKey != key:
+                    staleDict.setdefault(factor, {})[freqStr] = key
+        return staleDict
+
+    def _matchesCatalog(self, catalog, factorSource):
+        '''catalog记录的因子源码hash和检测参数（lag, cut, fee）与当前一致'''
+        params = catalog.content.get("params", {})
+        return catalog.content.get("source") == factorSource and \
+            all(params.get(name) == value for name, value in [("lag", self.lag), ("cut", 0.1), ("fee", self.fee)])
+
+    def writeChangedFactors(self, workers=1, evalMode="stream", chunkDays=None, warmupDays=30):
+        '''
+        只重新计算因子定义或检测参数变化了的(因子, 周期)，其余保持不变
+        变化的(因子, 周期)在已存数据起止时间上的结果集在缓存中时直接从缓存恢复，否则重新计算后存入缓存；
+        被替换的数据在缓存中时直接删除，否则移入以时间命名的文件夹
+        param workers, evalMode, chunkDays, warmupDays: 见writeNewFactor
+        return: 出错因子及其错误信息的字典
+        '''
+        if evalMode == "vector":
+            panelFactorTest.requireVerified()
+        staleDict = self.staleCells()
+        computeDict = {}
+        for factor, keyDict in staleDict.items():
+            for freqStr, key in keyDict.items():
+                self._retireResults(factor, freqStr)
+                if self.resultCache.has(key):
+                    folderPath = pathSelector.PathSelector.getFactorFilePath(factorName=factor, factorFrequency=freqStr)
+                    self.resultCache.restore(key, folderPath)
+                    self.logger.info("The results of {} {} have been restored from the cache".format(factor, freqStr))
+                else:
+                    computeDict.setdefault(factor, {})[freqStr] = key
+        self.logger.info("{} factor frequencies changed, {} to be computed: {}"
+                         .format(sum(len(keyDict) for keyDict in staleDict.values()),
+                                 sum(len(keyDict) for keyDict in computeDict.values()),
+                                 {factor: sorted(keyDict) for factor, keyDict in computeDict.items()}))
+
+        failedDict = None
+        if workers > 1 and computeDict:
+            failedDict = self._runParallel("_writeFactorCells", list(computeDict), workers, cellDict=computeDict,
+                                           evalMode=evalMode, chunkDays=chunkDays, warmupDays=warmupDays)
+        else:
+            failedDict = self._runSerial("_writeFactorCells", sorted(computeDict), cellDict=computeDict,
+                                         evalMode=evalMode, chunkDays=chunkDays, warmupDays=warmupDays)
+        self.resultCache.evict()
+        self._finishRun()
+        return failedDict
+
+    def _writeFactorCells(self, factor, cellDict, evalMode="stream", chunkDays=None, warmupDays=30):
+        '''
+        计算一个因子指定周期的数据，写入后按新数据的起止时间记录的结果集key（见_recordedWrite）存入缓存
+        param factor: 因子名
+        param cellDict: {factor: {freqStr: key}}，只计算本因子的周期
+        '''
+        keyDict = cellDict[factor]
+        allFreqs = (self.resampleFreqNum, self.resampleFreqStr)
+        self.resampleFreqNum = [freqNum for freqNum, freqStr in zip(*allFreqs) if freqStr in keyDict]
+        self.resampleFreqStr = [freqStr for freqStr in allFreqs[1] if freqStr in keyDict]
+        try:
+            self._writeOneNewFactor(factor, evalMode=evalMode, chunkDays=chunkDays, warmupDays=warmupDays)
+        finally:
+            self.resampleFreqNum, self.resampleFreqStr = allFreqs
+        self.waitReports()  # 图表生成后再存入缓存
+
+        for freqStr in keyDict:
+            catalog = factorCatalog.FactorCatalog(factor, freqStr)
+            key = catalog.content.get("resultKey")
+            if not catalog.getFiles() or key is None:  # 数据过短未写入
+                continue
+            self.resultCache.store(key, catalog.folderPath,
+                                   meta={"factor": factor, "frequency": freqStr,
+                                         "params": self._resultParams(factor, freqStr, None, catalog)})
+
+    def _resultParams(self, factor, freqStr, sourceHash, catalog):
+        '''
+        结果集key对应的参数
+        起止时间取已存数据的而不是本次计算的，续写后key随之变化，缓存中较早的结果集不会替换较新的数据
+        param sourceHash: 因子模块及其依赖的源码hash，为空时重新计算
+        param catalog: 因子周期的FactorCatalog，没有数据时起止时间为None
+        '''
+        return {**self._checkpointParams(factor, freqStr),
+                "source": sourceHash or resultCache.dependencyHash(factor),
+                "dataRange": catalog.getDateRange()}
+
+    def _recordResultKey(self, factor, freqStr):
+        '''写入后按已存数据重新记录结果集key，h5PanelWriter写入时会清除原有的key'''
+        catalog = factorCatalog.FactorCatalog(factor, freqStr)
+        if catalog.getFiles():
+            catalog.content["resultKey"] = resultCache.cellKey(self._resultParams(factor, freqStr, None, catalog))
+            catalog.save()
+
+    def _retireResults(self, factor, freqStr):
+        '''
+        移除一个周期文件夹下即将被替换的数据文件
+        数据的结果集key记录在catalog中且已缓存时直接删除，否则移入以时间命名的文件夹
+        '''
+        folderPath = pathSelector.PathSelector.getFactorFilePath(factorName=factor, factorFrequency=freqStr)
+        if not os.path.isdir(folderPath):
+            return
+        fileList = [entry.path for entry in os.scandir(folderPath) if entry.is_file()]
+        if not fileList:
+            return
+        oldKey = factorCatalog.FactorCatalog(factor, freqStr).content.get("resultKey")
+        if oldKey and self.resultCache.has(oldKey):
+            for filePath in fileList:
+                os.remove(filePath)
+            return
+        destFolderPath = os.path.join(folderPath, pd.Timestamp.now().strftime("%Y%m%d_%H%M"))
+        os.makedirs(destFolderPath, exist_ok=True)
+        for filePath in fileList:
+            shutil.move(filePath, destFolderPath)
+        self.logger.info("The old files of {} {} have been moved to {}".format(factor, freqStr, destFolderPath))
+
+    def _writeOneNewFactor(self, factor, evalMode="stream", chunkDays=None, warmupDays=30):
+        '''
+        计算、检验并存储单个新增因子
+        param factor: 因子名
+        param evalMode: "stream" or "vector"，见writeNewFactor
+        param chunkDays: 分段回放的工作日数，为空时一次回放全部数据，见writeNewFactor
+        param warmupDays: 分段回放时每段提前开始的工作日数
+        '''
+        self.logger.info(
+            "****************** Writing FactorData for {} ******************".format(factor))
+        self.stageTags = {"factor": factor, "mode": "new", "eval": evalMode}
+        with self.recorder.profile(factor), self._stage("total"):
+            factorObject = self._loadFactorObject(factor)
+            if chunkDays:
+                self._writeChunked(factor, factorObject, evalMode, chunkDays, warmupDays)
+            else:
+                self.factorTesterDict = self._replayFactor(factorObject, evalMode)
+                self._saveNewResults(factor, self.factorTesterDict)
+
+    def _replayFactor(self, factorObject, evalMode):
+        '''
+        以[self.start, self.end]的新panelFeed回放一个因子
+        useBarStore的批量检测模式下收益panel从barStore读取，回放时不创建收益对象，见_updateBarStores
+        return: {freqStr: DefaultFactorTest或PanelFactorTest}
+        '''
+        storedReturns = self._prepareBarStores(evalMode)
+        with self._stage("feedLoad"):
+            panelFeed = self.getPanelFeed()  # 为新的因子匹配一个新的panelFeed
+        driverFeed = self._buildFeeds(panelFeed, fullHistory=evalMode == "vector", withReturns=not storedReturns)
+        if evalMode == "vector":
+            factorPanelDict = self._buildFactorPanels(factorObject)
+            with self._stage("replay"):
+                driverFeed.run(_print=True)
+            return self._buildPanelTesters(factorPanelDict)
+        testerDict = self._buildFactorTesters(factorObject)
+        with self._stage("replay"):
+            driverFeed.run(_print=True)  # 由panelFeed或advancedFeed同时驱动各resampleFeed
+        return testerDict
+
+    def _writeChunked(self, factor, factorObject, evalMode, chunkDays, warmupDays):
+        '''
+        分段回放并写入一个新因子，每段只保留该段（及提前warmupDays个工作日）的feed和检测结果
+        第一段以new模式写入，之后各段以tail模式追加晚于已存最后时间的数据，提前部分自然被跳过；
+        warmupDays不少于因子及检测指标的回看长度时，写入的数据与一次回放全部数据相同
+        说明：之后各段出现第一段没有的代码时，tail模式按合并后的列重写已存数据，之前的时间为NaN
+        '''
+        if self.start is None or self.end is None:
+            raise ValueError("start and end must be given to write a factor in chunks")
+        originalStart, originalEnd = self.start, self.end
+        bizDays = pd.bdate_range(pd.Timestamp(originalStart), pd.Timestamp(originalEnd))
+        chunkStarts = bizDays[::chunkDays]
+        try:
+            for i, chunkStart in enumerate(chunkStarts):
+                isLast = i == len(chunkStarts) - 1
+                chunkEnd = bizDays[-1] if isLast else bizDays[bizDays.get_loc(chunkStarts[i + 1]) - 1]
+                replayStart = bizDays[0] if i == 0 else chunkStart - pd.tseries.offsets.BusinessDay(n=warmupDays)
+                self.start, self.end = replayStart.strftime("%Y%m%d"), chunkEnd.strftime("%Y%m%d")
+                self.logger.info("Chunk {}/{} of {}: {} - {}, replay from {}"
+                                 .format(i + 1, len(chunkStarts), factor, chunkStart.date(), chunkEnd.date(),
+                                         replayStart.date()))
+                with self._stage("chunk", chunk=i):
+                    self.factorTesterDict = self._replayFactor(factorObject, evalMode)
+                    if i == 0 and self._replayLength(self.factorTesterDict) <= 2 * self.lag:
+                        self.logger.warning(
+                            "The length of the return panel <= 2 * the required lag. Data will not be saved.")
+                        return
                     for freqStr in self.resampleFreqStr:
-                        # 对各resample周期创建相应的格模块类
-                        self._return_Dict[freqStr] = returns.RelativeReturns(advFeed,
-                                                                             isResample=True,
-                                                                             resampleType=freqStr,
-                                                                             lag=self.lag,
-                                                                             maxLen=1024)
-                        self.rawFactorDict[freqStr] = factorBase.FactorPanel(self.reasampleFeedDict[freqStr],
-                                                                             factorObject)
-                        # self.rawFactorDict[freqStr] = factorBase.FactorPanel(advFeed,
-                        #                                                      factorObject,
-                        #                                                      isResample=True,
-                        #                                                      resampleType=freqStr)
-                        self.factorTesterDict[freqStr] = DefaultFactorTest(advFeed,
-                                                                           self.rawFactorDict[freqStr],
-                                                                           self._return_Dict[freqStr],
-                                                                           isResample = True,
-                                                                           resampleType = freqStr,
-                                                                           indicators = ['IC', 'rankIC', 'beta', 'gpIC',
-                                                                                       'tbdf', 'turn', 'groupRet'],
-                                                                           lag=self.lag,
-                                                                           cut=0.1,
-                                                                           fee=self.fee)
-                    advFeed.run(_print=True)  # 由advancedFeed同时驱动各resampleFeed
-
-                # 若数据长度不符合因子检验标准，则不存储
-                if len(self._return_Dict[self.resampleFreqStr[0]]) <= 2 * self.lag:
-                    self.logger.warning(
-                        "The length of the return panel <= 2 * the required lag. Data will not be saved.")
-                    return
-
-                # 写h5文件和图表
-                for freqStr in self.resampleFreqStr:
-                    h5PanelWriter = h5Writer.H5PanelWriter(factor, self.factorTesterDict[freqStr])
-                    h5PanelWriter.write(mode="new")
-                    reportWriter = ReportWriter(factorName=factor,
-                                                defaultFactorTest=self.factorTesterDict[freqStr])
-                    reportWriter.write()
-
-    def updateFactor(self, factor, nBizDaysAhead=30):
+                        h5PanelWriter = h5Writer.H5PanelWriter(factor, self.factorTesterDict[freqStr],
+                                                               backend=self.backend)
+                        self._recordedWrite(h5PanelWriter, factor, freqStr, mode="new" if i == 0 else "tail")
+                if isLast:
+                    with self._stage("checkpointSave"):
+                        self._saveCheckpoints(factor, self.factorTesterDict)
+                else:  # 释放本段的feed及检测结果，feed与指标之间的订阅关系为循环引用
+                    self.panelFeed = self.advFeed = None
+                    self.reasampleFeedDict, self._return_Dict = {}, {}
+                    self.rawFactorDict, self.factorTesterDict = {}, {}
+                    gc.collect()
+        finally:
+            self.start, self.end = originalStart, originalEnd
+
+        for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+            # 图表由写入完成后的完整数据生成
+            with self._stage("reportSubmit", frequency=freqStr):
+                self.reportPool.submitStored(factor, freqNum)
+
+    def _writeFactorGroup(self, factorList, evalMode="stream"):
+        '''
+        单次回放模式：一个panelFeed（相对收益时为AdvancedFeed）同时驱动多个因子的计算和检验
+        各因子共用resampleFeed和收益panel，数据读取、回放和resample的开销不随因子个数增加
+        注意：回放过程中任一因子出错会中断整组因子的计算
+        param factorList: 因子名列表
+        param evalMode: "stream" or "vector"，见writeNewFactor
+        '''
+        factorList = list(factorList)
+        self.logger.info(
+            "****************** Writing FactorData for {} in a single replay ******************".format(factorList))
+        self.stageTags = {"factor": "+".join(factorList), "mode": "new", "eval": evalMode}  # 共用的阶段记在整组名下
+        storedReturns = self._prepareBarStores(evalMode)
+        with self._stage("feedLoad"):
+            panelFeed = self.getPanelFeed()
+        driverFeed = self._buildFeeds(panelFeed, fullHistory=evalMode == "vector", withReturns=not storedReturns)
+        testerDictByFactor = {}
+        if evalMode == "vector":
+            factorPanelDictByFactor = {factor: self._buildFactorPanels(self._loadFactorObject(factor))
+                                       for factor in factorList}
+            with self._stage("replay"):
+                driverFeed.run(_print=True)
+            for factor in factorList:
+                self.stageTags["factor"] = factor
+                testerDictByFactor[factor] = self._buildPanelTesters(factorPanelDictByFactor[factor])
+        else:
+            for factor in factorList:
+                testerDictByFactor[factor] = self._buildFactorTesters(self._loadFactorObject(factor))
+            with self._stage("replay"):
+                driverFeed.run(_print=True)
+
+        for factor in factorList:
+            self.logger.info(
+                "****************** Saving FactorData for {} ******************".format(factor))
+            self.stageTags["factor"] = factor
+            self._saveNewResults(factor, testerDictByFactor[factor])
+
+    def _loadFactorObject(self, factor):
+        '''导入因子模块并返回因子类'''
+        modulePath = "cpa.factorPool.factors.{}".format(factor)  # 因子模块路径
+        module = importlib.import_module(modulePath)  # 导入模块
+        return getattr(module, 'Factor')  # 获取因子对象的名称 e.g. cpa.factorPool.factors.dmaEwv.Factor
+
+    def _buildFeeds(self, panelFeed, fullHistory=False, withReturns=True):
+        '''
+        创建各resample周期的resampleFeed和收益panel，与因子无关，可在多个因子间共享
+        param panelFeed: 分钟级panelFeed
+        param fullHistory: True时收益panel保留全部历史（不设maxLen），供批量检测模式回放结束后直接使用
+        param withReturns: False时只创建resampleFeed，收益panel从barStore读取
+        return: 驱动回放的feed，绝对收益或不创建收益panel时为panelFeed，相对收益时为AdvancedFeed
+        '''
+        returnKwargs = {} if fullHistory else {"maxLen": 1024}
+        self.panelFeed = panelFeed
+        self.reasampleFeedDict = {}
+        self._return_Dict = {}
+        for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+            self.reasampleFeedDict[freqStr] = ResampledPanelFeed(panelFeed, freqNum)
+        if not withReturns:  # 收益panel从barStore读取，各resampleFeed由分钟panelFeed直接驱动
+            self.advFeed = None
+            return panelFeed
+
+        # 计算绝对收益
+        if self.isRelReturn is False:
+            for freqStr in self.resampleFreqStr:
+                self._return_Dict[freqStr] = returns.Returns(self.reasampleFeedDict[freqStr],
+                                                             lag=self.lag,
+                                                             **returnKwargs)
+            self.advFeed = None
+            return panelFeed
+
+        # 计算相对收益
+        baseFeedDict = {"base": panelFeed}  # panelFeed字典
+        combinedDict = {**baseFeedDict, **self.reasampleFeedDict}  #合并字典
+        benchPanel = self.getBenchPanel()  # 基准指数panel
+        self.advFeed = AdvancedFeed(feedDict=combinedDict, panelDict={'bench': benchPanel})
+        for freqStr in self.resampleFreqStr:
+            self._return_Dict[freqStr] = returns.RelativeReturns(self.advFeed,
+                                                                 isResample=True,
+                                                                 resampleType=freqStr,
+                                                                 lag=self.lag,
+                                                                 **returnKwargs)
+        return self.advFeed
+
+    def _prepareBarStores(self, evalMode):
+        '''
+        useBarStore的批量检测模式下先更新barStore，逐bar检测模式的DefaultFactorTest需要回放中的收益对象，不使用barStore
+        return: 收益panel是否从barStore读取
+        '''
+        if not (self.useBarStore and evalMode == "vector"):
+            return False
+        self._updateBarStores()
+        return True
+
+    def _barStore(self, freqStr):
+        '''一个周期的BarStore'''
+        return barStore.BarStore(self.instruments, freqStr, lag=self.lag, isRelReturn=self.isRelReturn)
+
+    def _updateBarStores(self):
+        '''
+        追加各周期barStore中还没有的收益bar，同一FactorUpdate对同一时间范围只更新一次，之后的因子直接读取
+        各周期共用一次分钟panelFeed回放，由_buildFeeds创建的Returns或RelativeReturns计算收益；
+        回放从各周期需要的最早时间开始（见BarStore.replayStart），已存的时间范围不再回放，
+        回放开始时间早于已存数据时重建
+        '''
+        updateKey = (str(self.start), str(self.end))
+        if updateKey in self._barStoreUpdated:
+            return
+        storeDict = {freqStr: self._barStore(freqStr) for freqStr in self.resampleFreqStr}
+        if not all(store.covers(self.start, self.end) for store in storeDict.values()):
+            startList = [store.replayStart(self.start) for store in storeDict.values()]
+            originalStart = self.start
+            self.start = None if any(start is None for start in startList) \
+                else min(pd.Timestamp(start) for start in startList).to_pydatetime()
+            try:
+                with self._stage("barStoreUpdate"):
+                    driverFeed = self._buildFeeds(self.getPanelFeed(), fullHistory=True)
+                    driverFeed.run(_print=True)
+                    for freqStr, store in storeDict.items():
+                        self.recorder.count("bars", store.update(self._return_Dict[freqStr].to_frame(),
+                                                                 start=originalStart))
+            finally:
+                self.start = originalStart
+                self.panelFeed = self.advFeed = None
+                self.reasampleFeedDict, self._return_Dict = {}, {}
+        self._barStoreUpdated.add(updateKey)
+
+    def _buildFactorTesters(self, factorObject):
+        '''
+        在_buildFeeds创建的feed上为一个因子创建各周期的FactorPanel和DefaultFactorTest
+        param factorObject: 因子类
+        return: {freqStr: DefaultFactorTest}
+        '''
+        testerDict = {}
+        for freqStr in self.resampleFreqStr:
+            self.rawFactorDict[freqStr] = factorBase.FactorPanel(self.reasampleFeedDict[freqStr], factorObject)
+            if self.isRelReturn is False:
+                testerDict[freqStr] = DefaultFactorTest(self.reasampleFeedDict[freqStr],
+                                                        self.rawFactorDict[freqStr],
+                                                        self._return_Dict[freqStr],
+                                                        indicators=['IC', 'rankIC', 'beta', 'gpIC',
+                                                                    'tbdf', 'turn', 'groupRet'],
+                                                        lag=self.lag,
+                                                        cut=0.1,
+                                                        fee=self.fee)
+            else:
+                # self.rawFactorDict[freqStr] = factorBase.FactorPanel(advFeed,
+                #                                                      factorObject,
+                #                                                      isResample=True,
+                #                                                      resampleType=freqStr)
+                testerDict[freqStr] = DefaultFactorTest(self.advFeed,
+                                                        self.rawFactorDict[freqStr],
+                                                        self._return_Dict[freqStr],
+                                                        isResample = True,
+                                                        resampleType = freqStr,
+                                                        indicators = ['IC', 'rankIC', 'beta', 'gpIC',
+                                                                    'tbdf', 'turn', 'groupRet'],
+                                                        lag=self.lag,
+                                                        cut=0.1,
+                                                        fee=self.fee)
+        return testerDict
+
+    def _buildFactorPanels(self, factorObject):
+        '''
+        批量检测模式：只在各周期的resampleFeed上创建FactorPanel，不创建DefaultFactorTest
+        param factorObject: 因子类
+        return: {freqStr: FactorPanel}
+        '''
+        factorPanelDict = {}
+        for freqStr in self.resampleFreqStr:
+            factorPanelDict[freqStr] = factorBase.FactorPanel(self.reasampleFeedDict[freqStr], factorObject)
+            self.rawFactorDict[freqStr] = factorPanelDict[freqStr]
+        return factorPanelDict
+
+    def _buildPanelTesters(self, factorPanelDict):
+        '''
+        批量检测模式：回放结束后由完整的因子值panel和收益panel批量计算各周期的检测指标
+        收益panel取回放中由_buildFeeds(fullHistory=True)创建的Returns或RelativeReturns，与逐bar模式使用同一收益；
+        useBarStore时收益panel从已更新的barStore读取，见_updateBarStores
+        param factorPanelDict: {freqStr: 已回放完的FactorPanel}
+        return: {freqStr: PanelFactorTest}
+        '''
+        testerDict = {}
+        for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+            factorFrame = factorPanelDict[freqStr].to_frame()
+            if self.useBarStore:
+                returnFrame = self._storedReturns(freqStr, factorFrame)
+            else:
+                returnFrame = self._return_Dict[freqStr].to_frame()
+            with self._stage("vectorTest", frequency=freqStr):
+                testerDict[freqStr] = panelFactorTest.PanelFactorTest(factorFrame, returnFrame,
+                                                                      frequency=freqNum,
+                                                                      indicators=['IC', 'rankIC', 'beta', 'gpIC',
+                                                                                  'tbdf', 'turn', 'groupRet'],
+                                                                      lag=self.lag,
+                                                                      cut=0.1,
+                                                                      fee=self.fee)
+                testerDict[freqStr].run()
+                self.recorder.count("bars", len(factorFrame))
+        return testerDict
+
+    def _storedReturns(self, freqStr, factorFrame):
+        '''
+        从barStore读取与因子值对齐的收益panel，barStore需已由_updateBarStores更新
+        与在本次回放上创建的收益panel相同，前lag个bar没有收益
+        param freqStr: 周期标签
+        param factorFrame: 回放得到的因子值DataFrame
+        '''
+        if not len(factorFrame):
+            return pd.DataFrame(index=factorFrame.index, columns=factorFrame.columns, dtype=np.float64)
+        with self._stage("barStoreLoad", frequency=freqStr):
+            returnFrame = self._barStore(freqStr).load(start=factorFrame.index[0], end=factorFrame.index[-1],
+                                                       fields=["returns"])["returns"]
+            returnFrame = returnFrame.reindex(index=factorFrame.index, columns=factorFrame.columns)
+        returnFrame.iloc[:self.lag] = np.nan
+        return returnFrame
+
+    def _replayLength(self, testerDict):
+        '''本次回放第一个周期的bar数：收益panel的长度，收益panel从barStore读取时为因子值的长度'''
+        freqStr = self.resampleFreqStr[0]
+        if freqStr in self._return_Dict:
+            return len(self._return_Dict[freqStr])
+        return len(testerDict[freqStr].factorPanel.to_frame())
+
+    def _saveNewResults(self, factor, testerDict):
+        '''
+        以new模式写入一个因子各周期的h5文件和图表
+        param factor: 因子名
+        param testerDict: {freqStr: DefaultFactorTest}
+        '''
+        # 若数据长度不符合因子检验标准，则不存储
+        if self._replayLength(testerDict) <= 2 * self.lag:
+            self.logger.warning(
+                "The length of the return panel <= 2 * the required lag. Data will not be saved.")
+            return
+
+        # 写h5文件和图表
+        for freqStr in self.resampleFreqStr:
+            h5PanelWriter = h5Writer.H5PanelWriter(factor, testerDict[freqStr], backend=self.backend)
+            self._recordedWrite(h5PanelWriter, factor, freqStr, mode="new")
+            with self._stage("reportSubmit", frequency=freqStr):
+                self.reportPool.submit(factor, testerDict[freqStr])  # 图表在后台生成，不阻塞下一个因子
+        with self._stage("checkpointSave"):
+            self._saveCheckpoints(factor, testerDict)
+
+    def _recordedWrite(self, h5PanelWriter, factor, freqStr, **writeKwargs):
+        '''写入一个周期的因子数据，记录耗时、写入的bar数和字节数，并按写入后的数据重新记录结果集key'''
+        with self._stage("writeH5", frequency=freqStr):
+            folderPath = pathSelector.PathSelector.getFactorFilePath(factorName=factor, factorFrequency=freqStr)
+            bytesBefore = stageRecorder.folderBytes(folderPath) if self.recorder.enabled else 0
+            h5PanelWriter.write(**writeKwargs)
+            if self.recorder.enabled:
+                self.recorder.count("bars", h5PanelWriter.factorRows)
+                self.recorder.count("bytesWritten", max(stageRecorder.folderBytes(folderPath) - bytesBefore, 0))
+        self._recordResultKey(factor, freqStr)
+
+    def _checkpointParams(self, factor, freqStr):
+        '''检查点对应的因子检测参数，参数变化后旧检查点失效'''
+        return {"instruments": self.instruments, "market": str(self.market), "frequency": freqStr,
+                "isRelReturn": self.isRelReturn, "lag": self.lag, "fee": self.fee, "cut": 0.1,
+                "source": factorCatalog.factorSourceHash(factor)}
+
+    def _saveCheckpoints(self, factor, testerDict):
+        '''
+        保存一个因子各周期的检查点：最后一个bar的时间、因子检测参数和回看窗口的工作日数
+        param factor: 因子名
+        param testerDict: {freqStr: DefaultFactorTest或PanelFactorTest}
+        '''
+        for freqStr in self.resampleFreqStr:
+            factorIndex = testerDict[freqStr].factorPanel.to_frame().index
+            if not len(factorIndex):
+                continue
+            checkpoint = factorCheckpoint.FactorCheckpoint(factor, freqStr)
+            checkpoint.save(lastTime=factorIndex[-1],
+                            params=self._checkpointParams(factor, freqStr),
+                            windowDays=self.checkpointDays)
+
+    def _loadCheckpoints(self, factor):
+        '''
+        读取一个因子各周期的检查点，任一周期缺失、参数不一致，
+        或检查点的最后时间与数据目录中因子计算值的结束时间不完全相同时不使用检查点
+        return: {freqStr: (lastTime, windowDays)}
+        '''
+        savedStateDict = {}
+        for freqStr in self.resampleFreqStr:
+            loaded = factorCheckpoint.FactorCheckpoint(factor, freqStr).load(self._checkpointParams(factor, freqStr))
+            if loaded is None:
+                return {}
+            entry = factorCatalog.getCatalog(factor, freqStr).getFiles().get("factor")
+            if entry is None or entry["end"] is None or pd.Timestamp(entry["end"]) != loaded[0]:
+                self.logger.info("The checkpoint of {} {} ends at {}, the stored data at {}; it will not be used"
+                                 .format(factor, freqStr, loaded[0], entry and entry["end"]))
+                return {}
+            savedStateDict[freqStr] = loaded
+        return savedStateDict
+
+    def updateFactor(self, factor, nBizDaysAhead=30, appendMode="tail", useCheckpoint=True, waitReports=True):
         '''
         续写一个因子文件夹下的所有文件
         param factor: 因子名
         param nBizDaysAhead: 以旧数据结束日期提前n个工作日开始计算新数据，根据策略需要调整
                              例如使用MA20的策略，对于2h的数据，至少要提前10个工作日
+        param appendMode: "tail"时在原h5文件中原位追加新数据，不读取旧数据；
+                          "append"时读取旧数据，将旧文件移入以时间命名的文件夹后重写完整文件
+        param useCheckpoint: True时若各周期都有与当前参数及已存数据一致的检查点，则从检查点的最后时间之前
+                             checkpointDays个工作日开始回放；否则按nBizDaysAhead提前计算
+        param waitReports: True时等待后台图表生成完成并导出阶段记录后返回，
+                           False时图表继续在后台生成，由waitReports()等待
         '''
+        self.stageTags = {"factor": factor, "mode": appendMode, "eval": "stream"}
+        with self.recorder.profile(factor), self._stage("total"):
+            self._updateFactor(factor, nBizDaysAhead, appendMode, useCheckpoint)
+        if waitReports:
+            self._finishRun()
+
+    def _updateFactor(self, factor, nBizDaysAhead, appendMode, useCheckpoint):
+        '''续写一个因子，参数见updateFactor'''
         self.logger.info("****************** Updating FactorData for {} ******************".format(factor))
+        self.dictOldResultDict = {}  # 只保留本因子的旧数据
 
-        factorReader = h5Reader.H5BatchPanelReader(factorName=factor, frequency=None, allFolders=True)
-        factorReader.prepareOutputData()
-        dateRangeDict = factorReader.getDateRange()  # 获取存放首尾数据日期的字典
-        endDateList = sorted([range[1] for range in dateRangeDict.values()])  # 取所有的数据结束日期， 并排序
-        endDate = endDateList[-1].to_pydatetime()  # 取所有数据结束日期中最晚的一个
-        timeDiff = pd.tseries.offsets.BusinessDay(n=nBizDaysAhead)  # 比结束日期提前n个工作日开始计算新数据
-        self.start = endDate - timeDiff  # 计算新数据所开始的时间
-        self.logger.info("The end time in the original data is {}\n"
-                         "The input time difference is {}\n"
-                         "The start time for calculating the new data is {}\n"
-                         "The end time for calculating the new data is {}\n"
-                         .format(endDate, timeDiff, self.start, self.end))
-        panelFeed = self.getPanelFeed()  # 以新的start获取一个新的panelFeed
+        with self._stage("checkpointLoad"):
+            savedStateDict = self._loadCheckpoints(factor) if useCheckpoint else {}
+        if savedStateDict:
+            # 从最早的检查点所在日期之前windowDays个工作日开始回放，检查点之后同一天的分钟也被重新计算，
+            # 回放的窗口只用于恢复状态，写入时跳过不晚于已存最后时间的数据
+            lastTime = min(lastTime for lastTime, _ in savedStateDict.values())
+            windowDays = max(windowDays for _, windowDays in savedStateDict.values())
+            self.start = (lastTime.normalize() - pd.tseries.offsets.BusinessDay(n=windowDays)).to_pydatetime()
+            self.logger.info("The checkpoint time is {}\n"
+                             "The start time for calculating the new data is {}\n"
+                             "The end time for calculating the new data is {}\n"
+                             .format(lastTime, self.start, self.end))
+        else:
+            # 由数据目录获取结束日期，不加载数据；没有目录的旧数据由文件元数据重建目录，支持全部存储后端
+            endDate = factorCatalog.factorEndDate(factor)
+            if endDate is None:
+                raise ValueError("No stored data of {} was found in {}".format(factor, self.factorDataPath))
+            timeDiff = pd.tseries.offsets.BusinessDay(n=nBizDaysAhead)  # 比结束日期提前n个工作日开始计算新数据
+            self.start = endDate - timeDiff  # 计算新数据所开始的时间
+            self.logger.info("The end time in the original data is {}\n"
+                             "The input time difference is {}\n"
+                             "The start time for calculating the new data is {}\n"
+                             "The end time for calculating the new data is {}\n"
+                             .format(endDate, timeDiff, self.start, self.end))
+        with self._stage("feedLoad"):
+            panelFeed = self.getPanelFeed()  # 以新的start获取一个新的panelFeed
+        self.panelFeed = panelFeed
+        self.advFeed = None
+        for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+            self.reasampleFeedDict[freqStr] = ResampledPanelFeed(panelFeed, freqNum)
 
         modulePath = "cpa.factorPool.factors.{}".format(factor)  # 因子模块路径
         module = importlib.import_module(modulePath)  # 导入模块
@@ -222,29 +831,11 @@ class FactorUpdate:
 
 
         for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
-            folderPath = pathSelector.PathSelector.getFactorFilePath(factorName=factor, factorFrequency=freqStr)
-            # 读取因子检测的参数值
-            csvFileName = [name for name in os.listdir(folderPath) if name.endswith(".csv")][0]
-            csvFilePath = os.path.join(folderPath, csvFileName)
-            fields = ["frequency", "lag", "nGroup", "cut", "fee", "poolNum"]
-            settingReader = csvReader.CSVPanelReader(filePath=csvFilePath,
-                                                     fields=fields,
-                                                     frequency=freqNum,
-                                                     isInstrumentCol=False)
-            settingReader.loads()
-
-            # 读取不同周期的h5文件
-            freqReader = h5Reader.H5BatchPanelReader(factorName=factor,
-                                                     frequency=freqNum,
-                                                     allFolders=False)
-            freqReader.prepareOutputData()  # 存入相应的字典中
-            oldResultDict = freqReader.to_frame()  # 获取存放dataframe数据的字典
-            filePathDict = freqReader.getFilePath()  # 获取原来H5文件的路径
+            # 按数据目录读取不同周期的旧数据，tail模式不需要旧数据
+            if appendMode == "append":
+                self.dictOldResultDict[freqStr] = factorStorage.readFactorData(factor, freqStr)
 
             # 对各resample周期创建相应的模块类
-            self.dictOldResultDict[freqStr] = oldResultDict
-            self.dictFilePathDict[freqStr] = filePathDict
-            self.reasampleFeedDict[freqStr] = ResampledPanelFeed(panelFeed, freqNum)
             self._return_Dict[freqStr] = returns.Returns(self.reasampleFeedDict[freqStr], lag=self.lag, maxLen=1024)
             self.rawFactorDict[freqStr] = factorBase.FactorPanel(self.reasampleFeedDict[freqStr], factorObject)
             self.factorTesterDict[freqStr] = DefaultFactorTest(feed=self.reasampleFeedDict[freqStr],
@@ -256,56 +847,327 @@ class FactorUpdate:
                                                                cut=0.1,
                                                                fee=self.fee)
 
-        panelFeed.run(_print=True)  # 由panelFeed同时驱动各resampleFeed
+        with self._stage("replay"):
+            panelFeed.run(_print=True)
 
+        if appendMode == "tail":
+            for freqStr in self.resampleFreqStr:
+                h5PanelWriter = h5Writer.H5PanelWriter(factorName=factor,
+                                                       defaultFactorTest=self.factorTesterDict[freqStr],
+                                                       backend=self.backend)
+                self._recordedWrite(h5PanelWriter, factor, freqStr, mode="tail")  # 原位追加新数据
 
         for freqStr, oldResultDict in self.dictOldResultDict.items():
-            # 将旧的文件移入以时间命名的文件夹
-            oldDateTime = list(self.dictOldResultDict[freqStr].keys())[0][-16:-3]
+            # 将旧的文件移入以时间命名的文件夹，新文件沿用旧数据的存储后端
+            backendName = factorCatalog.getCatalog(factor, freqStr).content.get("backend", "table")
             freqFolderPath = pathSelector.PathSelector.getFactorFilePath(factorName=factor, factorFrequency=freqStr)
-            destFolderPath = os.path.join(freqFolderPath, oldDateTime)
-            if not os.path.exists(destFolderPath):
-                os.mkdir(destFolderPath)
+            destFolderPath = os.path.join(freqFolderPath, pd.Timestamp.now().strftime("%Y%m%d_%H%M"))
+            os.makedirs(destFolderPath, exist_ok=True)
             fileList = [name for name in os.listdir(freqFolderPath) if
                               os.path.isfile(os.path.join(freqFolderPath, name))]
             for file in fileList:
                 sourceFilePath = os.path.join(freqFolderPath, file)
                 shutil.move(sourceFilePath, destFolderPath)
 
-            # 写新的h5文件
+            # 写新的数据文件
             h5PanelWriter = h5Writer.H5PanelWriter(factorName=factor,
-                                                   defaultFactorTest=self.factorTesterDict[freqStr])
-            h5PanelWriter.write(mode="append", oldResultDict=oldResultDict)  # 使用append模式写入
+                                                   defaultFactorTest=self.factorTesterDict[freqStr],
+                                                   backend=backendName)
+            self._recordedWrite(h5PanelWriter, factor, freqStr, mode="append", oldResultDict=oldResultDict)  # 使用append模式写入
+
+        with self._stage("checkpointSave"):
+            self._saveCheckpoints(factor, self.factorTesterDict)
 
-        for freqNum in self.resampleFreqNum:
-            # 写新的图表文件
-            secondReader = h5Reader.H5BatchPanelReader(factorName=factor,
-                                                       frequency=freqNum)
-            secondReader.prepareOutputData()
-            reportWriter = ReportWriter(factorName=factor,
-                                        h5BatchPanelReader=secondReader,
-                                        csvPanelReader=settingReader)
-            reportWriter.write()
+        for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+            # 由续写后的完整数据在后台生成新的图表文件，数据目录未变化时跳过
+            with self._stage("reportSubmit", frequency=freqStr):
+                self.reportPool.submitStored(factor, freqNum)
 
-    def updateFactorPool(self, nBizDaysAhead=30):
+    def updateFactorPool(self, nBizDaysAhead=30, workers=1, appendMode="tail", useCheckpoint=True):
         '''
         续写factorData下所有的因子文件夹
         param nBizDaysAhead: 以旧数据结束日期提前n个工作日开始计算新数据，根据策略需要调整
                              例如使用MA20的策略，对于2h的数据，至少要提前10个工作日
+        param workers: 并行进程数，大于1时各因子在进程池中独立续写；等于1时串行续写，
+                       两种方式下单个因子出错（如没有已存储的数据）均不影响其他因子
+        param appendMode: 续写模式，"tail" or "append"，见updateFactor
+        param useCheckpoint: 是否使用检查点，见updateFactor
+        return: 出错因子及其错误信息的字典
         '''
         factorNameList = [name for name in os.listdir(self.factorDataPath) if  # 取factorData文件下的子文件夹名
                           os.path.isdir(os.path.join(self.factorDataPath, name))]
-        for factor in factorNameList:
-            self.updateFactor(factor, nBizDaysAhead=nBizDaysAhead)
+        failedDict = None
+        if workers > 1:
+            failedDict = self._runParallel("updateFactor", factorNameList, workers,
+                                           nBizDaysAhead=nBizDaysAhead, appendMode=appendMode,
+                                           useCheckpoint=useCheckpoint, waitReports=False)
+        else:  # 前一个因子的图表在后台生成时即开始续写下一个因子
+            failedDict = self._runSerial("updateFactor", factorNameList, nBizDaysAhead=nBizDaysAhead,
+                                         appendMode=appendMode, useCheckpoint=useCheckpoint, waitReports=False)
+        self._finishRun()
+        return failedDict
+
+    def backfillFactor(self, factor, workers=4, shardDays=None, warmupDays=30, evalMode="stream"):
+        '''
+        按日期分片并行回补一个长历史的新因子
+        [start, end]按工作日分为若干片，每片在子进程中提前warmupDays个工作日开始回放，只保留本片的结果；
+        各片结果按时间拼接后以new模式写入factorData，与一次串行回放的结果一致（warmupDays不少于回看长度时）
+        param factor: 因子名
+        param workers: 进程数
+        param shardDays: 每片的工作日数，为空时平均分为workers片
+        param warmupDays: 每片提前开始的工作日数，与updateFactor的nBizDaysAhead作用相同
+        param evalMode: "stream" or "vector"，见writeNewFactor
+        return: 出错分片及其错误信息的字典，任一分片出错时不写入数据
+        说明：分片回放不保存检查点；new模式会覆盖已有数据，因子已有数据时不回补，应使用updateFactor续写
+        '''
+        if self.start is None or self.end is None:
+            raise ValueError("start and end must be given to backfill a factor in shards")
+        if evalMode == "vector":
+            panelFactorTest.requireVerified()
+        if factorCatalog.factorEndDate(factor) is not None:
+            raise ValueError("{} already has data in {}, use updateFactor to extend it".format(factor, self.factorDataPath))
+        bizDays = pd.bdate_range(pd.Timestamp(self.start), pd.Timestamp(self.end))
+        shardDays = shardDays or int(np.ceil(len(bizDays) / workers))
+        shardList = []
+        for i in range(0, len(bizDays), shardDays):
+            keepStart, keepEnd = bizDays[i], bizDays[min(i + shardDays, len(bizDays)) - 1]
+            replayStart = keepStart if i == 0 else keepStart - pd.tseries.offsets.BusinessDay(n=warmupDays)
+            shardList.append(tuple(date.strftime("%Y%m%d") for date in [replayStart, keepStart, keepEnd]))
+        if not shardList:
+            self.logger.warning("There is no business day between {} and {}, {} is not backfilled"
+                                .format(self.start, self.end, factor))
+            return {}
+        self.logger.info("****************** Backfilling FactorData for {} in {} shards ******************"
+                         .format(factor, len(shardList)))
+        self.stageTags = {"factor": factor, "mode": "new", "eval": evalMode}
+
+        failedDict = {}
+        shardResultList = []
+        with self.recorder.profile(factor), self._stage("total"):
+            with self._stage("shardReplay"), self._queueLogging() as logQueue:
+                with ProcessPoolExecutor(max_workers=min(workers, len(shardList))) as executor:
+                    futureList = [executor.submit(_runShardTask, self._initKwargs, factor, shard, evalMode, logQueue)
+                                  for shard in shardList]
+                    for shard, future in zip(shardList, futureList):
+                        try:
+                            error, shardResult, records = future.result()
+                        except Exception:  # 子进程异常退出等进程池层面的错误
+                            error, shardResult, records = traceback.format_exc(), None, []
+                        self.recorder.extend(records)
+                        if error:
+                            failedDict[shard] = error
+                            self.logger.error("Shard {} - {} of {} failed:\n{}".format(shard[1], shard[2], factor, error))
+                        shardResultList.append(shardResult)
+            if failedDict:
+                return failedDict
+
+            # 按时间拼接各片的结果，写入正常的factorData结构
+            for freqNum, freqStr in zip(self.resampleFreqNum, self.resampleFreqStr):
+                with self._stage("stitch", frequency=freqStr):
+                    reportData = ReportData.concat([shardResult[freqStr] for shardResult in shardResultList])
+                if freqStr == self.resampleFreqStr[0] and len(reportData.factorPanel.data) <= 2 * self.lag:
+                    self.logger.warning("The length of the factor panel <= 2 * the required lag. Data will not be saved.")
+                    return failedDict
+                h5PanelWriter = h5Writer.H5PanelWriter(factor, reportData, backend=self.backend)
+                self._recordedWrite(h5PanelWriter, factor, freqStr, mode="new")
+                with self._stage("reportSubmit", frequency=freqStr):
+                    self.reportPool.submit(factor, reportData)
+        self._finishRun()
+        return failedDict
+
+    @contextlib.contextmanager
+    def _queueLogging(self):
+        '''子进程日志通过队列汇总到主进程的日志handler中，with块返回日志队列'''
+        manager = multiprocessing.Manager()
+        logQueue = manager.Queue()
+        handlers = self.logger.handlers or logging.getLogger().handlers
+        listener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+        listener.start()
+        try:
+            yield logQueue
+        finally:
+            listener.stop()
+            manager.shutdown()
+
+    def waitReports(self, raiseErrors=True):
+        '''
+        等待后台图表生成任务全部完成，同步生成图表（reportWorkers为0）时没有需要等待的任务
+        param raiseErrors: True时有图表出错则抛出RuntimeError，错误信息已逐个记入日志
+        return: 出错图表及其错误信息的字典
+        '''
+        with self.recorder.stage("reportWait"):
+            failedDict = self.reportPool.wait()
+        if failedDict and raiseErrors:
+            raise RuntimeError("{} reports failed: {}".format(len(failedDict), ", ".join(sorted(failedDict))))
+        return failedDict
+
+    def _finishRun(self):
+        '''等待后台图表生成完成并导出阶段记录，图表出错时在导出阶段记录后抛出异常'''
+        try:
+            self.waitReports()
+        finally:
+            self.exportMetrics()
+
+    def _stage(self, name, **tags):
+        '''以当前因子的标签记录一个阶段'''
+        return self.recorder.stage(name, **{**self.stageTags, **tags})
+
+    def exportMetrics(self):
+        '''
+        导出阶段记录及耗时最长因子的cProfile结果，导出后清空已导出的记录
+        '''
+        if self.metricsPath and self.recorder.records:
+            self.recorder.export(self.metricsPath)
+            for stage, factor, frequency, seconds in self.recorder.summary(top=5):
+                self.logger.info("Slowest stage: {} {} {} {:.1f}s".format(stage, factor, frequency or "", seconds))
+        if self.profileSlowest:
+            profilePath = os.path.splitext(self.metricsPath)[0] + ".prof" if self.metricsPath \
+                else os.path.join(self.factorDataPath, "factorUpdate_slowest.prof")
+            self.recorder.dumpProfile(profilePath)
+        self.recorder.records = []
+        self.recorder.slowestProfile = None
+
+    def _runSerial(self, methodName, factorList, **methodKwargs):
+        '''
+        在当前进程中逐个计算因子，与_runParallel相同，单个因子出错时记录错误并继续计算下一个因子
+        param methodName: 调用的方法名，见_runParallel
+        param factorList: 因子名列表，或因子名tuple组成的列表
+        param methodKwargs: 传给methodName的其他参数
+        return: 出错因子（或因子组）及其错误信息的字典
+        '''
+        failedDict = {}
+        for factor in factorList:
+            try:
+                getattr(self, methodName)(factor, **methodKwargs)
+            except Exception:
+                failedDict[factor] = traceback.format_exc()
+                self.logger.error("Factor {} failed:\n{}".format(factor, failedDict[factor]))
+        self.logger.info("{} of {} factors finished, failed factors: {}"
+                         .format(len(factorList) - len(failedDict), len(factorList), sorted(failedDict)))
+        return failedDict
+
+    def _runParallel(self, methodName, factorList, workers, **methodKwargs):
+        '''
+        将因子列表分配到进程池中并行计算
+        每个因子在子进程中使用独立的FactorUpdate对象，只写入各自的factorData/<factor>文件夹，
+        因此不同因子的写入不会冲突；子进程日志通过队列汇总到主进程的日志handler中
+        param methodName: 子进程中调用的方法名，"_writeOneNewFactor", "updateFactor", "_writeFactorGroup"
+                          or "_writeFactorCells"
+        param factorList: 因子名列表，或因子名tuple组成的列表（每组在一个进程中单次回放）
+        param workers: 进程数
+        param methodKwargs: 传给methodName的其他参数
+        return: 出错因子（或因子组）及其错误信息的字典
+        '''
+        factorList = sorted(set(factorList))  # 去重，保证同一因子只被一个进程写入
+        failedDict = {}
+        with self._queueLogging() as logQueue:
+            with ProcessPoolExecutor(max_workers=min(workers, len(factorList) or 1)) as executor:
+                futureDict = {executor.submit(_runFactorTask, self._initKwargs, methodName,
+                                              factor, methodKwargs, logQueue): factor
+                              for factor in factorList}
+                for future in as_completed(futureDict):
+                    factor = futureDict[future]
+                    try:
+                        error, records, slowestProfile = future.result()
+                    except Exception:  # 子进程异常退出等进程池层面的错误
+                        error, records, slowestProfile = traceback.format_exc(), [], None
+                    self.recorder.extend(records)  # 汇总子进程的阶段记录
+                    if slowestProfile is not None:
+                        self.recorder.keepSlowest(*slowestProfile)
+                    if error:
+                        failedDict[factor] = error
+                        self.logger.error("Factor {} failed:\n{}".format(factor, error))
+                    else:
+                        self.logger.info("Factor {} finished".format(factor))
+
+        self.logger.info("{} of {} factors finished, failed factors: {}"
+                         .format(len(factorList) - len(failedDict), len(factorList), sorted(failedDict)))
+        return failedDict
+
+
+def _redirectLogging(logQueue):
+    '''将子进程中已创建的所有logger改为向主进程的日志队列输出'''
+    rootLogger = logging.getLogger()
+    loggerList = [logging.getLogger(name) for name in list(logging.root.manager.loggerDict)]
+    for log in loggerList:
+        if isinstance(log, logging.Logger):
+            for handler in list(log.handlers):
+                log.removeHandler(handler)
+            log.propagate = True
+    if not any(isinstance(handler, QueueHandler) for handler in rootLogger.handlers):
+        for handler in list(rootLogger.handlers):
+            rootLogger.removeHandler(handler)
+        rootLogger.addHandler(QueueHandler(logQueue))
+        rootLogger.setLevel(logging.INFO)
+
+
+def _runFactorTask(initKwargs, methodName, factor, methodKwargs, logQueue):
+    '''
+    进程池中单个因子的任务入口
+    return: (错误信息, 阶段记录, 耗时最长的cProfile结果)，成功时错误信息为None，
+            保证单个因子的错误不影响其他因子；阶段记录和cProfile结果由主进程汇总导出
+    '''
+    factorUpdate = None
+    error = None
+    try:
+        for name in ([factor] if isinstance(factor, str) else factor):
+            importlib.import_module("cpa.factorPool.factors.{}".format(name))  # 先导入因子模块，其中新建的logger一并重定向
+        _redirectLogging(logQueue)
+        factorUpdate = FactorUpdate(**dict(initKwargs, reportWorkers=0))  # 子进程中同步生成图表，不再嵌套进程池
+        getattr(factorUpdate, methodName)(factor, **methodKwargs)
+    except Exception:
+        error = traceback.format_exc()
+    if factorUpdate is None:
+        return error, [], None
+    return error, factorUpdate.recorder.records, factorUpdate.recorder.slowestProfile
+
+def _runShardTask(initKwargs, factor, shard, evalMode, logQueue):
+    '''
+    进程池中单个日期分片的任务入口
+    param shard: (回放开始日期, 保留开始日期, 保留结束日期)
+    return: (错误信息, {freqStr: 本片的ReportData}, 阶段记录)
+    '''
+    replayStart, keepStart, keepEnd = shard
+    try:
+        importlib.import_module("cpa.factorPool.factors.{}".format(factor))
+        _redirectLogging(logQueue)
+        # 各分片的时间范围不同，不共用barStore，避免分片之间相互重建
+        factorUpdate = FactorUpdate(**dict(initKwargs, start=replayStart, end=keepEnd, reportWorkers=0,
+                                           useBarStore=False))
+        factorUpdate.stageTags = {"factor": factor, "mode": "shard", "eval": evalMode, "shard": keepStart}
+        testerDict = factorUpdate._replayFactor(factorUpdate._loadFactorObject(factor), evalMode)
+        shardResult = {freqStr: ReportData.fromTester(tester).slice(keepStart, keepEnd)  # 去掉提前回放的部分
+                       for freqStr, tester in testerDict.items()}
+        return None, shardResult, factorUpdate.recorder.records
+    except Exception:
+        return traceback.format_exc(), None, []
+
 
 if __name__ == "__main__":
 
 
     "写新的因子检测数据"
     # 写factorData中不存在，但是factors中存在的因子
-    # 如果要重新写某个因子，需将factorData下原来的因子文件夹删除或者重命名
+    # 如果要重新写某个因子，需将factorData下原来的因子文件夹删除或者重命名，或使用writeChangedFactors
     factorUpdate = FactorUpdate(instruments="SZ50", start="20150701", end="20150731", isRelReturn=True)
     factorUpdate.writeNewFactor()
+    # 新增因子较多时可使用多进程并行计算
+    # factorUpdate.writeNewFactor(workers=8)
+    # 长历史回补时检测指标可在回放结束后批量计算
+    # factorUpdate.writeNewFactor(evalMode="vector")
+    # 各因子共用持久化的resample bar及收益panel，新的分钟数据只追加计算一次
+    # factorUpdate = FactorUpdate(instruments="SZ50", start="20150701", end="20150731", useBarStore=True)
+    # factorUpdate.writeNewFactor(evalMode="vector")
+    # 长历史按20个工作日分段回放，内存占用与总时长无关
+    # factorUpdate.writeNewFactor(chunkDays=20, warmupDays=30)
+    # 单个长历史因子按日期分片并行回补
+    # factorUpdate = FactorUpdate(instruments="ZZ500", start="20100101", end="20191231")
+    # factorUpdate.backfillFactor("maPanelFactor", workers=16, warmupDays=30)
+    # 记录各阶段耗时及内存，并保存最慢因子的cProfile结果
+    # factorUpdate = FactorUpdate(instruments="SZ50", start="20150701", end="20150731",
+    #                             metricsPath="factorUpdate_metrics.jsonl", profileSlowest=True)
+    # 因子定义或检测参数变化后，只重新计算变化了的因子周期，缓存中已有的结果直接恢复
+    # factorUpdate.writeChangedFactors(workers=8)
 
     '''续写功能，仅在原有数据非常长的情况下使用，使用前建议咨询项目组成员'''
     # 续写factorData下某一个因子
@@ -314,3 +1176,4 @@ if __name__ == "__main__":
 
     # 续写factorData下所有的因子
     # factorUpdate.updateFactorPool()
+    # factorUpdate.updateFactorPool(workers=8)
@@ -8,31 +8,38 @@ sys.path.append('../t0_frameWork/')
 import datetime
 
 from cpa.io import BaseWriter
-from cpa.config import pathSelector
 from cpa.utils import logger
 from cpa.config import const
 from cpa.factorProcessor import factorTest
+from cpa.io import factorCatalog, factorStorage
 
 
 class H5PanelWriter(BaseWriter):
     '''
     因子计算及检测数据h5文件写入接口
-    说明：用来写因子检测数据的，有两种写新的和续写两种模式，用cpa.factorPool.factorUpdate里面的相应函数调用。
+    说明：用来写因子检测数据的，有写新的、续写和原位续写三种模式，用cpa.factorPool.factorUpdate里面的相应函数调用。
+         存储格式由factorStorage中的后端决定
     '''
 
     logger = logger.getLogger("H5PanelWriter")
 
-    def __init__(self, factorName, defaultFactorTest):
+    def __init__(self, factorName, defaultFactorTest, backend="table", rootPath=None):
         '''
         初始化
         param defaultFactorTest: factorTest.py下的DefaultFactorTest类对象
         param factorName: 因子名
+        param backend: 存储后端，"table", "fixed", "parquet" or "consolidated"，见factorStorage
+                       tail模式下若已有数据的后端不同，则沿用已有数据的后端
+        param rootPath: factorData根文件夹，为空时由pathSelector生成
         '''
+        self.rootPath = rootPath
         self.defaultFactorTest = defaultFactorTest
+        self.backend = factorStorage.getBackend(backend)
         self.testReportGenerator = factorTest.TestReportGenerator(defaultFactorTest=self.defaultFactorTest)
         self.frequency = defaultFactorTest.frequency
         self.factorName = factorName
         self.count = 0
+        self.factorRows = 0  # 本次写入的因子计算值行数（bar数）
         self.name = self.__class__.__name__
 
     def getDir(self):
@@ -44,112 +51,96 @@ class H5PanelWriter(BaseWriter):
     def write(self, mode, oldResultDict=None):
         '''
         写入函数
-        param mode: 写入模式， "new" or "append"
-        param oldResultDict: 存储旧h5文件数据的字典，由h5PanelReader生成
+        param mode: 写入模式， "new", "append" or "tail"
+                    tail模式直接在原h5文件的table中追加晚于已存最后时间的新数据，不读取旧数据也不重写文件
+        param oldResultDict: 旧数据的字典{数据名: DataFrame或Series}，由factorStorage.readFactorData读取，
+                             仅append模式需要，旧文件需已移出因子周期文件夹
         '''
         # 存储路径命名
         currentDT = datetime.datetime.now()
-        factorFolderPath = pathSelector.PathSelector.getFactorFilePath(factorName=self.factorName,  # 因子计算数据的文件路径
-                                                                       factorFrequency=const.DataFrequency.freq2lable(self.frequency))  # 因子文件夹路径
-        calFileName = self.factorName + "_factor_" +\
-                      const.DataFrequency.freq2lable(self.frequency) +\
-                      currentDT.strftime("_%Y%m%d_%H%M") + ".h5"  # 因子计算值文件名
-        calFilePath = pathSelector.PathSelector.getFactorFilePath(factorName=self.factorName,  # 因子计算数据的文件路径
-                                                                  factorFrequency=const.DataFrequency.freq2lable(self.frequency),
-                                                                  fileName=calFileName)
+        factorFolderPath = factorCatalog.factorFolderPath(self.factorName,  # 因子文件夹路径
+                                                          const.DataFrequency.freq2lable(self.frequency),
+                                                          rootPath=self.rootPath)
+        # 数据目录，记录本次写入各文件的起止时间、行数、列名及检测参数
+        self.catalog = factorCatalog.FactorCatalog(self.factorName,
+                                                   const.DataFrequency.freq2lable(self.frequency),
+                                                   folderPath=factorFolderPath)
+        self.catalog.setParams({name: getattr(self.defaultFactorTest, name, None)
+                                for name in ["lag", "cut", "fee", "nGroup"]})
 
         # 写入新h5文件
         if mode == "new":
-            # 因子计算数据存储
-            self.defaultFactorTest.factorPanel.to_frame().to_hdf(path_or_buf=calFilePath,  # 使用pandas存储h5文件
-                                                                 key=self.factorName,
-                                                                 format="table",
-                                                                 data_columns=True,
-                                                                 mode="w")
-            self.logger.info("The file {} has been saved".format(calFileName))
+            freqLabel = const.DataFrequency.freq2lable(self.frequency)
+            self.backend.clear(factorFolderPath, self.factorName, freqLabel)
+            self.catalog.content["files"] = {}
+            for key, data in self.getDataDict().items():
+                fileName = self.backend.fileName(self.factorName, key, freqLabel, currentDT)  # 因子计算值及检测数据文件名
+                self.backend.write(os.path.join(factorFolderPath, fileName), self.backend.storeKey(self.factorName, key), data)
+                self.catalog.record(key, fileName, data)
+                self.logger.info("The file {} has been saved".format(fileName))
+                if key == "factor":
+                    self.factorRows = len(data)
+            self.catalog.content["backend"] = self.backend.name
 
-            # 因子检测数据存储
-            indicatorDict = self.defaultFactorTest.getIndicators()  # 取包含因子检测对象的字典
-            for key, value in indicatorDict.items():
-                testFileName = self.factorName + "_" + key + "_" +\
-                               const.DataFrequency.freq2lable(self.frequency) +\
-                               currentDT.strftime("_%Y%m%d_%H%M") + ".h5"  # 因子检测数据文件名
-                testFilePath = pathSelector.PathSelector.getFactorFilePath(factorName=self.factorName,  # 因子计算数据的文件路径
-                                                                           factorFrequency=const.DataFrequency.freq2lable(self.frequency),
-                                                                           fileName=testFileName)  # 因子检测数据文件路径
-                if indicatorDict[key].__len__():  # 当存储因子检测值的series不为空时进行存储
-                    if key in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', "groupNumber"]:
-                        value.to_frame().to_hdf(path_or_buf=testFilePath,
-                                                key=key,
-                                                format="table",
-                                                data_columns=True,
-                                                mode="w")
-                    else:
-                        value.to_series().to_hdf(path_or_buf=testFilePath,
-                                                 key=key,
-                                                 format="table",
-                                                 data_columns=True,
-                                                 mode="w")
-                        self.logger.info("The file {} has been saved".format(testFileName))
-                else:  # 当存储因子检测值的series为空时，不进行存储，并记入日志
-                    self.logger.info("The calculation of {} failed".format(key))
-
-        # 续写h5文件
+        # 续写h5文件：旧数据与晚于旧数据最后时间的新数据合并后写新文件
         elif mode == "append":
-            # 因子计算数据存储
-            for key in oldResultDict.keys():
-                if "factor" in key:
-                    oldCalFileName = key
-            appendDataFrame = self.defaultFactorTest.factorPanel.to_frame()  # 新生成的因子计算值dataframe
-            # 当新dataframe的最早时间晚于旧dataframe的最早时间并早于旧dataframe的最晚时间才进行拼接
-            if appendDataFrame.index[0] > oldResultDict[oldCalFileName].index[0] \
-                and appendDataFrame.index[0] < oldResultDict[oldCalFileName].index[-1]:
-                appendDataFrame = appendDataFrame.loc[appendDataFrame.index > oldResultDict[oldCalFileName].index[-1]]
-                newDataFrame = oldResultDict[oldCalFileName].append(appendDataFrame)
-                newDataFrame = newDataFrame.loc[~newDataFrame.index.duplicated(keep="first")]  # 删除时间重复的数据
-                newDataFrame.to_hdf(path_or_buf=calFilePath,  # 使用pandas存储h5文件
-                                    key=self.factorName,
-                                    format="table",
-                                    data_columns=True,
-                                    mode="w")
+            freqLabel = const.DataFrequency.freq2lable(self.frequency)
+            self.backend.clear(factorFolderPath, self.factorName, freqLabel)
+            self.catalog.content["files"] = {}
+            for key, data in self.getDataDict().items():
+                newData, appendedData = factorStorage.mergeNewRows(oldResultDict.get(key), data)
+                fileName = self.backend.fileName(self.factorName, key, freqLabel, currentDT)
+                self.backend.write(os.path.join(factorFolderPath, fileName), self.backend.storeKey(self.factorName, key), newData)
+                self.catalog.record(key, fileName, newData)
                 self.count += 1
-                self.logger.info("The file {} has been saved".format(calFileName))
-            else:
-                self.logger.info("The earliest time of {} is before the one of {}. "
-                                 "The new dataframe will not be appended.".format(calFileName, oldCalFileName))
+                self.logger.info("The file {} has been saved, {} rows appended".format(fileName, len(appendedData)))
+                if key == "factor":
+                    self.factorRows = len(appendedData)
+            self.catalog.content["backend"] = self.backend.name
 
-            # 因子检测数据存储
-            indicatorDict = self.defaultFactorTest.getIndicators()
-            for key, value in indicatorDict.items():  # 遍历新生成的检测数据
-                testFileName = self.factorName + "_" + key + "_" +\
-                               const.DataFrequency.freq2lable(self.frequency) +\
-                               currentDT.strftime("_%Y%m%d_%H%M") + ".h5" # 命名因子检测数据文件
-                testFilePath = os.path.join(factorFolderPath, testFileName)
-                if indicatorDict[key].__len__():  # 当存储因子检测值不为空时进行存储
-                    appendData = value.to_frame() if key in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', 'groupNumber']\
-                                    else value.to_series()  # 生成新因子检测值df或者series
-                    for key, value in oldResultDict.items():  # 提取存放旧h5数据的字典
-                        # 检测新因子文件名是否与旧因子文件名相同
-                        if testFileName.split("_")[-4] == key.split("_")[-4]:
-                            # 当新data的最早时间晚于旧data的最早时间并早于旧data的最晚时间才进行拼接
-                            if appendData.index[0] > oldResultDict[key].index[0] \
-                                    and appendData.index[0] < oldResultDict[key].index[-1]:
-                                appendData = appendData.loc[appendData.index > oldResultDict[key].index[-1]]
-                                newData = oldResultDict[key].append(appendData)
-                                newData = newData.loc[~newData.index.duplicated(keep="first")]
-                                newData.to_hdf(path_or_buf=testFilePath,
-                                                 key=key,
-                                                 format="table",
-                                                 data_columns=True,
-                                                 mode="w")
-                                self.count += 1
-                                self.logger.info("The file {} has been saved".format(testFileName))
-                            else:
-                                self.logger.info("The earliest time of {} is before the one of {}. "
-                                                 "The new series will not be appended.".format(testFileName, key))
-
-                else:  # 当存储因子检测值的series为空时，不进行存储，并记入日志
-                    self.logger.info("The calculation of {} failed".format(key))
+        # 原位续写h5文件
+        elif mode == "tail":
+            freqLabel = const.DataFrequency.freq2lable(self.frequency)
+            if not self.catalog.exists():  # catalog出现之前写入的旧数据均为table格式
+                self.catalog.scanFolder()
+            if self.catalog.getFiles():  # 沿用已有数据的存储后端
+                self.backend = factorStorage.getBackend(self.catalog.content.get("backend", "table"))
+            for key, data in self.getDataDict().items():
+                storeKey = self.backend.storeKey(self.factorName, key)
+                oldFilePath = self.backend.findLatest(factorFolderPath, self.factorName, key, freqLabel)
+                if oldFilePath is None:  # 没有可续写的文件时写新文件
+                    fileName = self.backend.fileName(self.factorName, key, freqLabel, currentDT)
+                    self.backend.write(os.path.join(factorFolderPath, fileName), storeKey, data)
+                    self.catalog.record(key, fileName, data)
+                    self.logger.info("The file {} has been saved".format(fileName))
+                    appendedData = data
+                else:
+                    appendedData = self.backend.append(oldFilePath, storeKey, data)
+                    self.catalog.recordAppend(key, os.path.basename(oldFilePath), appendedData, storeKey=storeKey)
+                    self.count += 1
+                    self.logger.info("{} rows have been appended to the file {}"
+                                     .format(len(appendedData), os.path.basename(oldFilePath)))
+                if key == "factor":
+                    self.factorRows = len(appendedData)
+            self.catalog.content["backend"] = self.backend.name
 
         else:
-            raise ValueError("An argument except 'new' or 'append' was passed into the write() function for the mode")
+            raise ValueError("An argument except 'new', 'append' or 'tail' was passed into the write() function for the mode")
+
+        self.catalog.content.pop("resultKey", None)  # 数据已变化，原结果集key失效，由FactorUpdate重新记录
+        self.catalog.save()
+
+    def getDataDict(self):
+        '''
+        取因子计算值及各检测指标的数据，检测值为空的指标不存储，并记入日志
+        return: {"factor": 因子计算值DataFrame, 检测指标名: DataFrame或Series}
+        '''
+        dataDict = {"factor": self.defaultFactorTest.factorPanel.to_frame()}
+        indicatorDict = self.defaultFactorTest.getIndicators()  # 取包含因子检测对象的字典
+        for key, value in indicatorDict.items():
+            if indicatorDict[key].__len__():  # 当存储因子检测值的series不为空时进行存储
+                dataDict[key] = value.to_frame() if key in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', 'groupNumber']\
+                                    else value.to_series()
+            else:
+                self.logger.info("The calculation of {} failed".format(key))
+        return dataDict
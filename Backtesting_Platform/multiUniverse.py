@@ -0,0 +1,243 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+multiUniverse.py
+描述：多个股票池共用一次数据读取的因子检测
+     SZ50、HS300、ZZ500的成分股相互重叠（SZ50为HS300的子集），分别运行FactorUpdate时重叠的分钟数据被重复读取，
+     因子值也被重复计算；本模块在内存中合并各股票池代码的并集，每个因子只回放一次，
+     再按各日各股票池的成分截取截面，分别进行批量检测并写入各股票池的factorData
+说明：各股票池的分钟数据由DataFeedFactory.getHistReader读取，与getHistFeed使用同一数据源，
+     并集只在内存中合并，由DataFeedFactory.getReaderFeed创建panelFeed，不向数据文件夹写入任何文件；
+     某日某代码在股票池的分钟数据中有收盘价时，该代码在当日属于该股票池，各日的成分以PanelCache缓存在factorData旁的panelCache文件夹；
+     各股票池的结果写入该股票池单独运行FactorUpdate时使用的factorData文件夹（factorDataPaths），
+     路径显式传给H5PanelWriter和ReportPool，不改动pathSelector；
+     截面检测需要完整的因子值panel，只支持批量检测模式（evalMode="vector"）
+注意：因子值在并集上按代码回放，只依赖单个代码历史的因子与各股票池单独运行的结果相同；
+     代码调入股票池之前若在其他股票池中有数据，其回看窗口包含这段历史，与单独运行时从调入日开始回看不同；
+     在截面上标准化等依赖截面的因子，截面为并集而不是单个股票池
+'''
+
+import os
+import hashlib
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from cpa.utils import logger, bar
+from cpa.config import pathSelector
+from cpa.io import h5Writer, panelCache
+from cpa.factorPool.factorUpdate import FactorUpdate
+from cpa.factorProcessor import panelFactorTest
+from cpa.feed.feedFactory import DataFeedFactory
+
+
+class MultiUniverseUpdate:
+    '''多股票池因子检测数据写入'''
+
+    logger = logger.getLogger("MultiUniverseUpdate")
+    minuteFields = ['open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, factorDataPaths, market=bar.Market.STOCK, start=None, end=None,
+                 testFreq=None, isRelReturn=False, fee=0.003, lag=1, usePanelCache=True, backend="table",
+                 metricsPath=None, profileSlowest=False):
+        '''
+        param factorDataPaths: {股票池: 该股票池的factorData文件夹}，即各股票池单独运行FactorUpdate时写入的文件夹，
+                               如 {"SZ50": ".../factorData/SZ50", "HS300": ".../factorData/HS300"}
+        param isRelReturn: True时各股票池分别计算相对于各自基准指数的收益
+        param usePanelCache: True时基准指数数据通过panelCache读取，见FactorUpdate
+        其他参数见FactorUpdate
+        '''
+        self.factorDataPaths = dict(factorDataPaths)
+        if len({os.path.abspath(path) for path in self.factorDataPaths.values()}) < len(self.factorDataPaths):
+            raise ValueError("Each universe needs its own factorData folder, got {}".format(self.factorDataPaths))
+        self.universes = list(self.factorDataPaths)
+        self.market = market
+        self.isRelReturn = isRelReturn
+        self.unionName = "_".join(sorted(self.universes))
+        self.unionDict = None  # 代码并集的分钟数据{field: DataFrame}
+        self.memberDict = None  # {股票池: 各日成分DataFrame}
+        # 并集没有基准指数，回放时计算并集的绝对收益，相对收益在截取截面后按各股票池的基准指数计算；
+        # 图表在当前进程中生成，保证写入各股票池的文件夹
+        self.factorUpdate = FactorUpdate(instruments=self.unionName, market=market, start=start, end=end,
+                                         testFreq=testFreq, isRelReturn=False, fee=fee, lag=lag,
+                                         usePanelCache=usePanelCache, backend=backend, reportWorkers=0,
+                                         metricsPath=metricsPath, profileSlowest=profileSlowest)
+
+    def newFactorList(self):
+        '''
+        各股票池的factorData中还没有的因子
+        return: {因子名: [没有该因子的股票池]}，只包含至少一个股票池没有的因子
+        '''
+        factorDict = {}
+        for factor in self.factorUpdate.definedFactorList():
+            if factor == 'broker':
+                continue
+            missing = [universe for universe in self.universes
+                       if not os.path.isdir(os.path.join(self.factorDataPaths[universe], factor))]
+            if missing:
+                factorDict[factor] = missing
+        return factorDict
+
+    def loadUnionData(self):
+        '''
+        读取各股票池的分钟数据，在内存中合并为代码并集，并读取或计算各股票池各日的成分
+        重叠的(时间, 代码)取第一个股票池的数据
+        '''
+        if not (hasattr(DataFeedFactory, "getHistReader") and hasattr(DataFeedFactory, "getReaderFeed")):
+            raise NotImplementedError("MultiUniverseUpdate needs DataFeedFactory.getHistReader and "
+                                      "DataFeedFactory.getReaderFeed to share one replay across universes")
+        fieldDictList = []
+        for universe in self.universes:
+            sourceReader = DataFeedFactory.getHistReader(instruments=universe,
+                                                         market=self.market,
+                                                         frequency=bar.Frequency.MINUTE)
+            sourceReader.loads()
+            fieldDictList.append(panelCache.frameToFieldDict(sourceReader.to_frame(), self.minuteFields))
+        self.unionDict = {}
+        for field in self.minuteFields:
+            unionFrame = fieldDictList[0][field]
+            for fieldDict in fieldDictList[1:]:
+                unionFrame = unionFrame.combine_first(fieldDict[field])
+            self.unionDict[field] = unionFrame
+        self.memberDict = self._loadMembers(dict(zip(self.universes, fieldDictList)))
+        self.logger.info("The union of {} has been loaded: {} instruments, {} minutes"
+                         .format(self.universes, self.unionDict["close"].shape[1], len(self.unionDict["close"])))
+
+    def _loadMembers(self, fieldDictDict):
+        '''
+        各股票池各日的成分，以PanelCache缓存，各股票池数据的形状或时间范围变化时重新计算
+        param fieldDictDict: {股票池: 该股票池的分钟数据{field: DataFrame}}
+        return: {股票池: 成分DataFrame}，index为日期、columns为代码，代码当日属于股票池时为1.0，否则为NaN，数据为内存映射
+        '''
+        digest = hashlib.sha1()
+        for universe in self.universes:
+            closeFrame = fieldDictDict[universe]["close"]
+            digest.update(repr((universe, closeFrame.shape, str(closeFrame.index.min()), str(closeFrame.index.max()),
+                                list(closeFrame.columns.astype(str)))).encode())
+        factorDataPath = pathSelector.PathSelector.getFactorFilePath().rstrip(os.sep)
+        memberCache = panelCache.PanelCache(name=self.unionName + "_members", sourcePaths=[], fields=self.universes,
+                                            cacheDir=os.path.join(os.path.dirname(factorDataPath), "panelCache"),
+                                            sourceKey=digest.hexdigest())
+
+        def buildMembers():
+            memberDict = {}
+            for universe in self.universes:
+                closeFrame = fieldDictDict[universe]["close"]
+                dailyMember = closeFrame.notna().groupby(closeFrame.index.normalize()).any()
+                memberDict[universe] = dailyMember.astype(np.float64).where(dailyMember)
+            return memberDict
+
+        return memberCache.getOrBuild(buildMembers)
+
+    def writeNewFactor(self):
+        '''
+        每个新增因子在代码并集上回放一次，按股票池截取截面后分别检测，只写入还没有该因子的股票池
+        return: 出错因子及其错误信息的字典
+        '''
+        factorDict = self.newFactorList()
+        if not factorDict:
+            self.logger.info("No new factors seen in {}".format(self.universes))
+            return {}
+        self.logger.info("The new factors:{}".format(factorDict))
+        panelFactorTest.requireVerified()
+        fu = self.factorUpdate
+        with fu._stage("minuteLoad"):
+            if self.unionDict is None:
+                self.loadUnionData()
+            benchCloseDict = {universe: fu.getBenchClose(instruments=universe) if self.isRelReturn else None
+                              for universe in self.universes}
+        failedDict = {}
+        for factor, universes in factorDict.items():
+            try:
+                self._writeOneFactor(factor, universes, benchCloseDict)
+            except Exception:  # 单个因子出错不影响其他因子
+                failedDict[factor] = traceback.format_exc()
+                self.logger.error("Factor {} failed:\n{}".format(factor, failedDict[factor]))
+        fu._finishRun()
+        return failedDict
+
+    def getPanelFeed(self):
+        '''由内存中的并集数据创建一个新的分钟panelFeed'''
+        fu = self.factorUpdate
+        unionReader = panelCache.FramePanelReader(self.unionDict, frequency=bar.Frequency.MINUTE,
+                                                  start=fu.start, end=fu.end, isInstrumentCol=True)
+        return DataFeedFactory.getReaderFeed(unionReader)
+
+    def _writeOneFactor(self, factor, universes, benchCloseDict):
+        '''
+        回放一个因子并写入各股票池的结果
+        param universes: 写入的股票池，即还没有该因子的股票池
+        '''
+        self.logger.info("****************** Writing FactorData for {} in {} ******************"
+                         .format(factor, universes))
+        fu = self.factorUpdate
+        fu.stageTags = {"factor": factor, "mode": "new", "eval": "vector"}
+        with fu.recorder.profile(factor), fu._stage("total"):
+            factorObject = fu._loadFactorObject(factor)
+            with fu._stage("feedLoad"):
+                panelFeed = self.getPanelFeed()
+            driverFeed = fu._buildFeeds(panelFeed, fullHistory=True)
+            factorPanelDict = fu._buildFactorPanels(factorObject)
+            with fu._stage("replay"):
+                driverFeed.run(_print=True)
+
+            for freqNum, freqStr in zip(fu.resampleFreqNum, fu.resampleFreqStr):
+                factorFrame = factorPanelDict[freqStr].to_frame()
+                if len(factorFrame) <= 2 * fu.lag:
+                    self.logger.warning(
+                        "The length of the factor panel <= 2 * the required lag. Data will not be saved.")
+                    return
+                unionReturns = fu._return_Dict[freqStr].to_frame().reindex(index=factorFrame.index,
+                                                                           columns=factorFrame.columns)
+                for universe in universes:
+                    rootPath = self.factorDataPaths[universe]
+                    with fu._stage("vectorTest", frequency=freqStr, universe=universe):
+                        memberMask = universeMask(self.memberDict[universe], factorFrame.index, factorFrame.columns)
+                        members = memberMask.columns[memberMask.any(axis=0)]
+                        memberMask = memberMask[members]
+                        returnFrame = unionReturns[members]
+                        if benchCloseDict[universe] is not None:
+                            benchClose = benchCloseDict[universe].reindex(factorFrame.index, method="ffill")
+                            benchReturns = panelFactorTest.forwardReturns(benchClose.to_frame(), lag=fu.lag).iloc[:, 0]
+                            returnFrame = returnFrame.sub(benchReturns, axis=0)
+                        tester = panelFactorTest.PanelFactorTest(factorFrame[members].where(memberMask),
+                                                                 returnFrame.where(memberMask),
+                                                                 frequency=freqNum,
+                                                                 indicators=['IC', 'rankIC', 'beta', 'gpIC',
+                                                                             'tbdf', 'turn', 'groupRet'],
+                                                                 lag=fu.lag,
+                                                                 cut=0.1,
+                                                                 fee=fu.fee)
+                        tester.run()
+                    # 结果集key由该股票池单独运行的FactorUpdate按其参数补记，这里不记录
+                    with fu._stage("writeH5", frequency=freqStr, universe=universe):
+                        h5PanelWriter = h5Writer.H5PanelWriter(factor, tester, backend=fu.backend, rootPath=rootPath)
+                        h5PanelWriter.write(mode="new")
+                        fu.recorder.count("bars", h5PanelWriter.factorRows)
+                    with fu._stage("reportSubmit", frequency=freqStr, universe=universe):
+                        fu.reportPool.submit(factor, tester, rootPath=rootPath)
+
+
+def universeMask(memberFrame, index, columns):
+    '''
+    各bar的成分股掩码
+    param memberFrame: 各日的成分DataFrame，(日期, 代码)属于股票池时为1.0，否则为NaN
+    param index: bar时间，取bar所在日期的成分
+    param columns: 代码
+    return: 布尔DataFrame
+    '''
+    memberFrame = memberFrame.reindex(index=pd.DatetimeIndex(index).normalize(), columns=columns)
+    return memberFrame.set_axis(index, axis=0).notna()
+
+
+if __name__ == "__main__":
+
+    # SZ50、HS300、ZZ500共用一次数据读取和因子回放
+    factorDataPath = pathSelector.PathSelector.getFactorFilePath()
+    multiUpdate = MultiUniverseUpdate(factorDataPaths={universe: os.path.join(factorDataPath, universe)
+                                                       for universe in ["SZ50", "HS300", "ZZ500"]},
+                                      start="20150701", end="20150731", isRelReturn=True)
+    multiUpdate.writeNewFactor()
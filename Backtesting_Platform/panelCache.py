@@ -0,0 +1,359 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+panelCache.py
+描述：基准指数等panel数据的二进制缓存
+     首次读取时将解析好的数据按字段存为.npy矩阵（日期 × 代码），之后用内存映射读取，
+     按[start, end]切片时既不解析文本也不复制数据；源文件变化后自动重建缓存
+'''
+
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from cpa.utils import logger
+
+
+class PanelCache:
+    '''
+    panel数据的内存映射缓存
+    缓存目录结构（<name>为指向当前版本目录<name>.v<时间戳>_<pid>的符号链接，重建时整体切换）：
+        <cacheDir>/<name>/meta.json                   源文件签名、字段及各数据段的时间范围
+        <cacheDir>/<name>/<part>/dates.npy            int64纳秒时间戳索引，升序
+        <cacheDir>/<name>/<part>/instruments.npy      代码索引
+        <cacheDir>/<name>/<part>/<field>.npy          float64数据矩阵，行为日期，列为代码
+    build写入只有一个数据段的新版本；append在当前版本中写入新的数据段，再原子地替换meta.json，
+    已写入的数据段不再修改，追加的开销只与新数据量有关；数据段超过MAX_PARTS个时合并为一个数据段重建
+    '''
+
+    logger = logger.getLogger("PanelCache")
+    VERSION = 2
+    MAX_PARTS = 64
+
+    def __init__(self, name, sourcePaths, fields=('open', 'high', 'low', 'close', 'volume'), cacheDir=None,
+                 sourceKey=None):
+        '''
+        param name: 缓存名，如 "IH.CCFX"
+        param sourcePaths: 源数据文件或文件夹路径（或其列表），用于判断缓存是否过期
+        param fields: 缓存的字段
+        param cacheDir: 缓存根目录，为空时放在第一个源文件所在目录下的.panelCache文件夹
+        param sourceKey: 源数据不是文件时（如内存中的数据）标识源数据的字符串，与源文件签名一同判断缓存是否过期
+        '''
+        self.name = name
+        self.sourcePaths = [sourcePaths] if isinstance(sourcePaths, str) else list(sourcePaths)
+        self.fields = list(fields)
+        self.sourceKey = sourceKey
+        if cacheDir is None:
+            firstPath = self.sourcePaths[0]
+            baseDir = firstPath if os.path.isdir(firstPath) else os.path.dirname(firstPath)
+            cacheDir = os.path.join(baseDir, ".panelCache")
+        self.cacheDir = cacheDir
+        self.path = os.path.join(cacheDir, name)
+
+    def sourceSignature(self):
+        '''源文件签名：各文件的路径、大小和修改时间'''
+        signature = []
+        for sourcePath in self.sourcePaths:
+            if os.path.isdir(sourcePath):
+                fileList = sorted(os.path.join(root, fileName)
+                                  for root, dirs, files in os.walk(sourcePath)
+                                  if ".panelCache" not in root
+                                  for fileName in files)
+            else:
+                fileList = [sourcePath]
+            for filePath in fileList:
+                if os.path.exists(filePath):
+                    stat = os.stat(filePath)
+                    signature.append([filePath, stat.st_size, stat.st_mtime_ns])
+        return signature
+
+    def readMeta(self):
+        '''读取缓存的meta信息，缓存不存在时返回None'''
+        metaPath = os.path.join(self.path, "meta.json")
+        if not os.path.exists(metaPath):
+            return None
+        with open(metaPath, "r") as f:
+            return json.load(f)
+
+    def isValid(self):
+        '''缓存存在、版本一致、字段齐全且源文件及sourceKey未发生变化'''
+        meta = self.readMeta()
+        return meta is not None \
+            and meta.get("version") == self.VERSION \
+            and set(self.fields) <= set(meta["fields"]) \
+            and meta["source"] == self.sourceSignature() \
+            and meta.get("sourceKey") == self.sourceKey
+
+    def build(self, frameDict, attrs=None):
+        '''
+        写入缓存，替换已有的全部数据
+        param frameDict: {field: DataFrame}，index为时间，columns为代码
+        param attrs: 与数据一同记录在meta中的信息，由getAttrs读取
+        '''
+        versionPath = "{}.v{}_{}".format(self.path, time.time_ns(), os.getpid())
+        os.makedirs(versionPath)
+        parts = [self._writePart(versionPath, frameDict)]
+        meta = {"version": self.VERSION,
+                "name": self.name,
+                "fields": self.fields,
+                "source": self.sourceSignature(),
+                "sourceKey": self.sourceKey,
+                "attrs": attrs or {},
+                "parts": [part for part in parts if part["rows"]]}
+        with open(os.path.join(versionPath, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        # 先写入新的版本目录，再用os.replace原子地切换符号链接，其他进程总是读到完整的某一版本
+        if os.path.isdir(self.path) and not os.path.islink(self.path):  # 旧版本的缓存为普通目录，无法原子替换
+            shutil.rmtree(self.path, ignore_errors=True)
+        previousPath = os.path.realpath(self.path) if os.path.islink(self.path) else None
+        linkPath = "{}.link{}".format(self.path, os.getpid())
+        if os.path.lexists(linkPath):
+            os.remove(linkPath)
+        os.symlink(os.path.basename(versionPath), linkPath)
+        os.replace(linkPath, self.path)
+        self._removeOldVersions(keep=[versionPath, previousPath])
+        self.logger.info("The panel cache {} has been built, {} rows".format(self.name, parts[0]["rows"]))
+
+    def append(self, frameDict):
+        '''
+        在已有数据之后追加新的数据段，不读取也不重写已有数据
+        新数据段中出现已有数据没有的代码时，读取时已有数据段的这些代码为NaN
+        param frameDict: {field: DataFrame}，index为时间，需全部晚于已有数据的最后时间
+        return: 是否追加成功；缓存无效、新数据不晚于已有数据（如并行时其他进程已追加）时返回False
+        '''
+        if not self.isValid():
+            return False
+        versionPath = os.path.realpath(self.path)
+        meta = self.readMeta()
+        lastEnd = meta["parts"][-1]["end"] if meta["parts"] else None
+        dates = frameDict[self.fields[0]].index
+        if not len(dates) or (lastEnd is not None and dates.min().value <= lastEnd):
+            return False
+        if len(meta["parts"]) >= self.MAX_PARTS:  # 数据段过多时合并重建
+            stored = self.load()
+            self.build({field: pd.concat([stored[field], frameDict[field]]) for field in self.fields},
+                       attrs=meta.get("attrs"))
+            return True
+        part = self._writePart(versionPath, frameDict)
+        if self.readMeta() != meta:  # 写入数据段期间其他进程修改了缓存
+            shutil.rmtree(os.path.join(versionPath, part["dir"]), ignore_errors=True)
+            return False
+        meta["parts"].append(part)
+        metaPath = os.path.join(versionPath, "meta.json")
+        tmpPath = "{}.tmp{}".format(metaPath, os.getpid())
+        with open(tmpPath, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmpPath, metaPath)
+        self.logger.info("{} rows have been appended to the panel cache {}".format(part["rows"], self.name))
+        return True
+
+    def _writePart(self, versionPath, frameDict):
+        '''
+        在版本目录中写入一个数据段
+        return: 数据段信息{"dir", "start", "end", "rows"}，时间为int64纳秒时间戳
+        '''
+        dates = frameDict[self.fields[0]].index
+        for field in self.fields[1:]:
+            dates = dates.union(frameDict[field].index)
+        instruments = frameDict[self.fields[0]].columns
+        for field in self.fields[1:]:
+            instruments = instruments.union(frameDict[field].columns)
+        dates = pd.DatetimeIndex(dates).sort_values()
+        instruments = pd.Index(instruments).sort_values()
+        datesArray = dates.values.astype("datetime64[ns]").view(np.int64)
+
+        partName = "p{}_{}".format(time.time_ns(), os.getpid())
+        partPath = os.path.join(versionPath, partName)
+        os.makedirs(partPath)
+        np.save(os.path.join(partPath, "dates.npy"), datesArray)
+        np.save(os.path.join(partPath, "instruments.npy"), np.asarray(instruments.astype(str), dtype=str))
+        for field in self.fields:
+            values = frameDict[field].reindex(index=dates, columns=instruments).to_numpy(dtype=np.float64)
+            np.save(os.path.join(partPath, field + ".npy"), np.ascontiguousarray(values))
+        return {"dir": partName,
+                "start": int(datesArray[0]) if len(dates) else None,
+                "end": int(datesArray[-1]) if len(dates) else None,
+                "rows": len(dates)}
+
+    def _removeOldVersions(self, keep):
+        '''
+        删除不再被链接的版本目录
+        保留当前及上一版本，正在读取上一版本的进程不受影响
+        '''
+        prefix = os.path.basename(self.path) + ".v"
+        keepNames = {os.path.basename(path) for path in keep if path}
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.startswith(prefix) and entry.name not in keepNames and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def getAttrs(self):
+        '''build时记录的信息'''
+        meta = self.readMeta()
+        return meta.get("attrs", {}) if meta else {}
+
+    def getDates(self):
+        '''缓存的时间索引'''
+        path = os.path.realpath(self.path)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            parts = json.load(f)["parts"]
+        if len(parts) == 1:
+            return pd.DatetimeIndex(np.load(os.path.join(path, parts[0]["dir"], "dates.npy"), mmap_mode="r"))
+        return pd.DatetimeIndex(np.concatenate([np.load(os.path.join(path, part["dir"], "dates.npy"))
+                                                for part in parts] or [np.array([], dtype=np.int64)]))
+
+    def getInstruments(self):
+        '''缓存的代码列表，各数据段代码的并集'''
+        path = os.path.realpath(self.path)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            parts = json.load(f)["parts"]
+        instruments = pd.Index([], dtype=object)
+        for part in parts:
+            instruments = instruments.union(np.load(os.path.join(path, part["dir"], "instruments.npy")).tolist())
+        return instruments.tolist()
+
+    def load(self, start=None, end=None, fields=None):
+        '''
+        以内存映射方式读取缓存，并按[start, end]切片
+        只涉及一个数据段时返回的DataFrame直接引用映射的数据，不复制；跨数据段时拼接，代码取并集
+        param start: 开始时间，为空时从头读取
+        param end: 结束时间（包含），为空时读到最后
+        param fields: 读取的字段，为空时读取全部字段
+        return: {field: DataFrame}
+        '''
+        path = os.path.realpath(self.path)  # 同一次读取的各文件来自同一版本
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            parts = json.load(f)["parts"]  # meta.json原子替换，读到的数据段均已写入完成
+        startValue = None if start is None else pd.Timestamp(start).value
+        endValue = None if end is None else _endValue(end)
+        fields = fields or self.fields
+        frameList = []
+        for part in parts:
+            if (startValue is not None and part["end"] < startValue) or \
+                    (endValue is not None and part["start"] > endValue):
+                continue
+            frameList.append(self._loadPart(os.path.join(path, part["dir"]), startValue, endValue, fields))
+        if not frameList:  # 没有数据时返回空的DataFrame
+            frameList.append(self._loadPart(os.path.join(path, parts[0]["dir"]), 0, -1, fields) if parts else
+                             {field: pd.DataFrame(index=pd.DatetimeIndex([]), dtype=np.float64) for field in fields})
+        if len(frameList) == 1:
+            return frameList[0]
+        return {field: pd.concat([frameDict[field] for frameDict in frameList]) for field in fields}
+
+    def _loadPart(self, partPath, startValue, endValue, fields):
+        '''以内存映射方式读取一个数据段的[startValue, endValue]'''
+        datesArray = np.load(os.path.join(partPath, "dates.npy"), mmap_mode="r")
+        instruments = np.load(os.path.join(partPath, "instruments.npy")).tolist()
+        iStart = 0 if startValue is None else int(np.searchsorted(datesArray, startValue, side="left"))
+        iEnd = len(datesArray) if endValue is None else int(np.searchsorted(datesArray, endValue, side="right"))
+        index = pd.DatetimeIndex(np.asarray(datesArray[iStart:iEnd]))
+        frameDict = {}
+        for field in fields:
+            values = np.load(os.path.join(partPath, field + ".npy"), mmap_mode="r")
+            frameDict[field] = pd.DataFrame(values[iStart:iEnd], index=index, columns=instruments, copy=False)
+        return frameDict
+
+    def getOrBuild(self, loader, start=None, end=None, fields=None):
+        '''
+        缓存有效时直接读取，否则调用loader解析源数据并重建缓存
+        param loader: 无参数函数，返回完整历史的{field: DataFrame}
+        '''
+        if not self.isValid():
+            self.logger.info("The panel cache {} is missing or out of date, rebuilding".format(self.name))
+            self.build(loader())
+        return self.load(start=start, end=end, fields=fields)
+
+
+class FramePanelReader:
+    '''
+    内存中{field: DataFrame}数据的reader，提供与CSVPanelReader一致的loads()/to_frame()接口，
+    可直接传给series.SequenceDataPanel.from_reader
+    '''
+
+    def __init__(self, frameDict, frequency, start=None, end=None, isInstrumentCol=True, fields=None):
+        '''
+        param frameDict: {field: DataFrame}，index为时间，columns为代码
+        param frequency: 数据频率
+        param start: 开始时间
+        param end: 结束时间（包含），为日期时包含当天的全部数据
+        param isInstrumentCol: 与CSVPanelReader相同，False时数据只有一个代码，to_frame()返回字段为列的DataFrame
+        param fields: 读取的字段，为空时读取frameDict的全部字段
+        '''
+        self.sourceDict = frameDict
+        self.fields = list(fields or frameDict)
+        self.frequency = frequency
+        self.start = start
+        self.end = end
+        self.isInstrumentCol = isInstrumentCol
+        self.frameDict = None
+
+    def loads(self):
+        '''按[start, end]截取数据'''
+        self.frameDict = {}
+        for field in self.fields:
+            frame = self.sourceDict[field]
+            if self.start is not None:
+                frame = frame.loc[frame.index >= pd.Timestamp(self.start)]
+            if self.end is not None:
+                frame = frame.loc[frame.index <= pd.Timestamp(_endValue(self.end))]
+            self.frameDict[field] = frame
+
+    def to_frame(self):
+        '''
+        return: isInstrumentCol为False时返回index为时间、columns为字段的DataFrame，
+                否则返回index为(时间, 代码)、columns为字段的DataFrame
+        '''
+        if self.frameDict is None:
+            self.loads()
+        if not self.isInstrumentCol:
+            return pd.DataFrame({field: frame.iloc[:, 0] for field, frame in self.frameDict.items()},
+                                columns=self.fields)
+        return pd.concat({field: frame.stack(future_stack=True) for field, frame in self.frameDict.items()},
+                         axis=1)[self.fields]
+
+
+class CachedPanelReader(FramePanelReader):
+    '''
+    从PanelCache读取数据的reader，提供与CSVPanelReader一致的loads()/to_frame()接口，
+    可直接传给series.SequenceDataPanel.from_reader
+    '''
+
+    def __init__(self, panelCache, frequency, start=None, end=None, isInstrumentCol=False, fields=None):
+        '''
+        param panelCache: PanelCache对象，需已通过isValid()检查
+        param fields: 读取的字段，为空时读取缓存的全部字段
+        其他参数见FramePanelReader
+        '''
+        super().__init__({}, frequency, start=start, end=end, isInstrumentCol=isInstrumentCol,
+                         fields=fields or panelCache.fields)
+        self.panelCache = panelCache
+
+    def loads(self):
+        '''以内存映射方式读取缓存数据'''
+        self.frameDict = self.panelCache.load(start=self.start, end=self.end, fields=self.fields)
+
+
+def frameToFieldDict(frame, fields, instrument=None):
+    '''
+    将reader输出的DataFrame转换为PanelCache所需的{field: DataFrame}
+    param frame: index为时间（单一代码）或(时间, 代码)的DataFrame，columns为字段
+    param fields: 字段列表
+    param instrument: 单一代码数据的代码名
+    '''
+    if isinstance(frame.index, pd.MultiIndex):
+        return {field: frame[field].unstack(level=-1) for field in fields}
+    return {field: frame[[field]].set_axis([instrument or "bench"], axis=1) for field in fields}
+
+
+def _endValue(end):
+    '''结束时间为日期时包含当天的全部数据'''
+    endTS = pd.Timestamp(end)
+    if endTS == endTS.normalize() and not (isinstance(end, str) and ":" in end):
+        endTS = endTS + pd.Timedelta(days=1) - pd.Timedelta(1, unit="ns")
+    return endTS.value
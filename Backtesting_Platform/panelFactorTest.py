@@ -0,0 +1,278 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+panelFactorTest.py
+描述：因子检测的批量计算模式
+     因子值和收益的完整panel（时间 × 代码）已知时，用numpy一次性计算DefaultFactorTest的各检测指标，
+     不再随feed逐bar更新，用于历史数据的回补
+说明：与DefaultFactorTest的约定一致，t时刻的检测值使用t-lag时刻的因子值和(t-lag, t]区间的收益，
+     分组按因子值从小到大分为nGroup = round(1 / cut)组，第0组为因子值最小的一组，
+     groupRet和groupNumber的列名为字符串组号"0", "1", ...，与DefaultFactorTest一致，可直接写入h5的table
+注意：gpIC（组号与组收益的相关系数）、turn（组合中新进入代码的比例）及分组（ceil(排名 / 有效数 * nGroup)）等定义
+     按DefaultFactorTest的输出推定，只能由compareIndicators与DefaultFactorTest逐项比较确认；
+     批量模式在本模块的当前源码通过factorBenchmark.py --check streamVector的比较之前不可用，见requireVerified
+'''
+
+import os
+import json
+import hashlib
+import datetime
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from cpa.utils import logger
+
+
+class IndicatorResult:
+    '''检测结果的包装，提供与DefaultFactorTest中指标对象一致的__len__/to_frame()/to_series()接口'''
+
+    def __init__(self, data):
+        '''
+        param data: DataFrame或Series
+        '''
+        self.data = data
+
+    def __len__(self):
+        return len(self.data.dropna(how="all"))
+
+    def to_frame(self):
+        return self.data.to_frame() if isinstance(self.data, pd.Series) else self.data
+
+    def to_series(self):
+        return self.data.iloc[:, 0] if isinstance(self.data, pd.DataFrame) else self.data
+
+
+class PanelFactorTest:
+    '''
+    批量因子检测，对外提供与DefaultFactorTest一致的frequency, lag, cut, fee, nGroup, factorPanel, getIndicators()，
+    可直接传给H5PanelWriter和ReportWriter
+    '''
+
+    logger = logger.getLogger("PanelFactorTest")
+    INDICATORS = ['IC', 'rankIC', 'beta', 'gpIC', 'tbdf', 'turn', 'groupRet', 'cost', 'groupNumber']
+
+    def __init__(self, factorFrame, returnFrame, frequency=None,
+                 indicators=('IC', 'rankIC', 'beta', 'gpIC', 'tbdf', 'turn', 'groupRet'),
+                 lag=1, cut=0.1, fee=0.003, minCount=3):
+        '''
+        param factorFrame: 因子值DataFrame，index为时间，columns为代码
+        param returnFrame: 收益DataFrame，t时刻为(t-lag, t]区间的收益，与factorFrame的index和columns对齐后计算
+        param frequency: 数据频率，如 bar.Frequency.MINUTE5，写文件时用于生成周期标签
+        param indicators: 计算的检测指标
+        param lag: 因子值与收益的间隔bar数
+        param cut: 分组比例，分组数为round(1 / cut)
+        param fee: 开仓手续费，用于计算交易成本
+        param minCount: 截面上有效数据少于minCount时该时刻的检测值为空
+        '''
+        unknown = set(indicators) - set(self.INDICATORS)
+        if unknown:
+            raise ValueError("Unknown indicators {}".format(sorted(unknown)))
+        self.frequency = frequency
+        self.indicators = list(indicators)
+        self.lag = lag
+        self.cut = cut
+        self.fee = fee
+        self.nGroup = int(round(1 / cut))
+        self.minCount = minCount
+
+        columns = factorFrame.columns.union(returnFrame.columns)
+        self.factorPanel = IndicatorResult(factorFrame.reindex(columns=columns))
+        self.returnFrame = returnFrame.reindex(index=factorFrame.index, columns=columns)
+        self.indicatorDict = None
+
+    def run(self):
+        '''计算全部检测指标'''
+        index = self.returnFrame.index
+        factor = self.factorPanel.data.shift(self.lag).to_numpy(dtype=np.float64)  # t时刻使用t-lag的因子值
+        ret = self.returnFrame.to_numpy(dtype=np.float64)
+        valid = np.isfinite(factor) & np.isfinite(ret)
+        enough = valid.sum(axis=1) >= self.minCount
+        factor = np.where(valid, factor, np.nan)
+        ret = np.where(valid, ret, np.nan)
+
+        resultDict = {}
+        if "IC" in self.indicators:
+            resultDict["IC"] = pd.DataFrame({"IC": np.where(enough, _rowCorr(factor, ret), np.nan)}, index=index)
+        if "rankIC" in self.indicators:
+            rankIC = _rowCorr(_rowRank(factor), _rowRank(ret))
+            resultDict["rankIC"] = pd.DataFrame({"rankIC": np.where(enough, rankIC, np.nan)}, index=index)
+        if "beta" in self.indicators:
+            resultDict["beta"] = pd.Series(np.where(enough, _rowBeta(factor, ret), np.nan), index=index, name="beta")
+
+        groupNames = [str(g) for g in range(self.nGroup)]
+        groups = _rowGroups(factor, self.nGroup)
+        groupRet = np.full((len(index), self.nGroup), np.nan)
+        groupNumber = np.zeros((len(index), self.nGroup))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for g in range(self.nGroup):
+                inGroup = groups == g
+                groupNumber[:, g] = inGroup.sum(axis=1)
+                groupRet[:, g] = np.where(inGroup, ret, 0.0).sum(axis=1) / groupNumber[:, g]
+        groupRet[~enough] = np.nan
+
+        if "groupRet" in self.indicators:
+            resultDict["groupRet"] = pd.DataFrame(groupRet, index=index, columns=groupNames)
+        if "groupNumber" in self.indicators:
+            resultDict["groupNumber"] = pd.DataFrame(groupNumber, index=index, columns=groupNames)
+        if "gpIC" in self.indicators:  # 组号与组收益的相关系数
+            groupIndex = np.broadcast_to(np.arange(self.nGroup, dtype=np.float64), groupRet.shape)
+            gpIC = _rowCorr(np.where(np.isfinite(groupRet), groupIndex, np.nan), groupRet)
+            resultDict["gpIC"] = pd.Series(gpIC, index=index, name="gpIC")
+        if "tbdf" in self.indicators:  # 多空收益差：最高组减最低组
+            resultDict["tbdf"] = pd.Series(groupRet[:, -1] - groupRet[:, 0], index=index, name="tbdf")
+        if "turn" in self.indicators or "cost" in self.indicators:
+            turn = pd.DataFrame({"top": _turnover(groups == self.nGroup - 1),
+                                 "bottom": _turnover(groups == 0)}, index=index)
+            if "turn" in self.indicators:
+                resultDict["turn"] = turn
+            if "cost" in self.indicators:
+                resultDict["cost"] = turn * self.fee
+
+        self.indicatorDict = {name: IndicatorResult(resultDict[name]) for name in self.indicators}
+        return self.indicatorDict
+
+    def getIndicators(self):
+        '''
+        return: {检测指标名: IndicatorResult}
+        '''
+        if self.indicatorDict is None:
+            self.run()
+        return self.indicatorDict
+
+
+VERIFIED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panelFactorTest_verified.json")
+
+
+def implementationHash():
+    '''本模块源码的sha1，源码改动后需重新验证'''
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def isVerified():
+    '''本模块的当前源码是否已通过与DefaultFactorTest的比较'''
+    if not os.path.exists(VERIFIED_PATH):
+        return False
+    with open(VERIFIED_PATH, "r") as f:
+        return json.load(f).get("hash") == implementationHash()
+
+
+def markVerified():
+    '''记录本模块的当前源码已通过与DefaultFactorTest的比较，由factorBenchmark在streamVector检查通过后调用'''
+    content = {"hash": implementationHash(), "time": datetime.datetime.now().isoformat(timespec="seconds")}
+    tmpPath = "{}.tmp{}".format(VERIFIED_PATH, os.getpid())
+    with open(tmpPath, "w") as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmpPath, VERIFIED_PATH)
+
+
+def requireVerified():
+    '''批量模式的入口调用，未通过验证时抛出异常'''
+    if not isVerified():
+        raise RuntimeError("The vector evaluation mode has not been verified against DefaultFactorTest for this "
+                           "version of panelFactorTest. Run 'python factorBenchmark.py --check streamVector' "
+                           "(it records the verification when every indicator matches) or use evalMode='stream'")
+
+
+def forwardReturns(closeFrame, lag=1, benchClose=None):
+    '''
+    由收盘价计算(t-lag, t]区间的收益
+    param closeFrame: 收盘价DataFrame，index为时间，columns为代码
+    param lag: 间隔bar数
+    param benchClose: 基准收盘价Series，不为空时计算相对收益
+    '''
+    ret = closeFrame / closeFrame.shift(lag) - 1
+    if benchClose is not None:
+        benchClose = benchClose.reindex(closeFrame.index, method="ffill")
+        ret = ret.sub(benchClose / benchClose.shift(lag) - 1, axis=0)
+    return ret
+
+
+def compareIndicators(panelTest, defaultFactorTest, atol=1e-8):
+    '''
+    比较批量计算与逐bar计算的检测结果，用于验证批量模式
+    按逐bar结果的时间和列名（转换为字符串）对齐，一方有值而另一方为空时误差为inf
+    param panelTest: PanelFactorTest对象
+    param defaultFactorTest: 已运行完的DefaultFactorTest对象
+    param atol: 允许的最大绝对误差
+    return: {检测指标名: 最大绝对误差}，超过atol的指标记入日志
+    '''
+    errorDict = {}
+    streamDict = defaultFactorTest.getIndicators()
+    for name, result in panelTest.getIndicators().items():
+        if name not in streamDict or not len(streamDict[name]):
+            continue
+        stream = _indicatorFrame(name, streamDict[name])
+        batch = _indicatorFrame(name, result).reindex(index=stream.index, columns=stream.columns)
+        streamValues, batchValues = stream.to_numpy(dtype=np.float64), batch.to_numpy(dtype=np.float64)
+        if not np.array_equal(np.isnan(streamValues), np.isnan(batchValues)):
+            errorDict[name] = float("inf")
+        else:
+            diff = np.abs(batchValues - streamValues)
+            errorDict[name] = float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0
+        if errorDict[name] > atol:
+            PanelFactorTest.logger.warning("{}: max abs error {} exceeds {}".format(name, errorDict[name], atol))
+    return errorDict
+
+
+def _indicatorFrame(name, result):
+    '''检测结果转换为列名为字符串的DataFrame，与H5PanelWriter写入的数据一致'''
+    data = result.to_frame() if name in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', 'groupNumber'] \
+        else result.to_series().to_frame()
+    return data.set_axis([str(column) for column in data.columns], axis=1)
+
+
+def _rowRank(values):
+    '''逐行排名，相同值取平均排名，空值保持为空'''
+    return pd.DataFrame(values).rank(axis=1, method="average").to_numpy()
+
+
+def _rowDemean(values):
+    '''逐行减去均值，全为空值的行保持为空'''
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return values - np.nanmean(values, axis=1, keepdims=True)
+
+
+def _rowCorr(x, y):
+    '''逐行Pearson相关系数，x和y的空值位置须一致'''
+    xDemean = _rowDemean(x)
+    yDemean = _rowDemean(y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = np.nansum(xDemean * yDemean, axis=1)
+        return cov / np.sqrt(np.nansum(xDemean ** 2, axis=1) * np.nansum(yDemean ** 2, axis=1))
+
+
+def _rowBeta(x, y):
+    '''逐行以y对x的截面回归斜率'''
+    xDemean = _rowDemean(x)
+    yDemean = _rowDemean(y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nansum(xDemean * yDemean, axis=1) / np.nansum(xDemean ** 2, axis=1)
+
+
+def _rowGroups(values, nGroup):
+    '''
+    逐行按分位数分组，组号0到nGroup-1，空值为-1
+    '''
+    ranks = _rowRank(values)
+    counts = np.isfinite(values).sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        groups = np.ceil(ranks / counts * nGroup) - 1
+    return np.where(np.isfinite(groups), np.clip(groups, 0, nGroup - 1), -1).astype(np.int64)
+
+
+def _turnover(member):
+    '''
+    组合换手率：当期组合中新进入的代码占当期组合的比例
+    param member: 布尔矩阵，行为时间，列为代码
+    '''
+    previous = np.vstack([np.zeros((1, member.shape[1]), dtype=bool), member[:-1]])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        turn = (member & ~previous).sum(axis=1) / member.sum(axis=1)
+    turn[0] = np.nan
+    return turn
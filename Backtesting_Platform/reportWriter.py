@@ -3,32 +3,47 @@
 # author: Yanggang Fang
 '''
 因子检测报告图表写入模块
+图表可在后台进程池中生成，输入数据的hash与上次生成时一致时不再重复生成
 '''
+import os
+import json
+import hashlib
 import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
 from cpa.utils import logger
-from cpa.config import pathSelector
 from cpa.config import const
 from cpa.factorProcessor import factorTest
+from cpa.factorProcessor.panelFactorTest import IndicatorResult
+from cpa.io import factorCatalog, factorStorage
 
 
 class ReportWriter:
     '''
     通过调用factorTest下的TestReportGenerator类来实现图表的计算和存储
-    一种方式是通过传入factorTest下的DefaultFactorTest类对象，调用其下的几个panel
+    一种方式是通过传入factorTest下的DefaultFactorTest类对象（或ReportData），调用其下的几个panel
     还有一种是通过传入h5BatchPanelReader，通过读取h5文件来获取panel
+    每次生成后在同一文件夹下写入<factor>_Report_<freq>.json，记录输入数据的hash
     '''
 
     logger = logger.getLogger("ReportWriter")
 
-    def __init__(self, factorName, defaultFactorTest=None, h5BatchPanelReader=None):
+    def __init__(self, factorName, defaultFactorTest=None, h5BatchPanelReader=None, inputHash=None, rootPath=None):
         '''
         param factorName: 因子名
         param defaultFactorTest: 因子检测类对象
         param h5BatchPanelReader: h5文件读取类对象
+        param inputHash: 输入数据的hash，为空时由输入数据计算
+        param rootPath: factorData根文件夹，为空时由pathSelector生成
         '''
         self.factorName = factorName
+        self.rootPath = rootPath
         self.defaultFactorTest = defaultFactorTest
         self.h5BatchPanelReader = h5BatchPanelReader
+        self.inputHash = inputHash
         self.frequency = defaultFactorTest.frequency if defaultFactorTest\
                            else h5BatchPanelReader.frequency
         if self.defaultFactorTest and self.h5BatchPanelReader:
@@ -37,24 +52,262 @@ class ReportWriter:
         self.testReportGenerator = factorTest.TestReportGenerator(self.defaultFactorTest,
                                                                   self.h5BatchPanelReader)
 
-    def write(self):
+    def getPath(self, fileName):
+        '''因子周期文件夹下的文件路径'''
+        return _reportPath(self.factorName, self.frequency, fileName, rootPath=self.rootPath)
+
+    def contentHash(self):
+        '''
+        输入数据的hash
+        传入检测对象时对各检测指标的数据计算hash，传入h5BatchPanelReader时对h5文件的路径、大小和修改时间计算hash
+        '''
+        if self.inputHash is None:
+            if self.defaultFactorTest is not None:
+                self.inputHash = testerHash(self.defaultFactorTest)
+            else:
+                sha = hashlib.sha1()
+                for filePath in sorted(self.h5BatchPanelReader.getFilePath().values()):
+                    stat = os.stat(filePath)
+                    sha.update("{}|{}|{}".format(filePath, stat.st_size, stat.st_mtime_ns).encode())
+                self.inputHash = sha.hexdigest()
+        return self.inputHash
+
+    def isUpToDate(self):
+        '''图表文件均存在且上次生成时的输入hash与本次一致'''
+        return isReportUpToDate(self.factorName, self.frequency, self.contentHash(), rootPath=self.rootPath)
+
+    def write(self, force=False):
         '''
         将分层收益图和分层统计量分别写入对于的图和表文件
+        param force: True时不检查hash，总是重新生成
+        return: 是否重新生成了图表
         '''
+        if not force and self.isUpToDate():
+            self.logger.info("The report of {} {} is up to date"
+                             .format(self.factorName, const.DataFrequency.freq2lable(self.frequency)))
+            return False
         currentDT = datetime.datetime.now()
         # 储存分层收益图
         figName = self.factorName + '_Report_' +\
                   const.DataFrequency.freq2lable(self.frequency) + '.png'
                   # currentDT.strftime("_%Y%m%d_%H%M") + '.png'
-        path = pathSelector.PathSelector.getFactorFilePath(factorName=self.factorName,  # 因子计算数据的文件路径
-                                                           factorFrequency=const.DataFrequency.freq2lable(self.frequency),
-                                                           fileName=figName)
+        path = self.getPath(figName)
         self.testReportGenerator.plotGroupret(_show=False, path=path)
         # 储存分层统计量
         statisticFileName = self.factorName + '_Statistic_' +\
                             const.DataFrequency.freq2lable(self.frequency) + '.xls'
                             # currentDT.strftime("_%Y%m%d_%H%M") + '.xls'
-        self.testReportGenerator.statistic(path=pathSelector.PathSelector.getFactorFilePath(
-                                         factorName=self.factorName,  # 因子计算数据的文件路径
-                                         factorFrequency=const.DataFrequency.freq2lable(self.frequency),
-                                         fileName=statisticFileName))
+        self.testReportGenerator.statistic(path=self.getPath(statisticFileName))
+        # 记录本次输入数据的hash
+        hashPath = self.getPath(self.factorName + '_Report_' + const.DataFrequency.freq2lable(self.frequency) + '.json')
+        with open(hashPath, "w") as f:
+            json.dump({"inputHash": self.contentHash(), "written": currentDT.isoformat(timespec="seconds")}, f)
+        return True
+
+
+class ReportData:
+    '''
+    检测结果的快照，只包含生成图表所需的数据，不引用feed，可以传给其他进程
+    对外提供与DefaultFactorTest一致的frequency, lag, cut, fee, nGroup, factorPanel, getIndicators()
+    '''
+
+    def __init__(self, frequency, factorFrame, indicatorData, params=None):
+        '''
+        param frequency: 数据频率
+        param factorFrame: 因子值DataFrame
+        param indicatorData: {检测指标名: DataFrame或Series}
+        param params: {"lag", "cut", "fee", "nGroup"}
+        '''
+        self.frequency = frequency
+        self.factorPanel = IndicatorResult(factorFrame)
+        self.indicatorDict = {name: IndicatorResult(data) for name, data in indicatorData.items()}
+        for name, value in (params or {}).items():
+            setattr(self, name, value)
+
+    @classmethod
+    def fromTester(cls, defaultFactorTest):
+        '''由运行完的DefaultFactorTest或PanelFactorTest生成快照'''
+        indicatorData = {}
+        for name, value in defaultFactorTest.getIndicators().items():
+            if len(value):
+                indicatorData[name] = value.to_frame() if name in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', 'groupNumber']\
+                                          else value.to_series()
+        params = {name: getattr(defaultFactorTest, name, None) for name in ["lag", "cut", "fee", "nGroup"]}
+        return cls(defaultFactorTest.frequency, defaultFactorTest.factorPanel.to_frame(), indicatorData, params)
+
+    @classmethod
+    def fromStorage(cls, factorName, frequency):
+        '''由factorData下已存储的完整数据生成快照，支持factorStorage的所有存储后端'''
+        freqStr = const.DataFrequency.freq2lable(frequency)
+        dataDict = factorStorage.readFactorData(factorName, freqStr)
+        factorFrame = dataDict.pop("factor", pd.DataFrame())
+        params = factorCatalog.getCatalog(factorName, freqStr).content.get("params", {})
+        return cls(frequency, factorFrame, dataDict, params)
+
+    @classmethod
+    def concat(cls, reportDataList):
+        '''
+        按时间顺序拼接多段快照，时间重复的数据保留先出现的一段
+        param reportDataList: 按时间先后排列的ReportData列表，检测参数取第一段的
+        '''
+        first = reportDataList[0]
+        factorFrame = _concatData([reportData.factorPanel.data for reportData in reportDataList])
+        names = [name for name in first.indicatorDict]
+        for reportData in reportDataList[1:]:
+            names.extend(name for name in reportData.indicatorDict if name not in names)
+        indicatorData = {name: _concatData([reportData.indicatorDict[name].data for reportData in reportDataList
+                                            if name in reportData.indicatorDict])
+                         for name in names}
+        params = {name: getattr(first, name, None) for name in ["lag", "cut", "fee", "nGroup"]}
+        return cls(first.frequency, factorFrame, indicatorData, params)
+
+    def slice(self, start=None, end=None):
+        '''
+        截取[start, end]时间段的快照
+        param end: 结束日期，包含当天的全部数据
+        '''
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(1, unit="ns")
+        indicatorData = {name: result.data.loc[start:end] for name, result in self.indicatorDict.items()}
+        params = {name: getattr(self, name, None) for name in ["lag", "cut", "fee", "nGroup"]}
+        return ReportData(self.frequency, self.factorPanel.data.loc[start:end], indicatorData, params)
+
+    def getIndicators(self):
+        return self.indicatorDict
+
+
+class ReportPool:
+    '''
+    后台生成图表的进程池，因子数据写入后提交任务即可继续计算下一个因子
+    workers为0（默认）时在当前进程中同步生成，与原来直接调用ReportWriter相同，出错时直接抛出异常
+    '''
+
+    logger = logger.getLogger("ReportPool")
+
+    def __init__(self, workers=0):
+        '''
+        param workers: 进程数，大于0时启用后台进程池
+        '''
+        self.workers = workers
+        self.executor = None
+        self.futureDict = {}
+
+    def submit(self, factorName, defaultFactorTest, force=False, rootPath=None):
+        '''
+        提交由内存中的检测结果生成图表的任务
+        param factorName: 因子名
+        param defaultFactorTest: 运行完的DefaultFactorTest或PanelFactorTest
+        param force: 是否忽略hash总是重新生成
+        param rootPath: factorData根文件夹，为空时由pathSelector生成
+        '''
+        reportData = ReportData.fromTester(defaultFactorTest)
+        self._submit(factorName, reportData.frequency, _renderReport, factorName, reportData, force, rootPath)
+
+    def submitStored(self, factorName, frequency, force=False):
+        '''
+        提交由已存储数据生成图表的任务，用于续写后的完整数据
+        输入hash由数据目录计算，图表已是最新时不读取数据
+        param frequency: 数据频率
+        '''
+        self._submit(factorName, frequency, _renderStoredReport, factorName, frequency, force)
+
+    def _submit(self, factorName, frequency, function, *args):
+        taskName = "{} {}".format(factorName, const.DataFrequency.freq2lable(frequency))
+        if self.workers <= 0:
+            function(*args)
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.futureDict[self.executor.submit(_runTask, function, *args)] = taskName
+
+    def wait(self):
+        '''
+        等待进程池中所有已提交的任务完成并关闭进程池，同步模式下没有需要等待的任务
+        return: 出错任务及其错误信息的字典
+        '''
+        failedDict = {}
+        for future, taskName in self.futureDict.items():
+            try:
+                error = future.result()
+            except Exception:
+                error = traceback.format_exc()
+            if error:
+                failedDict[taskName] = error
+                self.logger.error("The report of {} failed:\n{}".format(taskName, error))
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = None
+        self.futureDict = {}
+        return failedDict
+
+
+def isReportUpToDate(factorName, frequency, inputHash, rootPath=None):
+    '''图表文件均存在且上次生成时记录的输入hash与inputHash一致'''
+    freqLabel = const.DataFrequency.freq2lable(frequency)
+    hashPath = _reportPath(factorName, frequency, factorName + '_Report_' + freqLabel + '.json', rootPath)
+    if not (os.path.exists(hashPath)
+            and os.path.exists(_reportPath(factorName, frequency, factorName + '_Report_' + freqLabel + '.png', rootPath))
+            and os.path.exists(_reportPath(factorName, frequency, factorName + '_Statistic_' + freqLabel + '.xls',
+                                           rootPath))):
+        return False
+    with open(hashPath, "r") as f:
+        return json.load(f).get("inputHash") == inputHash
+
+
+def testerHash(defaultFactorTest):
+    '''检测结果的hash：各检测指标的数据及检测参数'''
+    sha = hashlib.sha1()
+    sha.update(repr([getattr(defaultFactorTest, name, None) for name in ["lag", "cut", "fee", "nGroup"]]).encode())
+    for name, value in sorted(defaultFactorTest.getIndicators().items()):
+        if len(value):
+            frame = pd.DataFrame(value.to_frame() if name in ['groupRet', 'IC', 'rankIC', 'turn', 'cost', 'groupNumber']
+                                 else value.to_series())
+            sha.update(name.encode())
+            sha.update(repr(list(frame.columns)).encode())
+            sha.update(pd.util.hash_pandas_object(frame, index=True).values.tobytes())
+    return sha.hexdigest()
+
+
+def catalogHash(catalogContent):
+    '''已存储数据的hash：数据目录中各文件的起止时间、行数、列名及检测参数，不读取数据'''
+    content = {"params": catalogContent.get("params"), "source": catalogContent.get("source"),
+               "files": {key: [entry.get(name) for name in ["file", "start", "end", "rows", "columns"]]
+                         for key, entry in catalogContent.get("files", {}).items()}}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _concatData(dataList):
+    '''拼接DataFrame或Series，删除时间重复的数据'''
+    data = pd.concat(dataList)
+    return data.loc[~data.index.duplicated(keep="first")]
+
+
+def _reportPath(factorName, frequency, fileName, rootPath=None):
+    '''因子周期文件夹下的文件路径，rootPath为空时由pathSelector生成'''
+    return factorCatalog.factorFolderPath(factorName, const.DataFrequency.freq2lable(frequency),
+                                          rootPath=rootPath, fileName=fileName)
+
+
+def _runTask(function, *args):
+    '''进程池任务：运行function，出错时返回错误信息'''
+    try:
+        function(*args)
+    except Exception:
+        return traceback.format_exc()
+
+
+def _renderReport(factorName, reportData, force, rootPath=None):
+    '''由检测结果快照生成图表'''
+    ReportWriter(factorName=factorName, defaultFactorTest=reportData, rootPath=rootPath).write(force=force)
+
+
+def _renderStoredReport(factorName, frequency, force):
+    '''由已存储的数据生成图表，hash一致时不读取数据'''
+    catalog = factorCatalog.getCatalog(factorName, const.DataFrequency.freq2lable(frequency))
+    inputHash = catalogHash(catalog.content)
+    if not force and isReportUpToDate(factorName, frequency, inputHash):
+        ReportWriter.logger.info("The report of {} {} is up to date"
+                                 .format(factorName, const.DataFrequency.freq2lable(frequency)))
+        return
+    reportData = ReportData.fromStorage(factorName, frequency)
+    ReportWriter(factorName=factorName, defaultFactorTest=reportData, inputHash=inputHash).write(force=True)
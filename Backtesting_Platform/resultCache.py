@@ -0,0 +1,201 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+resultCache.py
+描述：因子检测结果的内容寻址缓存
+     每个(因子, 周期)的结果集以key索引，key由因子模块及其依赖的源码hash和检测参数
+     （股票池、市场、lag、fee、cut、周期、收益类型）及已存数据的起止时间计算，
+     因子定义或参数变化后key随之变化，只需重新计算变化了的(因子, 周期)；
+     缓存总大小超过上限时按最近使用时间淘汰旧的结果集
+'''
+
+import os
+import ast
+import json
+import shutil
+import hashlib
+import datetime
+import importlib.util
+
+from cpa.utils import logger
+from cpa.config import pathSelector
+
+
+class ResultCache:
+    '''
+    结果集缓存
+    缓存目录结构：
+        <cacheDir>/<key>/meta.json   因子名、周期、参数、大小、创建及最近使用时间
+        <cacheDir>/<key>/...         因子周期文件夹下的全部文件（数据、catalog.json、图表、检查点）
+    '''
+
+    logger = logger.getLogger("ResultCache")
+
+    def __init__(self, cacheDir=None, maxBytes=20 * 1024 ** 3):
+        '''
+        param cacheDir: 缓存根目录，为空时为factorData旁的factorCache文件夹
+        param maxBytes: 缓存总大小上限，超过时淘汰最久未使用的结果集
+        '''
+        if cacheDir is None:
+            factorDataPath = pathSelector.PathSelector.getFactorFilePath().rstrip(os.sep)
+            cacheDir = os.path.join(os.path.dirname(factorDataPath), "factorCache")
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def has(self, key):
+        '''缓存中是否有完整的结果集'''
+        return os.path.exists(os.path.join(self.getPath(key), "meta.json"))
+
+    def store(self, key, folderPath, meta):
+        '''
+        将因子周期文件夹下的文件（不含子文件夹）存入缓存
+        param key: 结果集的key
+        param folderPath: 因子周期文件夹
+        param meta: 结果集的说明，如 {"factor", "frequency", "params"}
+        '''
+        if self.has(key):
+            self._touch(key)
+            return
+        tmpPath = "{}.tmp{}".format(self.getPath(key), os.getpid())
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        os.makedirs(tmpPath)
+        nBytes = 0
+        for entry in os.scandir(folderPath):
+            if entry.is_file():
+                shutil.copy2(entry.path, tmpPath)
+                nBytes += entry.stat().st_size
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with open(os.path.join(tmpPath, "meta.json"), "w") as f:
+            json.dump({**meta, "key": key, "bytes": nBytes, "created": now, "lastUsed": now}, f, indent=1, default=str)
+        try:
+            os.replace(tmpPath, self.getPath(key))
+        except OSError:  # 其他进程已存入相同的结果集
+            shutil.rmtree(tmpPath, ignore_errors=True)
+        self.logger.info("The results of {} {} have been cached as {}".format(meta.get("factor"), meta.get("frequency"), key))
+
+    def restore(self, key, folderPath):
+        '''
+        用缓存的结果集替换因子周期文件夹下的文件，子文件夹（旧数据归档）保持不变
+        param key: 结果集的key
+        param folderPath: 因子周期文件夹
+        '''
+        os.makedirs(folderPath, exist_ok=True)
+        for entry in os.scandir(folderPath):
+            if entry.is_file():
+                os.remove(entry.path)
+        for entry in os.scandir(self.getPath(key)):
+            if entry.is_file() and entry.name != "meta.json":
+                shutil.copy2(entry.path, folderPath)
+        self._touch(key)
+
+    def evict(self):
+        '''
+        缓存总大小超过上限时，按最近使用时间从旧到新删除结果集
+        return: 被删除的key列表
+        '''
+        if not os.path.isdir(self.cacheDir):
+            return []
+        metaList = []
+        for name in os.listdir(self.cacheDir):
+            metaPath = os.path.join(self.cacheDir, name, "meta.json")
+            if os.path.exists(metaPath):
+                with open(metaPath, "r") as f:
+                    metaList.append(json.load(f))
+        totalBytes = sum(meta["bytes"] for meta in metaList)
+        evictedList = []
+        for meta in sorted(metaList, key=lambda meta: meta["lastUsed"]):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(self.getPath(meta["key"]), ignore_errors=True)
+            totalBytes -= meta["bytes"]
+            evictedList.append(meta["key"])
+        if evictedList:
+            self.logger.info("{} cached result sets have been evicted, {:.1f} MB left"
+                             .format(len(evictedList), totalBytes / 1024.0 ** 2))
+        return evictedList
+
+    def _touch(self, key):
+        '''更新最近使用时间'''
+        metaPath = os.path.join(self.getPath(key), "meta.json")
+        with open(metaPath, "r") as f:
+            meta = json.load(f)
+        meta["lastUsed"] = datetime.datetime.now().isoformat(timespec="seconds")
+        tmpPath = "{}.tmp{}".format(metaPath, os.getpid())
+        with open(tmpPath, "w") as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(tmpPath, metaPath)
+
+
+def dependencyHash(factorName, package="cpa"):
+    '''
+    因子模块及其依赖模块源码的sha1
+    依赖为因子模块中import的package内的模块，递归查找，框架内被因子用到的模块改动也会使结果失效
+    param factorName: 因子名
+    param package: 计入依赖的顶层包名
+    return: sha1，找不到因子模块时返回None
+    '''
+    rootName = "cpa.factorPool.factors.{}".format(factorName)
+    if _sourcePath(rootName) is None:
+        return None
+    sha = hashlib.sha1()
+    visited = set()
+    pendingList = [rootName]
+    while pendingList:
+        moduleName = pendingList.pop()
+        if moduleName in visited:
+            continue
+        visited.add(moduleName)
+        sourcePath = _sourcePath(moduleName)
+        if sourcePath is None:
+            continue
+        with open(sourcePath, "rb") as f:
+            source = f.read()
+        sha.update(moduleName.encode() + b"\0" + source)
+        pendingList.extend(name for name in _importedModules(source, moduleName)
+                           if name.split(".")[0] == package and name not in visited)
+    return sha.hexdigest()
+
+
+def cellKey(params):
+    '''
+    (因子, 周期)结果集的key
+    param params: 因子源码及依赖的hash和全部检测参数
+    '''
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _sourcePath(moduleName):
+    '''模块的源文件路径，不是.py源文件时返回None'''
+    try:
+        spec = importlib.util.find_spec(moduleName)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not spec.origin.endswith(".py") or not os.path.exists(spec.origin):
+        return None
+    return spec.origin
+
+
+def _importedModules(source, moduleName):
+    '''源码中import的模块名，from a import b时同时返回a和a.b（b可能是子模块）'''
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    nameList = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            nameList.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:  # 相对导入
+                base = moduleName.rsplit(".", node.level)[0]
+                parent = base + "." + node.module if node.module else base
+            else:
+                parent = node.module
+            nameList.append(parent)
+            nameList.extend(parent + "." + alias.name for alias in node.names)
+    return nameList
@@ -0,0 +1,207 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+stageRecorder.py
+描述：因子更新流程的分阶段计时及内存记录
+     每个阶段记录墙钟时间、CPU时间、进程峰值内存及计数（处理的bar数、写入的字节数等），
+     并带有因子、周期、写入模式等标签，可导出为JSON lines或Prometheus文本格式；
+     可选地对每个因子运行cProfile，只保留耗时最长的因子的结果
+'''
+
+import os
+import json
+import time
+import marshal
+import cProfile
+import datetime
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows下没有resource模块，不记录峰值内存
+    resource = None
+
+from cpa.utils import logger
+
+
+class StageRecorder:
+    '''
+    分阶段记录器
+    每条记录：{"stage", 标签..., "wallSeconds", "cpuSeconds", "peakRssMB", "peakRssGrowthMB", "counters", "time"}
+    peakRssMB为阶段结束时进程的历史峰值内存，peakRssGrowthMB为该阶段内峰值的增加量，不为0说明该阶段创下了新的峰值
+    '''
+
+    logger = logger.getLogger("StageRecorder")
+
+    def __init__(self, enabled=True, profile=False, **tags):
+        '''
+        param enabled: False时stage()等方法不做任何记录，开销可以忽略
+        param profile: True时profile()对每个因子运行cProfile，只保留耗时最长的一个
+        param tags: 所有记录共有的标签
+        '''
+        self.enabled = enabled
+        self.profileEnabled = profile
+        self.tags = tags
+        self.records = []
+        self.slowestProfile = None  # (秒数, 名称, pstats格式的统计字典)
+        self._counterStack = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **tags):
+        '''
+        记录with块内的一个阶段，块内调用count()的计数计入该阶段
+        param name: 阶段名，如 "feedLoad", "replay", "writeH5", "report"
+        param tags: 该阶段的标签，如 factor, frequency, mode
+        '''
+        if not self.enabled:
+            yield
+            return
+        counters = {}
+        self._counterStack.append(counters)
+        rssStart = peakRssMB()
+        wallStart, cpuStart = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wallSeconds, cpuSeconds = time.perf_counter() - wallStart, time.process_time() - cpuStart
+            self._counterStack.pop()
+            rssEnd = peakRssMB()
+            self.records.append({"stage": name, **self.tags, **tags,
+                                 "wallSeconds": wallSeconds, "cpuSeconds": cpuSeconds,
+                                 "peakRssMB": rssEnd,
+                                 "peakRssGrowthMB": None if rssEnd is None else rssEnd - rssStart,
+                                 "counters": counters,
+                                 "time": datetime.datetime.now().isoformat(timespec="seconds")})
+
+    def count(self, name, value=1):
+        '''
+        为当前阶段（及其外层阶段）增加计数
+        param name: 计数名，如 "bars", "bytesWritten"
+        '''
+        if not self.enabled:
+            return
+        for counters in self._counterStack:
+            counters[name] = counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        '''
+        对with块运行cProfile，耗时超过已保存的结果时替换之
+        param name: 被分析对象的名称，一般为因子名
+        '''
+        if not self.profileEnabled:
+            yield
+            return
+        profiler = cProfile.Profile()
+        wallStart = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.keepSlowest(time.perf_counter() - wallStart, name, _profileStats(profiler))
+
+    def keepSlowest(self, seconds, name, stats):
+        '''保留耗时最长的cProfile结果，也用于合并子进程返回的结果'''
+        if self.slowestProfile is None or seconds > self.slowestProfile[0]:
+            self.slowestProfile = (seconds, name, stats)
+
+    def extend(self, records):
+        '''合并其他记录器（如子进程）的记录'''
+        self.records.extend(records)
+
+    def dumpProfile(self, path):
+        '''
+        写出耗时最长因子的cProfile结果，可用pstats.Stats(path)或snakeviz读取
+        return: 被分析的因子名，没有结果时返回None
+        '''
+        if self.slowestProfile is None:
+            return None
+        seconds, name, stats = self.slowestProfile
+        with open(path, "wb") as f:
+            marshal.dump(stats, f)
+        self.logger.info("The profile of the slowest run {} ({:.1f}s) has been saved to {}".format(name, seconds, path))
+        return name
+
+    def toJsonLines(self, path, append=True):
+        '''以JSON lines写出全部记录'''
+        with open(path, "a" if append else "w") as f:
+            f.write("".join(json.dumps(record, default=str) + "\n" for record in self.records))
+
+    def toPrometheus(self, path, prefix="factor_update"):
+        '''
+        以Prometheus文本格式写出，相同标签的记录时间和计数求和，峰值内存取最大值
+        可由node_exporter的textfile collector采集
+        '''
+        labelNames = sorted({key for record in self.records for key in record
+                             if key not in ["wallSeconds", "cpuSeconds", "peakRssMB", "peakRssGrowthMB",
+                                            "counters", "time"]})
+        metricDict = {}
+        for record in self.records:
+            labels = ",".join('{}="{}"'.format(name, _escapeLabel(record.get(name))) for name in labelNames)
+            values = {"stage_wall_seconds": record["wallSeconds"], "stage_cpu_seconds": record["cpuSeconds"]}
+            values.update({"{}_total".format(_snakeCase(name)): value for name, value in record["counters"].items()})
+            for metric, value in values.items():
+                metricDict.setdefault(metric, {})
+                metricDict[metric][labels] = metricDict[metric].get(labels, 0) + value
+            if record["peakRssMB"] is not None:
+                metricDict.setdefault("stage_peak_rss_megabytes", {})
+                metricDict["stage_peak_rss_megabytes"][labels] = max(
+                    metricDict["stage_peak_rss_megabytes"].get(labels, 0), record["peakRssMB"])
+        lines = []
+        for metric, valueDict in sorted(metricDict.items()):
+            lines.append("# TYPE {}_{} {}".format(prefix, metric, "counter" if metric.endswith("_total") else "gauge"))
+            for labels, value in valueDict.items():
+                lines.append("{}_{}{{{}}} {}".format(prefix, metric, labels, value))
+        tmpPath = "{}.tmp{}".format(path, os.getpid())
+        with open(tmpPath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpPath, path)
+
+    def export(self, path):
+        '''按扩展名导出，.prom为Prometheus文本格式，其他为JSON lines'''
+        if path.endswith(".prom"):
+            self.toPrometheus(path)
+        else:
+            self.toJsonLines(path)
+        self.logger.info("{} stage records have been exported to {}".format(len(self.records), path))
+
+    def summary(self, top=10):
+        '''
+        墙钟时间最长的阶段
+        return: [(阶段名, 因子, 周期, 秒数)]
+        '''
+        ranked = sorted(self.records, key=lambda record: -record["wallSeconds"])[:top]
+        return [(record["stage"], record.get("factor"), record.get("frequency"), record["wallSeconds"])
+                for record in ranked]
+
+
+def peakRssMB():
+    '''当前进程的历史峰值内存（MB），不支持时返回None'''
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss / 1024.0 ** 2 if os.uname().sysname == "Darwin" else maxRss / 1024.0  # macOS为字节，Linux为KB
+
+
+def folderBytes(folderPath):
+    '''文件夹下（不含子文件夹）所有文件的总字节数，用于计算写入的字节数'''
+    if not os.path.isdir(folderPath):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(folderPath) if entry.is_file())
+
+
+def _profileStats(profiler):
+    '''cProfile结果转换为pstats格式的字典，可以跨进程传递'''
+    profiler.create_stats()
+    return profiler.stats
+
+
+def _escapeLabel(value):
+    return "" if value is None else str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _snakeCase(name):
+    return "".join("_" + char.lower() if char.isupper() else char for char in name).lstrip("_")
@@ -0,0 +1,41 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+'''
+conftest.py
+描述：测试共用的fixture，pathSelector替换为指向pytest临时目录的路径，不读取也不改写真实的data和factorData
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cpa.config import pathSelector
+
+
+@pytest.fixture
+def factorDataPath(tmp_path, monkeypatch):
+    '''pathSelector.PathSelector的factorData指向临时目录，返回factorData路径'''
+
+    class TmpPathSelector:
+
+        @classmethod
+        def getFactorFilePath(cls, factorName=None, factorFrequency=None, fileName=None):
+            folderPath = os.path.join(str(tmp_path), "factorData",
+                                      *[part for part in [factorName, factorFrequency] if part is not None])
+            os.makedirs(folderPath, exist_ok=True)
+            return os.path.join(folderPath, fileName) if fileName else folderPath
+
+    monkeypatch.setattr(pathSelector, "PathSelector", TmpPathSelector)
+    return TmpPathSelector.getFactorFilePath()
+
+
+@pytest.fixture
+def factorFrame():
+    '''10个5分钟bar × 4个代码的因子值'''
+    index = pd.date_range("2020-01-02 09:35", periods=10, freq="5min")
+    columns = ["000001.XSHE", "000002.XSHE", "600000.XSHG", "600036.XSHG"]
+    return pd.DataFrame(np.random.default_rng(0).normal(size=(10, 4)), index=index, columns=columns)
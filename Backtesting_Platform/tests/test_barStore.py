@@ -0,0 +1,60 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import numpy as np
+import pandas as pd
+
+from cpa.io import barStore
+
+
+def tradingMinutes(dates):
+    '''A股交易时间的分钟时间戳，每天09:31-11:30和13:01-15:00'''
+    minutes = pd.timedelta_range("09:31:00", "11:30:00", freq="min") \
+        .append(pd.timedelta_range("13:01:00", "15:00:00", freq="min"))
+    return pd.DatetimeIndex([pd.Timestamp(date) + minute for date in dates for minute in minutes])
+
+
+def testSessionBarIndex():
+    minuteIndex = tradingMinutes(["2020-01-02"])
+    barIndex = barStore.sessionBarIndex(minuteIndex, "5min")
+    assert len(barIndex) == 48
+    assert [str(time.time()) for time in barIndex[[0, 23, 24, -1]]] == ["09:35:00", "11:30:00", "13:05:00", "15:00:00"]
+    hourIndex = barStore.sessionBarIndex(minuteIndex, "2h")
+    assert [str(time.time()) for time in hourIndex] == ["11:30:00", "15:00:00"]
+
+
+def testResampleBars():
+    minuteIndex = tradingMinutes(["2020-01-02"])
+    values = np.arange(len(minuteIndex), dtype=np.float64)[:, None]
+    minuteDict = {field: pd.DataFrame(values, index=minuteIndex, columns=["a"])
+                  for field in ["open", "high", "low", "close", "volume"]}
+    barDict = barStore.resampleBars(minuteDict, barStore.sessionBarIndex(minuteIndex, "30min"))
+    assert barDict["open"]["a"].iloc[:2].tolist() == [0.0, 30.0]
+    assert barDict["close"]["a"].iloc[:2].tolist() == [29.0, 59.0]  # 09:31-10:00为第一根bar
+    assert barDict["high"]["a"].iloc[0] == 29.0 and barDict["low"]["a"].iloc[0] == 0.0
+    assert barDict["volume"]["a"].iloc[0] == sum(range(30))
+    assert barDict["close"]["a"].iloc[-1] == len(minuteIndex) - 1
+
+
+def testUpdateAppendsNewBars(tmp_path):
+    barIndex = barStore.sessionBarIndex(tradingMinutes(pd.bdate_range("2020-01-02", periods=6)), "2h")
+    returnFrame = pd.DataFrame(np.random.default_rng(0).normal(size=(len(barIndex), 3)), index=barIndex,
+                               columns=["a", "b", "c"])
+    store = barStore.BarStore("SZ50", "2h", cacheDir=str(tmp_path))
+    assert store.lastTime() is None and store.needsRebuild("20200102")
+    assert store.update(returnFrame.iloc[:6], start="20200102") == 6
+    assert store.lastTime() == barIndex[5]
+    assert store.covers("20200102", "20200103") and not store.covers("20200102", "20200109")
+    assert store.replayStart("20200102") == pd.Timestamp("2020-01-06") - pd.tseries.offsets.BusinessDay(n=2)
+
+    # 与已存数据重叠的bar不重复写入
+    assert store.update(returnFrame.iloc[4:], start=store.replayStart("20200102")) == 6
+    assert store.update(returnFrame.iloc[4:], start=store.replayStart("20200102")) == 0
+    assert len(store.panelCache.readMeta()["parts"]) == 2
+    pd.testing.assert_frame_equal(store.load()["returns"], returnFrame, check_freq=False)
+
+    # 开始时间早于已存数据时重建
+    assert store.needsRebuild("20200101")
+    assert store.update(returnFrame.iloc[2:], start="20200101") == len(returnFrame) - 2
+    assert len(store.panelCache.readMeta()["parts"]) == 1
@@ -0,0 +1,63 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import os
+import datetime
+
+import pytest
+
+from cpa.io import factorStorage, factorCatalog
+
+CURRENT_DT = datetime.datetime(2020, 1, 2, 15, 0)
+
+
+@pytest.mark.parametrize("name", sorted(factorStorage.BACKENDS))
+def testScanFolder(factorDataPath, factorFrame, name):
+    backend = factorStorage.getBackend(name)
+    folderPath = factorCatalog.factorFolderPath("maFactor", "5min")
+    for key, data in {"factor": factorFrame, "IC": factorFrame.iloc[:, 0].rename("IC")}.items():
+        fileName = backend.fileName("maFactor", key, "5min", CURRENT_DT)
+        backend.write(os.path.join(folderPath, fileName), backend.storeKey("maFactor", key), data)
+
+    catalog = factorCatalog.getCatalog("maFactor", "5min")
+    assert catalog.exists()
+    assert catalog.content["backend"] == name
+    entry = catalog.getFiles()["factor"]
+    assert (entry["rows"], entry["columns"]) == (10, list(factorFrame.columns))
+    assert catalog.getDateRange() == (factorFrame.index[0], factorFrame.index[-1])
+    assert set(factorStorage.readFactorData("maFactor", "5min")) == {"factor", "IC"}
+
+
+def testSaveAndReload(tmp_path, factorFrame):
+    catalog = factorCatalog.FactorCatalog("maFactor", "5min", folderPath=str(tmp_path))
+    assert not catalog.exists()
+    catalog.setParams({"lag": 1, "cut": 0.1, "fee": None}, source="abc")
+    catalog.record("factor", "maFactor_factor_5min_20200102_1500.h5", factorFrame.iloc[:6])
+    catalog.recordAppend("factor", "maFactor_factor_5min_20200102_1500.h5", factorFrame.iloc[6:])
+    catalog.save()
+
+    reloaded = factorCatalog.FactorCatalog("maFactor", "5min", folderPath=str(tmp_path))
+    assert reloaded.content["params"] == {"lag": 1, "cut": 0.1}
+    assert reloaded.content["source"] == "abc"
+    assert reloaded.getFiles()["factor"]["rows"] == 10
+    assert reloaded.getFiles()["factor"]["end"] == str(factorFrame.index[-1])
+
+
+def testParseDataKey():
+    assert factorCatalog.parseDataKey("maFactor_IC_5min_20200101_1200.h5", "maFactor", "5min") == "IC"
+    assert factorCatalog.parseDataKey("maFactor_groupRet_5min_20200101_1200.parquet", "maFactor", "5min") == "groupRet"
+    assert factorCatalog.parseDataKey("maFactor_IC_30min_20200101_1200.h5", "maFactor", "5min") is None
+    assert factorCatalog.parseDataKey("maFactor_5min.h5", "maFactor", "5min") is None
+
+
+def testListPool(factorDataPath, factorFrame):
+    backend = factorStorage.getBackend("table")
+    folderPath = factorCatalog.factorFolderPath("maFactor", "5min")
+    backend.write(os.path.join(folderPath, backend.fileName("maFactor", "factor", "5min", CURRENT_DT)),
+                  "maFactor", factorFrame)
+    os.makedirs(os.path.join(factorDataPath, "emptyFactor"))
+    poolDict = factorCatalog.listPool(rebuild=True)
+    assert poolDict["emptyFactor"] == {}
+    assert poolDict["maFactor"]["5min"]["files"]["factor"]["rows"] == 10
+    assert factorCatalog.factorEndDate("maFactor") == factorFrame.index[-1].to_pydatetime()
@@ -0,0 +1,85 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import os
+import datetime
+
+import pandas as pd
+import pytest
+
+from cpa.io import factorStorage, factorCatalog
+
+CURRENT_DT = datetime.datetime(2020, 1, 2, 15, 0)
+
+
+def writeAll(backend, folderPath, dataDict):
+    '''以一个后端写入{数据名: 数据}，返回文件路径字典'''
+    pathDict = {}
+    for key, data in dataDict.items():
+        fileName = backend.fileName("maFactor", key, "5min", CURRENT_DT)
+        pathDict[key] = os.path.join(str(folderPath), fileName)
+        backend.write(pathDict[key], backend.storeKey("maFactor", key), data)
+    return pathDict
+
+
+@pytest.mark.parametrize("name", sorted(factorStorage.BACKENDS))
+def testRoundTrip(tmp_path, factorFrame, name):
+    backend = factorStorage.getBackend(name)
+    groupRet = pd.DataFrame({1: factorFrame.iloc[:, 0], 2: factorFrame.iloc[:, 1]})  # 分组号为整数列名
+    IC = factorFrame.iloc[:, 0].rename("IC")
+    pathDict = writeAll(backend, tmp_path, {"factor": factorFrame, "groupRet": groupRet, "IC": IC})
+    pd.testing.assert_frame_equal(backend.read(pathDict["factor"], backend.storeKey("maFactor", "factor")),
+                                  factorFrame, check_freq=False)
+    pd.testing.assert_frame_equal(backend.read(pathDict["groupRet"], "groupRet"),
+                                  groupRet.set_axis(["1", "2"], axis=1), check_freq=False)
+    pd.testing.assert_series_equal(backend.read(pathDict["IC"], "IC"), IC, check_freq=False)
+
+
+@pytest.mark.parametrize("name", sorted(factorStorage.BACKENDS))
+def testAppendOnlyNewRows(tmp_path, factorFrame, name):
+    backend = factorStorage.getBackend(name)
+    storeKey = backend.storeKey("maFactor", "factor")
+    filePath = writeAll(backend, tmp_path, {"factor": factorFrame.iloc[:6]})["factor"]
+    newData = factorFrame.iloc[4:].assign(**{"000003.XSHE": 1.0})  # 与已存数据重叠两行，并新增一个代码
+    appendedData = backend.append(filePath, storeKey, newData)
+    assert list(appendedData.index) == list(factorFrame.index[6:])
+    storedData = backend.read(filePath, storeKey)
+    assert list(storedData.index) == list(factorFrame.index)
+    assert storedData["000003.XSHE"].iloc[:6].isna().all() and (storedData["000003.XSHE"].iloc[6:] == 1.0).all()
+    pd.testing.assert_frame_equal(storedData[factorFrame.columns], factorFrame, check_freq=False)
+
+
+def testConsolidatedClearDropsOldKeys(tmp_path, factorFrame):
+    backend = factorStorage.getBackend("consolidated")
+    filePath = writeAll(backend, tmp_path, {"factor": factorFrame, "IC": factorFrame.iloc[:, 0]})["factor"]
+    backend.clear(str(tmp_path), "maFactor", "5min")
+    writeAll(backend, tmp_path, {"factor": factorFrame})
+    with pd.HDFStore(filePath, mode="r") as store:
+        assert store.keys() == ["/factor"]
+
+
+def testReadCatalogData(tmp_path, factorFrame):
+    backend = factorStorage.getBackend("parquet")
+    catalog = factorCatalog.FactorCatalog("maFactor", "5min", folderPath=str(tmp_path))
+    dataDict = {"factor": factorFrame, "IC": factorFrame.iloc[:, 0].rename("IC")}
+    for key, filePath in writeAll(backend, tmp_path, dataDict).items():
+        catalog.record(key, os.path.basename(filePath), dataDict[key])
+    catalog.content["backend"] = backend.name
+    readDict = factorStorage.readCatalogData(catalog)
+    assert sorted(readDict) == ["IC", "factor"]
+    pd.testing.assert_frame_equal(readDict["factor"], factorFrame, check_freq=False)
+    assert list(factorStorage.readCatalogData(catalog, keys=["IC"])) == ["IC"]
+
+
+def testMergeNewRows(factorFrame):
+    oldData = factorFrame.iloc[:6].set_axis(range(4), axis=1)  # 旧数据为整数列名
+    newData, appendedData = factorStorage.mergeNewRows(oldData, factorFrame.iloc[3:].set_axis(range(4), axis=1))
+    assert list(newData.columns) == ["0", "1", "2", "3"]
+    assert list(appendedData.index) == list(factorFrame.index[6:])
+    assert newData.to_numpy().tolist() == factorFrame.to_numpy().tolist()
+
+
+def testGetBackendRejectsUnknownName():
+    with pytest.raises(ValueError):
+        factorStorage.getBackend("csv")
@@ -0,0 +1,99 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from cpa.io import panelCache
+
+
+def makeFrameDict(index, columns, seed=0):
+    rng = np.random.default_rng(seed)
+    return {field: pd.DataFrame(rng.normal(size=(len(index), len(columns))), index=index, columns=columns)
+            for field in ["open", "close"]}
+
+
+def testBuildAndLoad(tmp_path):
+    index = pd.date_range("2020-01-02 09:31", periods=20, freq="min")
+    frameDict = makeFrameDict(index, ["a", "b", "c"])
+    cache = panelCache.PanelCache("stock", sourcePaths=[], fields=["open", "close"], cacheDir=str(tmp_path))
+    assert not cache.isValid()
+    cache.build(frameDict, attrs={"start": "20200102"})
+    assert cache.isValid()
+    assert cache.getAttrs() == {"start": "20200102"}
+    assert list(cache.getDates()) == list(index)
+    assert cache.getInstruments() == ["a", "b", "c"]
+    loaded = cache.load(start=index[5], end=index[9], fields=["close"])
+    assert list(loaded) == ["close"]
+    pd.testing.assert_frame_equal(loaded["close"], frameDict["close"].iloc[5:10], check_freq=False, check_index_type=False)
+
+
+def testSourceChangeInvalidates(tmp_path):
+    sourcePath = tmp_path / "IH.CCFX.csv"
+    sourcePath.write_text("datetime,close\n")
+    index = pd.date_range("2020-01-02 09:31", periods=5, freq="min")
+    cache = panelCache.PanelCache("IH.CCFX", sourcePaths=str(sourcePath), fields=["open", "close"])
+    assert cache.cacheDir == os.path.join(str(tmp_path), ".panelCache")
+    cache.build(makeFrameDict(index, ["IH.CCFX"]))
+    assert cache.isValid()
+    sourcePath.write_text("datetime,close\n2020-01-02 09:31:00,1.0\n")
+    assert not cache.isValid()
+    assert not panelCache.PanelCache("IH.CCFX", sourcePaths=str(sourcePath), fields=["open", "close", "volume"]) \
+        .isValid()
+
+
+def testSourceKeyInvalidates(tmp_path):
+    index = pd.date_range("2020-01-02 09:31", periods=5, freq="min")
+    cache = panelCache.PanelCache("members", sourcePaths=[], fields=["open", "close"], cacheDir=str(tmp_path),
+                                  sourceKey="v1")
+    cache.build(makeFrameDict(index, ["a"]))
+    assert cache.isValid()
+    assert not panelCache.PanelCache("members", sourcePaths=[], fields=["open", "close"], cacheDir=str(tmp_path),
+                                     sourceKey="v2").isValid()
+
+
+def testAppendParts(tmp_path):
+    index = pd.date_range("2020-01-02 09:31", periods=30, freq="min")
+    frameDict = makeFrameDict(index, ["a", "b"])
+    cache = panelCache.PanelCache("stock", sourcePaths=[], fields=["open", "close"], cacheDir=str(tmp_path))
+    cache.build({field: frame.iloc[:10] for field, frame in frameDict.items()})
+    assert cache.append({field: frame.iloc[10:20] for field, frame in frameDict.items()})
+    assert not cache.append({field: frame.iloc[15:25] for field, frame in frameDict.items()})  # 与已有数据重叠
+    newDict = {field: frame.iloc[20:].assign(c=1.0) for field, frame in frameDict.items()}  # 新增代码c
+    assert cache.append(newDict)
+    assert len(cache.readMeta()["parts"]) == 3
+    assert cache.getInstruments() == ["a", "b", "c"]
+
+    loaded = cache.load()["close"]
+    assert list(loaded.index) == list(index)
+    pd.testing.assert_frame_equal(loaded[["a", "b"]], frameDict["close"], check_freq=False, check_index_type=False)
+    assert loaded["c"].iloc[:20].isna().all() and (loaded["c"].iloc[20:] == 1.0).all()
+    # 只涉及一个数据段的读取
+    pd.testing.assert_frame_equal(cache.load(start=index[12], end=index[14])["close"],
+                                  frameDict["close"].iloc[12:15], check_freq=False, check_index_type=False)
+
+
+def testAppendCompactsParts(tmp_path, monkeypatch):
+    monkeypatch.setattr(panelCache.PanelCache, "MAX_PARTS", 2)
+    index = pd.date_range("2020-01-02 09:31", periods=9, freq="min")
+    frameDict = makeFrameDict(index, ["a"])
+    cache = panelCache.PanelCache("stock", sourcePaths=[], fields=["open", "close"], cacheDir=str(tmp_path))
+    cache.build({field: frame.iloc[:3] for field, frame in frameDict.items()})
+    for start in [3, 6]:
+        assert cache.append({field: frame.iloc[start:start + 3] for field, frame in frameDict.items()})
+    assert len(cache.readMeta()["parts"]) == 1
+    pd.testing.assert_frame_equal(cache.load()["open"], frameDict["open"], check_freq=False, check_index_type=False)
+
+
+def testFramePanelReader():
+    index = pd.date_range("2020-01-02 09:31", periods=3, freq="min").append(
+        pd.date_range("2020-01-03 09:31", periods=3, freq="min"))
+    frameDict = makeFrameDict(index, ["a", "b"])
+    reader = panelCache.FramePanelReader(frameDict, frequency=None, start="20200102", end="20200102")
+    frame = reader.to_frame()
+    assert list(frame.columns) == ["open", "close"]
+    assert len(frame) == 6  # 3分钟 × 2个代码，end为日期时包含当天的全部数据
+    assert panelCache.frameToFieldDict(frame, ["close"])["close"].equals(frameDict["close"].iloc[:3])
@@ -0,0 +1,84 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cpa.factorProcessor import panelFactorTest
+
+INDEX = pd.date_range("2020-01-02 10:00", periods=4, freq="h")
+COLUMNS = ["a", "b", "c", "d"]
+
+
+@pytest.fixture
+def panelTest():
+    '''lag=1、两组的手算例子，t时刻使用t-1的因子值和t时刻的收益'''
+    factorFrame = pd.DataFrame([[1, 2, 3, 4], [4, 3, 2, 1], [4, 3, 1, 2], [0, 0, 0, 0]],
+                               index=INDEX, columns=COLUMNS, dtype=np.float64)
+    returnFrame = pd.DataFrame([[np.nan] * 4, [0.01, 0.02, 0.03, 0.04], [0.04, 0.02, 0.01, 0.03],
+                                [0.01, 0.02, 0.03, 0.04]], index=INDEX, columns=COLUMNS)
+    tester = panelFactorTest.PanelFactorTest(factorFrame, returnFrame,
+                                             indicators=panelFactorTest.PanelFactorTest.INDICATORS,
+                                             lag=1, cut=0.5, fee=0.003)
+    tester.run()
+    return tester
+
+
+def indicator(panelTest, name):
+    return panelTest.getIndicators()[name].to_frame()
+
+
+def testCorrelations(panelTest):
+    np.testing.assert_allclose(indicator(panelTest, "IC")["IC"], [np.nan, 1.0, 0.4, -0.8])
+    np.testing.assert_allclose(indicator(panelTest, "rankIC")["rankIC"], [np.nan, 1.0, 0.4, -0.8])
+    np.testing.assert_allclose(indicator(panelTest, "beta")["beta"], [np.nan, 0.01, 0.004, -0.008])
+
+
+def testGroups(panelTest):
+    groupRet = indicator(panelTest, "groupRet")
+    assert list(groupRet.columns) == ["0", "1"]
+    np.testing.assert_allclose(groupRet.to_numpy(), [[np.nan, np.nan], [0.015, 0.035], [0.02, 0.03], [0.035, 0.015]])
+    np.testing.assert_allclose(indicator(panelTest, "groupNumber").to_numpy()[1:], 2.0)
+    np.testing.assert_allclose(indicator(panelTest, "tbdf")["tbdf"], [np.nan, 0.02, 0.01, -0.02])
+    np.testing.assert_allclose(indicator(panelTest, "gpIC")["gpIC"], [np.nan, 1.0, 1.0, -1.0])
+
+
+def testTurnover(panelTest):
+    turn = indicator(panelTest, "turn")
+    np.testing.assert_allclose(turn["top"], [np.nan, 1.0, 1.0, 0.0])
+    np.testing.assert_allclose(turn["bottom"], [np.nan, 1.0, 1.0, 0.0])
+    np.testing.assert_allclose(indicator(panelTest, "cost").to_numpy(), turn.to_numpy() * 0.003)
+
+
+def testMinCount():
+    factorFrame = pd.DataFrame([[1.0, 2.0, np.nan, np.nan]] * 2, index=INDEX[:2], columns=COLUMNS)
+    returnFrame = pd.DataFrame([[0.01, 0.02, 0.03, 0.04]] * 2, index=INDEX[:2], columns=COLUMNS)
+    panelTest = panelFactorTest.PanelFactorTest(factorFrame, returnFrame, lag=1)
+    assert np.isnan(indicator(panelTest, "IC")["IC"]).all()  # 有效数据少于minCount
+    assert len(panelTest.getIndicators()["IC"]) == 0
+
+
+def testForwardReturns():
+    closeFrame = pd.DataFrame({"a": [10.0, 11.0, 12.1]}, index=INDEX[:3])
+    benchClose = pd.Series([100.0, 105.0, 105.0], index=INDEX[:3])
+    np.testing.assert_allclose(panelFactorTest.forwardReturns(closeFrame)["a"], [np.nan, 0.1, 0.1])
+    np.testing.assert_allclose(panelFactorTest.forwardReturns(closeFrame, benchClose=benchClose)["a"],
+                               [np.nan, 0.05, 0.1])
+
+
+def testRequireVerified(tmp_path, monkeypatch):
+    monkeypatch.setattr(panelFactorTest, "VERIFIED_PATH", str(tmp_path / "panelFactorTest_verified.json"))
+    assert not panelFactorTest.isVerified()
+    with pytest.raises(RuntimeError):
+        panelFactorTest.requireVerified()
+    panelFactorTest.markVerified()
+    panelFactorTest.requireVerified()
+    monkeypatch.setattr(panelFactorTest, "implementationHash", lambda: "changed")
+    assert not panelFactorTest.isVerified()
+
+
+def testUnknownIndicator():
+    with pytest.raises(ValueError):
+        panelFactorTest.PanelFactorTest(pd.DataFrame(), pd.DataFrame(), indicators=["IR"])
@@ -0,0 +1,62 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import os
+import json
+
+from cpa.factorPool import resultCache
+
+
+def writeResultFolder(folderPath, nBytes):
+    os.makedirs(str(folderPath), exist_ok=True)
+    with open(os.path.join(str(folderPath), "maFactor_factor_5min_20200102_1500.h5"), "wb") as f:
+        f.write(b"0" * nBytes)
+    os.makedirs(os.path.join(str(folderPath), "20200102_1500"), exist_ok=True)  # 旧数据归档不存入缓存
+
+
+def setLastUsed(cache, key, lastUsed):
+    metaPath = os.path.join(cache.getPath(key), "meta.json")
+    with open(metaPath, "r") as f:
+        meta = json.load(f)
+    meta["lastUsed"] = lastUsed
+    with open(metaPath, "w") as f:
+        json.dump(meta, f)
+
+
+def testCellKey():
+    params = {"source": "abc", "lag": 1, "cut": 0.1, "frequency": "5min"}
+    assert resultCache.cellKey(params) == resultCache.cellKey(dict(reversed(list(params.items()))))
+    assert resultCache.cellKey(params) != resultCache.cellKey({**params, "lag": 2})
+
+
+def testStoreAndRestore(tmp_path):
+    cache = resultCache.ResultCache(cacheDir=str(tmp_path / "factorCache"))
+    writeResultFolder(tmp_path / "cell", 100)
+    key = resultCache.cellKey({"source": "abc"})
+    assert not cache.has(key)
+    cache.store(key, str(tmp_path / "cell"), {"factor": "maFactor", "frequency": "5min"})
+    assert cache.has(key)
+    assert sorted(os.listdir(cache.getPath(key))) == ["maFactor_factor_5min_20200102_1500.h5", "meta.json"]
+
+    restorePath = tmp_path / "restored"
+    writeResultFolder(restorePath, 10)
+    (restorePath / "stale.h5").write_bytes(b"1")
+    cache.restore(key, str(restorePath))
+    assert sorted(os.listdir(str(restorePath))) == ["20200102_1500", "maFactor_factor_5min_20200102_1500.h5"]
+    assert os.path.getsize(str(restorePath / "maFactor_factor_5min_20200102_1500.h5")) == 100
+
+
+def testDefaultCacheDir(factorDataPath):
+    assert resultCache.ResultCache().cacheDir == os.path.join(os.path.dirname(factorDataPath), "factorCache")
+
+
+def testEvictLeastRecentlyUsed(tmp_path):
+    cache = resultCache.ResultCache(cacheDir=str(tmp_path / "factorCache"), maxBytes=250)
+    for i, lastUsed in enumerate(["2020-01-03T00:00:00", "2020-01-01T00:00:00", "2020-01-02T00:00:00"]):
+        writeResultFolder(tmp_path / "cell{}".format(i), 100)
+        cache.store("key{}".format(i), str(tmp_path / "cell{}".format(i)), {"factor": "maFactor"})
+        setLastUsed(cache, "key{}".format(i), lastUsed)
+    assert cache.evict() == ["key1"]
+    assert cache.evict() == []
+    assert cache.has("key0") and cache.has("key2") and not cache.has("key1")
@@ -0,0 +1,61 @@
+#!/usr/bin/env Python
+# -*- coding:utf-8 -*-
+# author: Yanggang Fang
+
+import json
+
+from cpa.utils import stageRecorder
+
+
+def testNestedStagesAndCounters():
+    recorder = stageRecorder.StageRecorder(instruments="SZ50")
+    with recorder.stage("total", factor="maFactor"):
+        with recorder.stage("writeH5", frequency="5min"):
+            recorder.count("bars", 10)
+        recorder.count("bars", 5)
+    writeRecord, totalRecord = recorder.records
+    assert (writeRecord["stage"], writeRecord["frequency"], writeRecord["counters"]) == ("writeH5", "5min", {"bars": 10})
+    assert (totalRecord["stage"], totalRecord["factor"], totalRecord["counters"]) == ("total", "maFactor", {"bars": 15})
+    assert totalRecord["instruments"] == "SZ50"
+    assert totalRecord["wallSeconds"] >= writeRecord["wallSeconds"] >= 0
+
+
+def testDisabledRecordsNothing():
+    recorder = stageRecorder.StageRecorder(enabled=False)
+    with recorder.stage("total"), recorder.profile("maFactor"):
+        recorder.count("bars")
+    assert recorder.records == [] and recorder.slowestProfile is None
+
+
+def testExportJsonLines(tmp_path):
+    recorder = stageRecorder.StageRecorder()
+    with recorder.stage("replay", factor="maFactor"):
+        pass
+    path = str(tmp_path / "metrics.jsonl")
+    recorder.export(path)
+    recorder.export(path)  # JSON lines追加写入
+    with open(path, "r") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["stage"] for line in lines] == ["replay", "replay"]
+
+
+def testExportPrometheus(tmp_path):
+    recorder = stageRecorder.StageRecorder()
+    for _ in range(2):
+        with recorder.stage("writeH5", factor="maFactor"):
+            recorder.count("bytesWritten", 100)
+    path = str(tmp_path / "metrics.prom")
+    recorder.export(path)
+    with open(path, "r") as f:
+        text = f.read()
+    assert "# TYPE factor_update_bytes_written_total counter" in text
+    assert 'factor_update_bytes_written_total{factor="maFactor",stage="writeH5"} 200' in text
+    assert "# TYPE factor_update_stage_wall_seconds gauge" in text
+
+
+def testProfileKeepsSlowest(tmp_path):
+    recorder = stageRecorder.StageRecorder(profile=True)
+    recorder.keepSlowest(1.0, "fast", {})
+    recorder.keepSlowest(2.0, "slow", {})
+    recorder.keepSlowest(1.5, "medium", {})
+    assert recorder.dumpProfile(str(tmp_path / "slowest.prof")) == "slow"
@@ -0,0 +1,210 @@
+import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.signal import lfilter
+
+
+def _split(params, p, q, const):
+    c = params[0] if const else 0.0
+    AR_param = params[int(const):int(const) + p]
+    MA_param = params[int(const) + p:int(const) + p + q]
+    return c, AR_param, MA_param
+
+
+def _lags(x, p, start):
+    '''columns x_t-1 .. x_t-p for t = start..n-1'''
+    n = x.shape[0]
+    return np.column_stack([x[start - i:n - i] for i in range(1, p + 1)]) if p else np.empty((n - start, 0))
+
+
+def ARMA_residuals(params, x, p, q, const=True):
+    '''
+    conditional residuals of x_t = c + sum(phi_i x_t-i) + e_t + sum(theta_j e_t-j)
+    conditioning on the first p observations and e = 0 before the sample, as Q5_logL_MLE_MA1 in PS3
+    '''
+    c, AR_param, MA_param = _split(params, p, q, const)
+    w = x[p:] - c - _lags(x, p, p) @ AR_param
+    return lfilter([1.0], np.r_[1.0, MA_param], w)
+
+
+def ARMA_neg_logL(params, x, p, q, const=True):
+    '''concentrated negative conditional log-likelihood and its analytic gradient'''
+    c, AR_param, MA_param = _split(params, p, q, const)
+    e = ARMA_residuals(params, x, p, q, const)
+    T = e.shape[0]
+    ssr = e @ e
+    neg_logL = T / 2 * (np.log(2 * np.pi) + 1 + np.log(ssr / T))
+    J = _jacobian(x, e, p, q, const, MA_param)
+    grad = T / ssr * (J.T @ e)
+    return neg_logL, grad
+
+
+def _jacobian(x, e, p, q, const, MA_param):
+    '''de_t/dparams, every column filtered by 1/(1 + theta(L)) in one call'''
+    T = e.shape[0]
+    columns = []
+    if const:
+        columns.append(-np.ones((T, 1)))
+    if p:
+        columns.append(-_lags(x, p, p))
+    if q:
+        e_padded = np.r_[np.zeros(q), e]
+        columns.append(-_lags(e_padded, q, q))
+    dw = np.column_stack(columns) if columns else np.empty((T, 0))
+    return lfilter([1.0], np.r_[1.0, MA_param], dw, axis=0)
+
+
+def _pacf_to_coef(u):
+    '''
+    unconstrained u -> partial autocorrelations tanh(u) -> phi of a stationary 1 - sum(phi_i L^i) (Durbin-Levinson)
+    returns phi and d phi / d u
+    '''
+    r = np.tanh(u)
+    phi = np.empty(0)
+    J = np.empty((0, r.shape[0]))
+    for k in range(r.shape[0]):
+        J_new = np.vstack((J - r[k] * J[::-1], np.zeros(r.shape[0])))
+        J_new[:k, k] = -phi[::-1]
+        J_new[k, k] = 1.0
+        phi, J = np.r_[phi - r[k] * phi[::-1], r[k]], J_new
+    return phi, J * (1 - r ** 2)
+
+
+def _coef_to_pacf(phi, bound=0.99):
+    '''inverse of _pacf_to_coef, partial autocorrelations are clipped to +-bound so any start values map to u'''
+    phi = np.asarray(phi, dtype=float)
+    r = np.empty(phi.shape[0])
+    for k in range(phi.shape[0] - 1, -1, -1):
+        r[k] = np.clip(phi[k], -bound, bound)
+        phi = (phi[:k] + r[k] * phi[:k][::-1]) / (1 - r[k] ** 2)
+    return np.arctanh(r)
+
+
+def _untransform(z, p, q, const):
+    '''
+    unconstrained z -> (const, stationary AR, invertible MA) params and the Jacobian d params / d z
+    the MA polynomial 1 + sum(theta_j L^j) equals 1 - sum(phi_j L^j) of the transformed MA block
+    '''
+    c, AR_z, MA_z = _split(z, p, q, const)
+    AR_param, AR_J = _pacf_to_coef(AR_z)
+    MA_phi, MA_J = _pacf_to_coef(MA_z)
+    params = np.r_[c, AR_param, -MA_phi] if const else np.r_[AR_param, -MA_phi]
+    J = np.zeros((params.shape[0], params.shape[0]))
+    if const:
+        J[0, 0] = 1.0
+    J[int(const):int(const) + p, int(const):int(const) + p] = AR_J
+    J[int(const) + p:, int(const) + p:] = -MA_J
+    return params, J
+
+
+def _transform(params, p, q, const):
+    c, AR_param, MA_param = _split(np.asarray(params, dtype=float), p, q, const)
+    z = np.r_[_coef_to_pacf(AR_param), _coef_to_pacf(-MA_param)]
+    return np.r_[c, z] if const else z
+
+
+def _transformed_neg_logL(z, x, p, q, const, nonfinite):
+    '''ARMA_neg_logL over the unconstrained parameters, non-finite values are counted in nonfinite[0]'''
+    params, J = _untransform(z, p, q, const)
+    neg_logL, grad = ARMA_neg_logL(params, x, p, q, const)
+    if not (np.isfinite(neg_logL) and np.all(np.isfinite(grad))):
+        nonfinite[0] += 1
+        return np.inf, np.zeros_like(z)
+    return neg_logL, J.T @ grad
+
+
+def _start_params(x, p, q, const):
+    '''OLS AR(p) coefficients, MA terms start at 0'''
+    X = _lags(x, p, p)
+    X = np.column_stack((np.ones(X.shape[0]), X)) if const else X
+    beta = np.linalg.lstsq(X, x[p:], rcond=None)[0] if X.shape[1] else np.empty(0)
+    return np.r_[beta, np.zeros(q)]
+
+
+def fit_ARMA(x, p, q, const=True, start_params=None, maxiter=500):
+    '''
+    conditional MLE of ARMA(p, q) with L-BFGS-B and analytic gradients
+    AR and MA coefficients are optimized as tanh-bounded partial autocorrelations (as statsmodels transparams),
+    so every step is stationary and invertible; start values outside the region are pulled inside
+    '''
+    x = np.asarray(x, dtype=float)
+    start_params = _start_params(x, p, q, const) if start_params is None else np.asarray(start_params, dtype=float)
+    nonfinite = [0]
+    opt = minimize(_transformed_neg_logL, _transform(start_params, p, q, const),
+                   args=(x, p, q, const, nonfinite), jac=True, method="L-BFGS-B", options={"maxiter": maxiter})
+    params = _untransform(opt.x, p, q, const)[0]
+    c, AR_param, MA_param = _split(params, p, q, const)
+    e = ARMA_residuals(params, x, p, q, const)
+    T = e.shape[0]
+    sigma_squared = e @ e / T
+    J = _jacobian(x, e, p, q, const, MA_param)
+    # Gauss-Newton approximation of the information matrix
+    var_cov = sigma_squared * np.linalg.pinv(J.T @ J)
+    k = params.shape[0] + 1
+    logL = -opt.fun
+    results = {"Params": params,
+               "Standard errors": np.sqrt(np.diag(var_cov)),
+               "Variance-covariance matrix": var_cov,
+               "Sigma squared": sigma_squared,
+               "Residuals": e,
+               "Maximized log-likelihood function": logL,
+               "AIC": -2 * logL + 2 * k,
+               "BIC": -2 * logL + np.log(T) * k,
+               "Stationary": bool(np.all(np.abs(np.roots(np.r_[1.0, -AR_param])) < 1)) if p else True,
+               "Invertible": bool(np.all(np.abs(np.roots(np.r_[1.0, MA_param])) < 1)) if q else True,
+               "Non-finite evaluations": nonfinite[0],
+               "Converged": bool(opt.success) and bool(np.isfinite(opt.fun))}
+    return results
+
+
+def _param_names(p, q, const):
+    return (["const"] if const else []) + ["ar.L{}".format(i) for i in range(1, p + 1)] \
+        + ["ma.L{}".format(j) for j in range(1, q + 1)]
+
+
+def _fit_chunk(chunk, p, q, const):
+    rows = []
+    for name, x in chunk:
+        try:
+            results = fit_ARMA(x, p, q, const)
+        except (ValueError, np.linalg.LinAlgError):
+            rows.append((name, None))
+            continue
+        rows.append((name, {**dict(zip(_param_names(p, q, const), results["Params"])),
+                            **{"se." + key: value for key, value in
+                               zip(_param_names(p, q, const), results["Standard errors"])},
+                            "sigma2": results["Sigma squared"],
+                            "llf": results["Maximized log-likelihood function"],
+                            "aic": results["AIC"],
+                            "bic": results["BIC"],
+                            "nobs": len(x) - p,
+                            "stationary": results["Stationary"],
+                            "invertible": results["Invertible"],
+                            "nonfinite": results["Non-finite evaluations"],
+                            "converged": results["Converged"]}))
+    return rows
+
+
+def fit_ARMA_batch(data, p, q, const=True, workers=None, chunksize=50):
+    '''
+    fit ARMA(p, q) to every column of data (DataFrame or (n, m) array) over a process pool
+    missing values are dropped per column; returns a DataFrame with one row per series
+    '''
+    df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(np.asarray(data, dtype=float))
+    series_list = [(name, df[name].dropna().to_numpy(dtype=float)) for name in df.columns]
+    series_list = [(name, x) for name, x in series_list if len(x) > p + q + int(const) + 1]
+    chunks = [series_list[i:i + chunksize] for i in range(0, len(series_list), chunksize)]
+    workers = workers or os.cpu_count()
+    rows = []
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            for chunk_rows in executor.map(partial(_fit_chunk, p=p, q=q, const=const), chunks):
+                rows.extend(chunk_rows)
+    else:
+        for chunk in chunks:
+            rows.extend(_fit_chunk(chunk, p, q, const))
+    return pd.DataFrame.from_dict({name: row for name, row in rows if row is not None}, orient="index")
@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, f, t
+
+try:
+    from .batch_ols import batch_ols
+except ImportError:  # run as a script, or with Empirical_Methods on sys.path as in the notebooks
+    from batch_ols import batch_ols
+
+
+def read_groupRet(factor_data_path, freq, factors=None):
+    '''
+    groupRet panels written by H5PanelWriter under factor_data_path/<factor>/<freq>/
+    located through FactorCatalog and read with the factorStorage backend recorded there, needs cpa;
+    folders without catalog.json are scanned in memory, nothing is written
+    returns {factor: DataFrame}, columns are group numbers from the lowest to the highest factor value
+    '''
+    from cpa.io import factorCatalog, factorStorage
+
+    factors = factors or sorted(name for name in os.listdir(factor_data_path)
+                                if os.path.isdir(os.path.join(factor_data_path, name, freq)))
+    groupRet_dict = {}
+    for factor in factors:
+        catalog = factorCatalog.FactorCatalog(factor, freq, folderPath=os.path.join(factor_data_path, factor, freq))
+        if not catalog.exists():
+            catalog.scanFolder()
+        df = factorStorage.readCatalogData(catalog, keys=["groupRet"]).get("groupRet")
+        if df is None:
+            continue
+        df.columns = [int(column) if str(column).isdigit() else column for column in df.columns]
+        groupRet_dict[factor] = df.sort_index(axis=1)
+    return groupRet_dict
+
+
+def groupRet_assets(groupRet_dict, how="spread"):
+    '''
+    test assets from groupRet panels
+    how="spread": one top-minus-bottom series per factor; how="groups": every group of every factor
+    '''
+    if how == "spread":
+        assets = {factor: df.iloc[:, -1] - df.iloc[:, 0] for factor, df in groupRet_dict.items()}
+    elif how == "groups":
+        assets = {"{}_g{}".format(factor, group): df[group]
+                  for factor, df in groupRet_dict.items() for group in df.columns}
+    else:
+        raise ValueError("how must be 'spread' or 'groups', got {}".format(how))
+    return pd.DataFrame(assets)
+
+
+def _align(assets, factors):
+    assets = pd.DataFrame(assets)
+    factors = pd.DataFrame(factors)
+    data = assets.join(factors, how="inner", rsuffix="_factor").dropna()
+    return data.iloc[:, :assets.shape[1]], data.iloc[:, assets.shape[1]:]
+
+
+def time_series_regression(assets, factors, nlags=None):
+    '''
+    all N assets on the K factors with an intercept in one multivariate regression
+    returns batch_ols results (Beta[:, 0] is alpha) plus the residual covariance and aligned data
+    '''
+    assets, factors = _align(assets, factors)
+    ts_results = batch_ols(assets.to_numpy(), factors.to_numpy(), intercept=True, nlags=nlags)
+    T, K = factors.shape
+    e = ts_results["Residuals"]
+    ts_results["Residual covariance"] = e.T @ e / (T - K - 1)
+    ts_results["Assets"] = assets
+    ts_results["Factors"] = factors
+    return ts_results
+
+
+def GRS_test(ts_results):
+    '''
+    Gibbons-Ross-Shanken F statistic with F(N, T-N-K), and the asymptotic Wald chi2(N) version used in PS5
+    the factor covariance is the MLE one (divided by T) as in the GRS formula; the residual covariance
+    divided by T-K-1 is turned into the MLE one by the (T-N-K)/(T-K-1) factor
+    '''
+    factors = ts_results["Factors"].to_numpy()
+    T, K = factors.shape
+    alpha = ts_results["Beta"][:, 0]
+    N = alpha.shape[0]
+    if T - N - K <= 0:
+        raise ValueError("GRS needs T > N + K, got T={}, N={}, K={}".format(T, N, K))
+    resid_cov = ts_results["Residual covariance"]
+    mkt_mean = factors.mean(axis=0)
+    mkt_cov = np.atleast_2d(np.cov(factors, rowvar=False, ddof=0))
+    mkt_SRsqr = mkt_mean @ np.linalg.solve(mkt_cov, mkt_mean)
+    alpha_quad = alpha @ np.linalg.solve(resid_cov, alpha)
+    GRS = (T / N) * ((T - N - K) / (T - K - 1)) * alpha_quad / (1 + mkt_SRsqr)
+    Wald = T * alpha_quad / (1 + mkt_SRsqr)
+    return {"GRS": GRS, "GRS P-value": f.sf(GRS, N, T - N - K),
+            "Wald": Wald, "Wald P-value": chi2.sf(Wald, N)}
+
+
+def alpha_beta_frame(ts_results, se="White"):
+    '''
+    alpha_beta_df/t_test_df of PS5 for all assets at once
+    p-values use the t distribution with the residual degrees of freedom for every se, as fit(use_t=True) in PS5
+    '''
+    names = ["Alpha"] + ["Beta-{}".format(name) for name in ts_results["Factors"].columns]
+    beta = ts_results["Beta"]
+    std = ts_results["{} standard errors".format(se)]
+    t_stat = beta / std
+    pvalue = 2 * t.sf(np.abs(t_stat), ts_results["Degrees of freedom for residuals"])
+    columns = {}
+    for i, name in enumerate(names):
+        columns[name] = beta[:, i]
+        columns[name + "-Standard Error"] = std[:, i]
+        columns[name + "-Tstat"] = t_stat[:, i]
+        columns[name + "-Pvalue"] = pvalue[:, i]
+    return pd.DataFrame(columns, index=ts_results["Assets"].columns)
+
+
+def rolling_betas(assets, factors, window):
+    '''
+    betas of every asset over every rolling window, from cumulative sums of the cross products
+    returns (W, K+1, N) coefficients, window w ends at row w + window - 1
+    '''
+    R = np.asarray(assets, dtype=float)
+    X = np.column_stack((np.ones(R.shape[0]), np.asarray(factors, dtype=float)))
+    XX = np.cumsum(np.einsum('tk,tl->tkl', X, X), axis=0)
+    XR = np.cumsum(np.einsum('tk,tn->tkn', X, R), axis=0)
+    XX = np.concatenate((np.zeros((1,) + XX.shape[1:]), XX))
+    XR = np.concatenate((np.zeros((1,) + XR.shape[1:]), XR))
+    XX_window = XX[window:] - XX[:-window]
+    XR_window = XR[window:] - XR[:-window]
+    return np.linalg.solve(XX_window, XR_window)
+
+
+def Fama_MacBeth(assets, factors, window=60, nlags=None):
+    '''
+    rolling Fama-MacBeth: betas from the past window periods explain the next period's returns
+    all cross-sectional regressions are fitted in one batch_ols call
+    nlags: Newey-West lags for the standard errors of the average premia, None for the usual FM errors,
+           which use the sample standard deviation of the premia (ddof=1), unlike the MLE covariance in GRS_test
+    '''
+    assets, factors = _align(assets, factors)
+    T, N = assets.shape
+    betas = rolling_betas(assets.to_numpy(), factors.to_numpy(), window)[:-1]  # windows ending at window-1..T-2
+    W = betas.shape[0]
+    Z = np.concatenate((np.ones((W, N, 1)), betas[:, 1:].transpose(0, 2, 1)), axis=2)  # (W, N, K+1)
+    R_next = assets.to_numpy()[window:]  # (W, N)
+    cs_results = batch_ols(R_next.T, Z.transpose(1, 0, 2), intercept=False)
+    gamma = cs_results["Beta"]  # (W, K+1)
+    names = ["Gamma-const"] + ["Gamma-{}".format(name) for name in factors.columns]
+    if nlags is None:
+        std = gamma.std(axis=0, ddof=1) / np.sqrt(W)
+    else:
+        std = batch_ols(gamma, np.ones((W, 1)), intercept=False, nlags=nlags)["Newey-West standard errors"][:, 0]
+    premia = gamma.mean(axis=0)
+    t_stat = premia / std
+    summary = pd.DataFrame({"Premium": premia, "Standard Error": std, "Tstat": t_stat,
+                            "Pvalue": 2 * t.sf(np.abs(t_stat), W - 1)}, index=names)
+    return {"Summary": summary,
+            "Gamma": pd.DataFrame(gamma, index=assets.index[window:], columns=names),
+            "Cross-sectional R squared": pd.Series(cs_results["R squared"], index=assets.index[window:])}
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+
+
+def _as_columns(data):
+    data = np.asarray(data, dtype=float)
+    return data.reshape(-1, 1) if data.ndim == 1 else data
+
+
+def _lag_products(x, nlags):
+    '''sum_t x_t x_t-l for l = 0..nlags and every column, via FFT'''
+    n = x.shape[0]
+    nfft = 1 << int(np.ceil(np.log2(2 * n - 1)))
+    F = np.fft.rfft(x, n=nfft, axis=0)
+    return np.fft.irfft(F * np.conj(F), n=nfft, axis=0)[:nlags + 1]
+
+
+def ACF(data, nlags, lag_mean=True):
+    '''
+    autocorrelations of every column of data, returns (nlags+1, m), or (nlags+1,) for one series
+    lag_mean=True matches ACF() in PS2/PS3: for lag l the mean is taken over the first n-l observations
+    lag_mean=False is the usual full-sample definition (statsmodels acf)
+    '''
+    x = _as_columns(data)
+    n = x.shape[0]
+    if not 0 <= nlags < n:
+        raise ValueError("nlags must be between 0 and len(data) - 1 = {}, got {}".format(n - 1, nlags))
+    lags = np.arange(nlags + 1).reshape(-1, 1)
+    if not lag_mean:
+        raw = _lag_products(x - x.mean(axis=0), nlags)
+        result = raw / raw[0]
+    else:
+        # the lag means are shift invariant; centering first avoids cancellation in raw - mean * (S_a + S_b)
+        x = x - x.mean(axis=0)
+        raw = _lag_products(x, nlags)
+        cumsum = np.vstack((np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)))
+        total = cumsum[-1]
+        S_b = cumsum[n - lags.ravel()]  # sum of x_0..x_n-1-l
+        S_a = total - cumsum[lags.ravel()]  # sum of x_l..x_n-1
+        mean = S_b / (n - lags)
+        nom = raw - mean * (S_a + S_b) + (n - lags) * mean ** 2
+        denom = np.sum(x ** 2, axis=0) - 2 * mean * total + n * mean ** 2
+        result = nom / denom
+    return result[:, 0] if np.ndim(data) == 1 else result
+
+
+def PACF(data, nlags, ACF_result=None):
+    '''Durbin-Levinson recursion over the full-sample ACF, returns (nlags+1, m)'''
+    r = _as_columns(ACF(data, nlags, lag_mean=False) if ACF_result is None else ACF_result)
+    PACF_result = np.ones_like(r)
+    phi = np.empty((0, r.shape[1]))
+    for k in range(1, nlags + 1):
+        nom = r[k] - np.sum(phi * r[k - 1:0:-1], axis=0)
+        denom = 1 - np.sum(phi * r[1:k], axis=0)
+        a = nom / denom
+        phi = np.vstack((phi - a * phi[::-1], a))
+        PACF_result[k] = a
+    return PACF_result[:, 0] if np.ndim(data) == 1 else PACF_result
+
+
+def Ljung_Box(data, nlags, dof=0, ACF_result=None):
+    '''Ljung-Box and Box-Pierce statistics for lags 1..nlags, each (nlags, m)'''
+    n = _as_columns(data).shape[0]
+    r = _as_columns(ACF(data, nlags, lag_mean=False) if ACF_result is None else ACF_result)[1:]
+    lags = np.arange(1, nlags + 1).reshape(-1, 1)
+    LB = n * (n + 2) * np.cumsum(r ** 2 / (n - lags), axis=0)
+    BP = n * np.cumsum(r ** 2, axis=0)
+    df = np.maximum(lags - dof, 1)
+    results = {"Ljung-Box Q": LB,
+               "Ljung-Box P-values": chi2.sf(LB, df),
+               "Box-Pierce Q": BP,
+               "Box-Pierce P-values": chi2.sf(BP, df)}
+    if np.ndim(data) == 1:
+        results = {key: value[:, 0] for key, value in results.items()}
+    return results
+
+
+def avg_ACF(data, nlags, lag_mean=True):
+    '''average ACF over the columns of data, replaces the loop over residual series in PS3'''
+    return np.mean(_as_columns(ACF(data, nlags, lag_mean)), axis=1)
+
+
+def ACF_frame(df, nlags, lag_mean=False):
+    '''
+    ACF, PACF and Ljung-Box Q for every column of a DataFrame, e.g. IC series of many factors
+    missing values are dropped per column and columns of the same length are computed in one call
+    returns DataFrames indexed by lag with one column per series
+    '''
+    groups = {}
+    for name in df.columns:
+        series = df[name].dropna()
+        if len(series) > nlags + 1:
+            groups.setdefault(len(series), []).append((name, series.to_numpy()))
+    ACF_dict, PACF_dict, Q_dict, p_dict = {}, {}, {}, {}
+    for n, items in groups.items():
+        names = [name for name, _ in items]
+        x = np.column_stack([values for _, values in items])
+        acf = ACF(x, nlags, lag_mean)
+        full_acf = acf if not lag_mean else ACF(x, nlags, lag_mean=False)
+        pacf = PACF(x, nlags, full_acf)
+        LB = Ljung_Box(x, nlags, ACF_result=full_acf)
+        for i, name in enumerate(names):
+            ACF_dict[name] = acf[:, i]
+            PACF_dict[name] = pacf[:, i]
+            Q_dict[name] = LB["Ljung-Box Q"][:, i]
+            p_dict[name] = LB["Ljung-Box P-values"][:, i]
+    columns = [name for name in df.columns if name in ACF_dict]
+    results = {"ACF": pd.DataFrame(ACF_dict, index=range(nlags + 1), columns=columns),
+               "PACF": pd.DataFrame(PACF_dict, index=range(nlags + 1), columns=columns),
+               "Ljung-Box Q": pd.DataFrame(Q_dict, index=range(1, nlags + 1), columns=columns),
+               "Ljung-Box P-values": pd.DataFrame(p_dict, index=range(1, nlags + 1), columns=columns)}
+    return results
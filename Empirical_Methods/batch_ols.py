@@ -0,0 +1,169 @@
+import numpy as np
+from scipy.stats import t, norm
+from statsmodels.tsa.adfvalues import mackinnonp
+
+
+def _as_batch(y, X, intercept):
+    '''y (n,) or (n, m), X (n, k) shared or (n, m, k) per regression -> y (m, n), X (1 or m, n, k)'''
+    y = np.asarray(y, dtype=float)
+    y = y.reshape(-1, 1) if y.ndim == 1 else y
+    X = np.asarray(X, dtype=float)
+    X = X.reshape(-1, 1) if X.ndim == 1 else X
+    X = X[None] if X.ndim == 2 else X.transpose(1, 0, 2)
+    if intercept:
+        X = np.concatenate((np.ones(X.shape[:2] + (1,)), X), axis=2)
+    return y.T, X
+
+
+def _has_const(X):
+    return np.all(X == 1.0, axis=1).any(axis=-1)
+
+
+def _hac_meat(X, e, nlags):
+    '''Newey-West with Bartlett weights 1 - j/(nlags+1)'''
+    u = X * e[:, :, None]
+    meat = np.einsum('bnk,bnl->bkl', u, u)
+    for j in range(1, nlags + 1):
+        gamma_j = np.einsum('bnk,bnl->bkl', u[:, j:], u[:, :-j])
+        meat += (1 - j / (nlags + 1)) * (gamma_j + gamma_j.transpose(0, 2, 1))
+    return meat
+
+
+def batch_ols(y, X, intercept=True, nlags=None, use_correction=False):
+    '''
+    m regressions in one call, columns of y are the dependent variables
+    X is shared (n, k) or one design per regression (n, m, k), e.g. simulated paths from simulation.var_paths
+    nlags: lags for Newey-West standard errors, None to skip; use_correction scales them by n/(n-k)
+    '''
+    y, X = _as_batch(y, X, intercept)
+    m, n = y.shape
+    k = X.shape[2]
+    df_resid = n - k
+
+    XtX_inv = np.linalg.inv(np.einsum('bnk,bnl->bkl', X, X))
+    beta = np.einsum('bkl,bl->bk', XtX_inv, np.einsum('bnk,bn->bk', X, y)) if X.shape[0] == m else \
+        (XtX_inv[0] @ (X[0].T @ y.T)).T
+    X = np.broadcast_to(X, (m, n, k))
+    fitted = np.einsum('bnk,bk->bn', X, beta)
+    e = y - fitted
+    ssr = np.sum(e ** 2, axis=1)
+    sigma_squared = ssr / df_resid
+
+    ols_var_cov_beta = XtX_inv * sigma_squared[:, None, None]
+    White_meat = np.einsum('bnk,bn,bnl->bkl', X, e ** 2, X, optimize=True)
+    White_var_cov_beta = n / df_resid * XtX_inv @ White_meat @ XtX_inv
+
+    const = _has_const(X)
+    centered = np.where(const[:, None], y - y.mean(axis=1, keepdims=True), y)
+    R_squared = 1 - ssr / np.sum(centered ** 2, axis=1)
+    adjusted_R_squared = 1 - (1 - R_squared) * (n - const) / df_resid
+    llf = -n / 2 * (np.log(2 * np.pi) + 1) - n / 2 * np.log(ssr / n)
+
+    results = {"Number of parameters": k,
+               "Sample size": n,
+               "Degrees of freedom for residuals": df_resid,
+               "Beta": beta,
+               "Fitted y": fitted.T,
+               "Residuals": e.T,
+               "OLS standard errors": np.sqrt(np.diagonal(ols_var_cov_beta, axis1=1, axis2=2)),
+               "White standard errors": np.sqrt(np.diagonal(White_var_cov_beta, axis1=1, axis2=2)),
+               "OLS variance-covariance matrix": ols_var_cov_beta,
+               "White variance-covariance matrix": White_var_cov_beta,
+               "Maximized log-likelihood function": llf,
+               "R squared": R_squared,
+               "Adjusted R squared": adjusted_R_squared,
+               "AIC": -2 * llf + 2 * k,
+               "BIC": -2 * llf + np.log(n) * k}
+    if nlags is not None:
+        NW_var_cov_beta = XtX_inv @ _hac_meat(X, e, nlags) @ XtX_inv
+        NW_var_cov_beta = NW_var_cov_beta * n / df_resid if use_correction else NW_var_cov_beta
+        results["Newey-West variance-covariance matrix"] = NW_var_cov_beta
+        results["Newey-West standard errors"] = np.sqrt(np.diagonal(NW_var_cov_beta, axis1=1, axis2=2))
+    return results
+
+
+def batch_t_test(ols_results, b=0, se="OLS"):
+    '''
+    t-statistics for every regression and coefficient, se: "OLS", "White" or "Newey-West"
+    p-values use the t distribution for OLS and the normal distribution for robust errors, as statsmodels does
+    '''
+    t_test = (ols_results["Beta"] - np.asarray(b)) / ols_results["{} standard errors".format(se)]
+    if se == "OLS":
+        p_value = 2 * t.sf(np.abs(t_test), ols_results["Degrees of freedom for residuals"])
+    else:
+        p_value = 2 * norm.sf(np.abs(t_test))
+    return {"T-statistics": t_test, "P-values": p_value}
+
+
+def ADF_regressors(data, nlags, const=True):
+    '''dz_t on [1], z_t-1, dz_t-1, ..., dz_t-nlags for each column, returns y (n', m), X (n', m, k)'''
+    data = np.asarray(data, dtype=float)
+    data = data.reshape(-1, 1) if data.ndim == 1 else data
+    delta_zt = np.diff(data, axis=0)
+    n = delta_zt.shape[0] - nlags
+    columns = [data[nlags:-1]] + [delta_zt[nlags - i:-i] for i in range(1, nlags + 1)]
+    if const:
+        columns = [np.ones_like(columns[0])] + columns
+    return delta_zt[nlags:], np.stack(columns, axis=2)[:n]
+
+
+def batch_ADF(data, nlags, const=True):
+    '''ADF t-statistics and MacKinnon p-values for every column of data'''
+    y, X = ADF_regressors(data, nlags, const)
+    ols_ADF = batch_ols(y, X, intercept=False)
+    idx = 1 if const else 0
+    ADF = ols_ADF["Beta"][:, idx] / ols_ADF["OLS standard errors"][:, idx]
+    pvalue = np.array([mackinnonp(stat, regression="c" if const else "n", N=1) for stat in ADF])
+    return ADF, pvalue
+
+
+def compare_statsmodels(n=500, m=200, k=3, nlags=4, seed=0):
+    '''
+    batch_ols, batch_ADF against statsmodels OLS (nonrobust, HC1, HAC) and adfuller fitted one series at a time
+    returns the largest absolute differences and the seconds taken by both
+    '''
+    import time
+    import statsmodels.api as sm
+    from statsmodels.tsa.stattools import adfuller
+
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n, k))
+    y = X @ rng.standard_normal((k, m)) + rng.standard_normal((n, m)) * (1 + np.abs(X[:, :1]))
+    walks = np.cumsum(rng.standard_normal((n, m)), axis=0)
+
+    start = time.perf_counter()
+    results = batch_ols(y, X, intercept=True, nlags=nlags, use_correction=True)
+    ADF, pvalue = batch_ADF(walks, nlags)
+    batch_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Xc = sm.add_constant(X)
+    sm_list = []
+    for i in range(m):
+        model = sm.OLS(y[:, i], Xc)
+        sm_list.append((model.fit(), model.fit(cov_type="HC1"),
+                        model.fit(cov_type="HAC", cov_kwds={"maxlags": nlags, "use_correction": True}),
+                        adfuller(walks[:, i], maxlag=nlags, regression="c", autolag=None,
+                                 result_object=False)))
+    sm_seconds = time.perf_counter() - start
+
+    def max_diff(batch, sm_values):
+        return float(np.max(np.abs(batch - np.array(sm_values))))
+
+    return {"Beta": max_diff(results["Beta"], [fit.params for fit, _, _, _ in sm_list]),
+            "OLS standard errors": max_diff(results["OLS standard errors"], [fit.bse for fit, _, _, _ in sm_list]),
+            "White standard errors": max_diff(results["White standard errors"], [fit.bse for _, fit, _, _ in sm_list]),
+            "Newey-West standard errors": max_diff(results["Newey-West standard errors"],
+                                                   [fit.bse for _, _, fit, _ in sm_list]),
+            "R squared": max_diff(results["R squared"], [fit.rsquared for fit, _, _, _ in sm_list]),
+            "Maximized log-likelihood function": max_diff(results["Maximized log-likelihood function"],
+                                                          [fit.llf for fit, _, _, _ in sm_list]),
+            "ADF": max_diff(ADF, [adf[0] for _, _, _, adf in sm_list]),
+            "ADF P-values": max_diff(pvalue, [adf[1] for _, _, _, adf in sm_list]),
+            "batch seconds": batch_seconds,
+            "statsmodels seconds": sm_seconds}
+
+
+if __name__ == "__main__":
+    for key, value in compare_statsmodels().items():
+        print("{}: {:.3g}".format(key, value))
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.signal import lfilter
+
+
+def _get_rng(rng=None, seed=None):
+    return rng if rng is not None else np.random.default_rng(seed)
+
+
+def arma_paths(AR_param=(), MA_param=(), nsample=100, burnin=0, paths=1, sigma=1.0, const=0.0,
+               rng=None, seed=None):
+    '''x_t = c + sum(phi_i x_t-i) + e_t + sum(theta_j e_t-j), zero pre-sample values, returns (nsample, paths)'''
+    rng = _get_rng(rng, seed)
+    AR_param = np.atleast_1d(np.asarray(AR_param, dtype=float))
+    MA_param = np.atleast_1d(np.asarray(MA_param, dtype=float))
+    ncol = burnin + nsample
+    e_array = sigma * rng.standard_normal((paths, ncol))
+    # recursive filter along time for all paths at once
+    x_array = lfilter(np.r_[1.0, MA_param], np.r_[1.0, -AR_param], e_array, axis=1)
+    if const:
+        # c enters the AR recursion only, not the MA filter, so the mean is c / (1 - sum(phi))
+        x_array += lfilter([1.0], np.r_[1.0, -AR_param], np.full(ncol, float(const)))
+    return x_array[:, burnin:].T
+
+
+def ar_paths(AR_param, nsample=100, burnin=0, paths=1, sigma=1.0, const=0.0, rng=None, seed=None):
+    return arma_paths(AR_param, (), nsample, burnin, paths, sigma, const, rng, seed)
+
+
+def ma_paths(MA_param, nsample=100, burnin=0, paths=1, sigma=1.0, const=0.0, rng=None, seed=None):
+    return arma_paths((), MA_param, nsample, burnin, paths, sigma, const, rng, seed)
+
+
+def var_paths(A_list, nsample=100, burnin=0, paths=1, cov=None, const=None, rng=None, seed=None):
+    '''X_t = c + sum(A_i X_t-i) + E_t, E_t ~ N(0, cov), zero pre-sample values, returns (nsample, paths, k)'''
+    rng = _get_rng(rng, seed)
+    A_list = [np.asarray(A, dtype=float) for A in A_list]
+    p = len(A_list)
+    k = A_list[0].shape[0]
+    cov = np.eye(k) if cov is None else np.asarray(cov, dtype=float)
+    const = np.zeros(k) if const is None else np.asarray(const, dtype=float).reshape(k)
+    chol = np.linalg.cholesky(cov)
+
+    ncol = burnin + nsample
+    X_array = np.zeros((paths, p + ncol, k))
+    X_array[:, p:] = rng.standard_normal((paths, ncol, k)) @ chol.T + const
+    # the shocks are stored in place and the lagged terms added step by step, vectorized over paths
+    for i in range(p, p + ncol):
+        for j, A in enumerate(A_list, start=1):
+            X_array[:, i] += X_array[:, i - j] @ A.T
+    return X_array[:, p + burnin:].transpose(1, 0, 2)
+
+
+def vecm_to_var(alpha, gamma, phi_list=()):
+    '''dX_t = gamma alpha' X_t-1 + sum(Phi_i dX_t-i) + E_t  ->  levels VAR(p+1) matrices'''
+    alpha = np.asarray(alpha, dtype=float)
+    alpha = alpha.reshape(-1, 1) if alpha.ndim == 1 else alpha
+    gamma = np.asarray(gamma, dtype=float)
+    gamma = gamma.reshape(-1, 1) if gamma.ndim == 1 else gamma
+    k = alpha.shape[0]
+    phi_list = [np.asarray(phi, dtype=float) for phi in phi_list]
+    Pi = gamma @ alpha.T
+    A_list = [np.eye(k) + Pi + (phi_list[0] if phi_list else 0)]
+    for i in range(1, len(phi_list)):
+        A_list.append(phi_list[i] - phi_list[i - 1])
+    if phi_list:
+        A_list.append(-phi_list[-1])
+    return A_list
+
+
+def vecm_paths(alpha, gamma, phi_list=(), nsample=100, burnin=0, paths=1, cov=None, rng=None, seed=None):
+    '''simulate_VECM1 for many paths: alpha (k, r), gamma (k, r), phi_list of (k, k), returns (nsample, paths, k)'''
+    return var_paths(vecm_to_var(alpha, gamma, phi_list), nsample, burnin, paths, cov, None, rng, seed)
+
+
+def simulate_in_chunks(simulate, paths, chunk_paths=10000, seed=None, **kwargs):
+    '''yield simulate(paths=n, rng=...) for chunks of at most chunk_paths paths, same seed and chunk_paths -> same draws'''
+    nchunk = int(np.ceil(paths / chunk_paths))
+    for i, child in enumerate(np.random.SeedSequence(seed).spawn(nchunk)):
+        n = min(chunk_paths, paths - i * chunk_paths)
+        yield simulate(paths=n, rng=np.random.default_rng(child), **kwargs)
+
+
+def monte_carlo(statistic, simulate, paths, chunk_paths=10000, seed=None, **kwargs):
+    '''statistic(chunk) returns one value (or row) per path, results of all chunks are stacked along axis 0'''
+    results = [np.asarray(statistic(chunk)) for chunk in
+               simulate_in_chunks(simulate, paths, chunk_paths, seed, **kwargs)]
+    return np.concatenate(results, axis=0)